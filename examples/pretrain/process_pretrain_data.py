@@ -4,17 +4,22 @@
 import logging
 import os
 import tarfile
+from functools import partial
 
-from tapex.common.download import download_file
-from tapex.data_utils.preprocess_binary import fairseq_binary_translation
-from tapex.data_utils.preprocess_bpe import fairseq_bpe_translation
+from tapex.common.download import download_file, download_model_weights, ensure_bpe_files
+from tapex.data_utils.binary_builder import build_fairseq_binary_dataset
+from tapex.data_utils.build_manifest import BuildManifest, MANIFEST_FILE, BINARIZE_RESOURCE_FILES, DATA_UTILS_DIR
 from tapex.processor import get_default_processor
 from random import shuffle
 
 PROCESSED_DATASET_FOLDER = "dataset"
-TABLE_PROCESSOR = get_default_processor(max_cell_length=15, max_input_length=1024)
 # Options: bart.base, bart.large (you do not need to further pre-train your models on tapex.base or tapex.large)
 MODEL_NAME = "bart.base"
+# the BPE files of the model are also used by the tokenizer of the table processor, without the HuggingFace hub
+RESOURCE_DIR = os.path.abspath(MODEL_NAME)
+TABLE_PROCESSOR = get_default_processor(max_cell_length=15, max_input_length=1024, resource_dir=RESOURCE_DIR)
+# the number of processes encoding and binarizing the corpus, all cores by default
+NUM_WORKERS = None
 logger = logging.getLogger(__name__)
 
 
@@ -78,25 +83,61 @@ def split_train_valid(data_dir):
     valid_tgt_out.close()
 
 
-def preprocess_pretrain_dataset(processed_data_dir):
-    fairseq_bpe_translation(processed_data_dir, resource_name=MODEL_NAME, with_test_set=False)
-    fairseq_binary_translation(processed_data_dir, resource_name=MODEL_NAME, with_test_set=False)
+def _build_pretrain_example_processor():
+    # the corpus has been truncated and linearized, thus the lines are kept as they are
+    def _process_example(example):
+        return example
+
+    return _process_example
+
+
+def preprocess_pretrain_dataset(processed_data_dir, out_prefixes=("train", "valid")):
+    resource_dir = RESOURCE_DIR
+    if not os.path.exists(os.path.join(resource_dir, "model.pt")):
+        download_model_weights(resource_dir, MODEL_NAME)
+    ensure_bpe_files(resource_dir)
+    # BPE and binarization are done in one pass, without writing the BPE text files
+    for out_prefix in out_prefixes:
+        with open(os.path.join(processed_data_dir, "{}.src".format(out_prefix)), "r", encoding="utf8") as src_f, \
+                open(os.path.join(processed_data_dir, "{}.tgt".format(out_prefix)), "r", encoding="utf8") as tgt_f:
+            build_fairseq_binary_dataset(zip(src_f, tgt_f), _build_pretrain_example_processor, out_prefix,
+                                         resource_dir, os.path.join(processed_data_dir, MODEL_NAME, "bin"),
+                                         num_workers=NUM_WORKERS)
+
+
+def prepare_pretrain_corpus():
+    pretrain_path = download_tapex_pretraining_data()
+    # split train/valid set
+    split_train_valid(pretrain_path)
+    return pretrain_path
 
 
 if __name__ == '__main__':
     logger.info("You are using the setting of {}".format(MODEL_NAME))
+    ensure_bpe_files(RESOURCE_DIR)
+    pretrain_path = os.path.join(PROCESSED_DATASET_FOLDER, "pretrain")
+    # stages whose inputs and settings are unchanged since the last run are skipped
+    manifest = BuildManifest(os.path.join(pretrain_path, MODEL_NAME, MANIFEST_FILE))
+    corpus_files = {split: [os.path.join(pretrain_path, "{}.{}".format(split, lang)) for lang in ["src", "tgt"]]
+                    for split in ["train", "valid"]}
 
     logger.info("*" * 80)
     logger.info("Prepare to download TAPEX Pre-training Corpus from the official link...")
-    pretrain_path = download_tapex_pretraining_data()
+    # the training set is rewritten when the validation set is split from it, thus both are done in one stage
+    manifest.run_stage("download", prepare_pretrain_corpus, outputs=corpus_files["train"] + corpus_files["valid"],
+                       check_output_contents=False)
     logger.info("Download finished! The processed pre-training corpus is saved in {}".format(pretrain_path))
 
-    # split train/valid set
-    split_train_valid(pretrain_path)
-
     logger.info("*" * 80)
     logger.info("Begin to BPE and build the dataset binaries in {}/bin".format(pretrain_path))
-    preprocess_pretrain_dataset(pretrain_path)
+    # the BPE and binarization depend on the model resources and the data utils besides the corpus
+    resource_files = [os.path.join(MODEL_NAME, file_name) for file_name in BINARIZE_RESOURCE_FILES]
+    for split in ["train", "valid"]:
+        manifest.run_stage("binarize.{}".format(split), partial(preprocess_pretrain_dataset, pretrain_path, [split]),
+                           inputs=corpus_files[split] + [__file__, DATA_UTILS_DIR] + resource_files,
+                           outputs=[os.path.join(pretrain_path, MODEL_NAME, "bin", "{}.src-tgt.{}.{}".format(
+                               split, lang, extension)) for lang in ["src", "tgt"] for extension in ["bin", "idx"]],
+                           config={"model_name": MODEL_NAME})
 
     logger.info("*" * 80)
     logger.info("Now you can pre-train any generative model using {} as the <data_dir> argument. "
@@ -7,7 +7,7 @@ import zipfile
 import logging
 from tqdm import tqdm
 import json
-from tapex.common.download import download_file
+from tapex.common.download import download_file, ensure_bpe_files
 from tapex.processor import get_default_processor
 from tapex.data_utils.preprocess_bpe import fairseq_bpe_classification
 from tapex.data_utils.preprocess_binary import fairseq_binary_classification
@@ -16,9 +16,11 @@ from typing import List
 RAW_DATASET_FOLDER = "raw_dataset"
 PROCESSED_DATASET_FOLDER = "dataset"
 TABLE_PATH = os.path.join(RAW_DATASET_FOLDER, "tabfact")
-TABLE_PROCESSOR = get_default_processor(max_cell_length=15, max_input_length=1024)
 # Options: bart.base, bart.large, tapex.base, tapex.large
 MODEL_NAME = "tapex.base"
+# the BPE files of the model are also used by the tokenizer of the table processor, without the HuggingFace hub
+RESOURCE_DIR = os.path.abspath(MODEL_NAME)
+TABLE_PROCESSOR = get_default_processor(max_cell_length=15, max_input_length=1024, resource_dir=RESOURCE_DIR)
 logger = logging.getLogger(__name__)
 
 
@@ -95,6 +97,7 @@ def preprocess_tabfact_dataset(processed_data_dir):
 
 if __name__ == '__main__':
     logger.info("You are using the setting of {}".format(MODEL_NAME))
+    ensure_bpe_files(RESOURCE_DIR)
 
     logger.info("*" * 80)
     logger.info("Prepare to download preprocessed TabFact json line file from our released link...")
@@ -5,20 +5,28 @@ import os
 import shutil
 import zipfile
 import logging
-from tqdm import tqdm
+from functools import partial
+from itertools import islice
 import pandas as pd
-from tapex.common.download import download_file
+from tapex.common.download import download_file, ensure_bpe_files
 from tapex.processor import get_default_processor
 from tapex.data_utils.preprocess_bpe import fairseq_bpe_translation
 from tapex.data_utils.preprocess_binary import fairseq_binary_translation
 from tapex.data_utils.format_converter import convert_fairseq_to_hf
+from tapex.data_utils.dataset_builder import build_fairseq_dataset
+from tapex.data_utils.table_store import TableStore
 
 RAW_DATASET_FOLDER = "raw_dataset"
 PROCESSED_DATASET_FOLDER = "dataset"
 TABLE_PATH = os.path.join(RAW_DATASET_FOLDER, "sqa")
-TABLE_PROCESSOR = get_default_processor(max_cell_length=15, max_input_length=1024)
+# the number of processes building the dataset, all cores by default
+NUM_WORKERS = None
+# the delimiter of answers in the targets, the same as the one of the table processor
+TARGET_DELIMITER = ", "
 # Options: bart.base, bart.large, tapex.base, tapex.large
 MODEL_NAME = "tapex.base"
+# the BPE files of the model are also used by the tokenizer of the table processor, without the HuggingFace hub
+RESOURCE_DIR = os.path.abspath(MODEL_NAME)
 logger = logging.getLogger(__name__)
 
 
@@ -39,35 +47,44 @@ def download_sqa():
     return sqa_raw_path
 
 
-def build_sqa_fairseq_dataset(out_prefix, src_file, data_dir):
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
+def _read_table_from_file(_sqa_table_name: str):
+    rows = []
+    assert ".csv" in _sqa_table_name
+    table_data = pd.read_csv(os.path.join(TABLE_PATH, _sqa_table_name))
+    # the first line is header
+    header = list(table_data.columns)
+    for row_data in table_data.values:
+        rows.append([str(_) for _ in list(row_data)])
 
-    def _read_table_from_file(_sqa_table_name: str):
-        rows = []
-        assert ".csv" in _sqa_table_name
-        table_data = pd.read_csv(os.path.join(TABLE_PATH, _sqa_table_name))
-        # the first line is header
-        header = list(table_data.columns)
-        for row_data in table_data.values:
-            rows.append([str(_) for _ in list(row_data)])
+    return {
+        "header": header,
+        "rows": rows
+    }
 
-        return {
-            "header": header,
-            "rows": rows
-        }
 
-    input_f = open("{}/{}.src".format(data_dir, out_prefix), "w", encoding="utf8")
-    output_f = open("{}/{}.tgt".format(data_dir, out_prefix), "w", encoding="utf8")
+# many questions are asked on the same table, thus each table is parsed once and shared by all questions
+TABLE_STORE = TableStore(_read_table_from_file)
 
-    examples = open(src_file, "r", encoding="utf8").readlines()
+
+def _iter_table_files(src_f):
+    # skip the header line, and leave malformed lines to `_iter_sqa_examples`
+    for example in islice(src_f, 1, None):
+        fields = example.strip("\n").split("\t")
+        if len(fields) == 7:
+            yield fields[4]
+
+
+def _iter_sqa_examples(src_f):
+    """
+    Parse the examples in order, prepending the previous questions of the same sequence to each question.
+    """
     history = ""
-    idx = 1
-    for example in tqdm(examples[1:]):
+    # skip the header line
+    for line_idx, example in enumerate(islice(src_f, 1, None), start=2):
+        question = ""
         try:
             anno_id, _, position, question, table_file, _, answer_text = example.strip("\n").split("\t")
             answer_text = answer_text.replace("\"\"", "\"").strip("\"'")
-            # must contain rows and header keys
             if position == "0":
                 # reset history
                 history = ""
@@ -75,23 +92,51 @@ def build_sqa_fairseq_dataset(out_prefix, src_file, data_dir):
             if history:
                 question = history + " " + question
             answer = eval(answer_text)
-            table_content = _read_table_from_file(table_file)
+            if TARGET_DELIMITER.join(answer).strip() == "":
+                raise ValueError("The Answer is EMPTY!")
+        except Exception:
+            logger.error("Error case on Line: {}, {}".format(line_idx, question))
+            continue
+        # reset the history
+        history = question
+        yield question, table_file, answer
+
+
+def _build_sqa_example_processor(out_prefix):
+    """
+    Called once in each worker, which gets its own table processor and shares the tables loaded before forking.
+    """
+    # the table store hands out a fresh view for every question, so the truncation never modifies the parsed table
+    table_processor = get_default_processor(max_cell_length=15, max_input_length=1024,
+                                            resource_dir=RESOURCE_DIR)
+
+    def _process_example(example):
+        question, table_file, answer = example
+        try:
+            # must contain rows and header keys
+            table_content = TABLE_STORE.get(table_file)
             if out_prefix == "train":
                 # in training, we employ answer to filter table rows to make LARGE tables fit into memory;
                 # otherwise, we cannot utilize answer information
-                input_source = TABLE_PROCESSOR.process_input(table_content, question, answer).lower()
+                input_source, answer = table_processor.process_example(table_content, question, answer)
             else:
-                input_source = TABLE_PROCESSOR.process_input(table_content, question, []).lower()
-            output_target = TABLE_PROCESSOR.process_output(answer).lower()
-            input_f.write(input_source + "\n")
-            output_f.write(output_target + "\n")
-            # reset the history
-            history = question
-            idx += 1
-        except:
-            logger.error("Error case on Line: {}, {}".format(idx, question))
-    input_f.close()
-    output_f.close()
+                input_source, _ = table_processor.process_example(table_content, question, [])
+            output_target = table_processor.process_output(answer).lower()
+        except Exception:
+            logger.error("Error case on table {}, {}".format(table_file, question))
+            return None
+        return input_source.lower(), output_target
+
+    return _process_example
+
+
+def build_sqa_fairseq_dataset(out_prefix, src_file, data_dir, num_workers=NUM_WORKERS):
+    # parse the referenced tables before forking workers, so that every table is parsed only once
+    with open(src_file, "r", encoding="utf8") as src_f:
+        TABLE_STORE.load(_iter_table_files(src_f), ignore_errors=True)
+    with open(src_file, "r", encoding="utf8") as src_f:
+        build_fairseq_dataset(_iter_sqa_examples(src_f), partial(_build_sqa_example_processor, out_prefix),
+                              out_prefix, data_dir, num_workers=num_workers)
 
 
 def build_sqa_huggingface_dataset(fairseq_data_dir):
@@ -101,12 +146,13 @@ def build_sqa_huggingface_dataset(fairseq_data_dir):
 
 
 def preprocess_sqa_dataset(processed_data_dir):
-    fairseq_bpe_translation(processed_data_dir, resource_name=MODEL_NAME)
+    fairseq_bpe_translation(processed_data_dir, resource_name=MODEL_NAME, num_workers=NUM_WORKERS)
     fairseq_binary_translation(processed_data_dir, resource_name=MODEL_NAME)
 
 
 if __name__ == '__main__':
     logger.info("You are using the setting of {}".format(MODEL_NAME))
+    ensure_bpe_files(RESOURCE_DIR)
 
     logger.info("*" * 80)
     logger.info("Prepare to download SQA dataset from the official link...")
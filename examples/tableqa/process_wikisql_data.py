@@ -6,20 +6,29 @@ import logging
 import os
 import tarfile
 from copy import deepcopy
+from functools import partial
 
-from tapex.common.download import download_file
+from tapex.common.download import download_file, ensure_bpe_files
 from tapex.data_utils.wikisql.executor import retrieve_wikisql_query_answer_tapas, _TYPE_CONVERTER
 from tapex.processor import get_default_processor
 from tapex.data_utils.preprocess_bpe import fairseq_bpe_translation
 from tapex.data_utils.preprocess_binary import fairseq_binary_translation
 from tapex.data_utils.format_converter import convert_fairseq_to_hf
+from tapex.data_utils.dataset_builder import build_fairseq_dataset
+from tapex.data_utils.build_manifest import BuildManifest, MANIFEST_FILE, BINARIZE_RESOURCE_FILES, DATA_UTILS_DIR, \
+    describe_processor
 
 
 RAW_DATASET_FOLDER = "raw_dataset"
 PROCESSED_DATASET_FOLDER = "dataset"
-TABLE_PROCESSOR = get_default_processor(max_cell_length=15, max_input_length=1024)
+MAX_CELL_LENGTH = 15
+MAX_INPUT_LENGTH = 1024
+# the number of processes building the dataset, all cores by default
+NUM_WORKERS = None
 # Options: bart.base, bart.large, tapex.base, tapex.large
 MODEL_NAME = "tapex.base"
+# the BPE files of the model are also used by the tokenizer of the table processor, without the HuggingFace hub
+RESOURCE_DIR = os.path.abspath(MODEL_NAME)
 logger = logging.getLogger(__name__)
 
 
@@ -39,36 +48,30 @@ def download_wikisql():
     return wikisql_raw_path
 
 
-def build_wikisql_fariseq_dataset(out_prefix, src_file, data_dir):
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
-
-    def _convert_table_types(table):
-        """Runs the type converter over the table cells."""
-        ret_table = deepcopy(table)
-        types = ret_table['types']
-        ret_table['real_rows'] = ret_table['rows']
-        typed_rows = []
-        for row in ret_table['rows']:
-            typed_row = []
-            for column, cell_value in enumerate(row):
-                typed_row.append(_TYPE_CONVERTER[types[column]](cell_value))
-            typed_rows.append(typed_row)
-        ret_table['rows'] = typed_rows
-        return ret_table
-
-    # load table content dictionary from files
-    table_content_dict = {}
-    table_file_path = "{}.tables.jsonl".format(src_file.split(".")[0])
-    for json_line in open(table_file_path, "r", encoding="utf8"):
-        content = json.loads(json_line)
-        table_content_dict[content["id"]] = content
+def _convert_table_types(table):
+    """Runs the type converter over the table cells."""
+    ret_table = deepcopy(table)
+    types = ret_table['types']
+    ret_table['real_rows'] = ret_table['rows']
+    typed_rows = []
+    for row in ret_table['rows']:
+        typed_row = []
+        for column, cell_value in enumerate(row):
+            typed_row.append(_TYPE_CONVERTER[types[column]](cell_value))
+        typed_rows.append(typed_row)
+    ret_table['rows'] = typed_rows
+    return ret_table
 
-    input_f = open("{}/{}.src".format(data_dir, out_prefix), "w", encoding="utf8")
-    output_f = open("{}/{}.tgt".format(data_dir, out_prefix), "w", encoding="utf8")
 
-    examples = open(src_file, "r", encoding="utf8").readlines()
-    for example in examples:
+def _build_wikisql_example_processor(out_prefix, table_content_dict):
+    """
+    Called once in each worker, which gets its own table processor.
+    """
+    # tables are shared by questions, so the truncation must not modify them
+    table_processor = get_default_processor(max_cell_length=MAX_CELL_LENGTH, max_input_length=MAX_INPUT_LENGTH,
+                                            copy_on_write=True, resource_dir=RESOURCE_DIR)
+
+    def _process_example(example: str):
         # each line is a json object
         example = json.loads(example)
         table_id = example["table_id"]
@@ -80,15 +83,26 @@ def build_wikisql_fariseq_dataset(out_prefix, src_file, data_dir):
         if out_prefix == "train":
             # in training, we employ answer to filter table rows to make LARGE tables fit into memory;
             # otherwise, we cannot utilize answer information
-            input_source = TABLE_PROCESSOR.process_input(table_content, question, answer).lower()
+            input_source, answer = table_processor.process_example(table_content, question, answer)
         else:
-            input_source = TABLE_PROCESSOR.process_input(table_content, question, []).lower()
-        output_target = TABLE_PROCESSOR.process_output(answer).lower()
-        input_f.write(input_source + "\n")
-        output_f.write(output_target + "\n")
+            input_source, _ = table_processor.process_example(table_content, question, [])
+        output_target = table_processor.process_output(answer).lower()
+        return input_source.lower(), output_target
+
+    return _process_example
 
-    input_f.close()
-    output_f.close()
+
+def build_wikisql_fariseq_dataset(out_prefix, src_file, data_dir, num_workers=NUM_WORKERS):
+    # load table content dictionary from files, which is inherited by the forked workers
+    table_content_dict = {}
+    table_file_path = "{}.tables.jsonl".format(src_file.split(".")[0])
+    for json_line in open(table_file_path, "r", encoding="utf8"):
+        content = json.loads(json_line)
+        table_content_dict[content["id"]] = content
+
+    with open(src_file, "r", encoding="utf8") as src_f:
+        build_fairseq_dataset(src_f, partial(_build_wikisql_example_processor, out_prefix, table_content_dict),
+                              out_prefix, data_dir, num_workers=num_workers)
 
 
 def build_wikisql_huggingface_dataset(fairseq_data_dir):
@@ -98,35 +112,56 @@ def build_wikisql_huggingface_dataset(fairseq_data_dir):
 
 
 def preprocess_wikisql_dataset(processed_data_dir):
-    fairseq_bpe_translation(processed_data_dir, resource_name=MODEL_NAME)
+    fairseq_bpe_translation(processed_data_dir, resource_name=MODEL_NAME, num_workers=NUM_WORKERS)
     fairseq_binary_translation(processed_data_dir, resource_name=MODEL_NAME)
 
 
 if __name__ == '__main__':
     logger.info("You are using the setting of {}".format(MODEL_NAME))
+    ensure_bpe_files(RESOURCE_DIR)
+    processed_wikisql_data_dir = os.path.join(PROCESSED_DATASET_FOLDER, "wikisql")
+    # stages whose inputs and settings are unchanged since the last run are skipped
+    manifest = BuildManifest(os.path.join(processed_wikisql_data_dir, MANIFEST_FILE))
+    wikisql_raw_data_dir = os.path.join(RAW_DATASET_FOLDER, "wikisql")
 
     logger.info("*" * 80)
     logger.info("Prepare to download WikiSQL from the official link...")
-    wikisql_raw_data_dir = download_wikisql()
+    manifest.run_stage("download", download_wikisql, outputs=[wikisql_raw_data_dir], check_output_contents=False)
     logger.info("Download finished! The original WikiSQL dataset is saved in {}".format(wikisql_raw_data_dir))
-    processed_wikisql_data_dir = os.path.join(PROCESSED_DATASET_FOLDER, "wikisql")
 
     logger.info("*" * 80)
     logger.info("Process the dataset and save the processed dataset in {}".format(processed_wikisql_data_dir))
-    build_wikisql_fariseq_dataset("train", os.path.join(wikisql_raw_data_dir, "data", "train.jsonl"),
-                                  processed_wikisql_data_dir)
-    build_wikisql_fariseq_dataset("valid", os.path.join(wikisql_raw_data_dir, "data", "dev.jsonl"),
-                                  processed_wikisql_data_dir)
-    build_wikisql_fariseq_dataset("test", os.path.join(wikisql_raw_data_dir, "data", "test.jsonl"),
-                                  processed_wikisql_data_dir)
+    processor_config = describe_processor(get_default_processor(max_cell_length=MAX_CELL_LENGTH,
+                                                                max_input_length=MAX_INPUT_LENGTH,
+                                                                resource_dir=RESOURCE_DIR))
+    dataset_files = []
+    for split, split_name in [("train", "train"), ("valid", "dev"), ("test", "test")]:
+        split_src_file = os.path.join(wikisql_raw_data_dir, "data", "{}.jsonl".format(split_name))
+        split_table_file = os.path.join(wikisql_raw_data_dir, "data", "{}.tables.jsonl".format(split_name))
+        split_dataset_files = [os.path.join(processed_wikisql_data_dir, "{}.{}".format(split, lang))
+                               for lang in ["src", "tgt"]]
+        # this script is an input as well, since it decides how examples are processed
+        manifest.run_stage("linearize.{}".format(split),
+                           partial(build_wikisql_fariseq_dataset, split, split_src_file, processed_wikisql_data_dir),
+                           inputs=[__file__, split_src_file, split_table_file],
+                           outputs=split_dataset_files, config=processor_config)
+        dataset_files.extend(split_dataset_files)
 
     logger.info("*" * 80)
     logger.info("Begin to BPE and build the dataset binaries in {}/bin".format(processed_wikisql_data_dir))
-    preprocess_wikisql_dataset(processed_wikisql_data_dir)
+    # the BPE and binarization depend on the model resources and the data utils besides the dataset files
+    binarize_inputs = dataset_files + [__file__, DATA_UTILS_DIR] + \
+        [os.path.join(MODEL_NAME, file_name) for file_name in BINARIZE_RESOURCE_FILES]
+    manifest.run_stage("binarize", partial(preprocess_wikisql_dataset, processed_wikisql_data_dir),
+                       inputs=binarize_inputs, outputs=[os.path.join(processed_wikisql_data_dir, MODEL_NAME, "bin")],
+                       config={"model_name": MODEL_NAME})
 
     logger.info("*" * 80)
     logger.info("Begin to build the HuggingFace dataset version in {}".format(processed_wikisql_data_dir))
-    build_wikisql_huggingface_dataset(processed_wikisql_data_dir)
+    manifest.run_stage("huggingface", partial(build_wikisql_huggingface_dataset, processed_wikisql_data_dir),
+                       inputs=dataset_files,
+                       outputs=[os.path.join(processed_wikisql_data_dir, "{}.json".format(split))
+                                for split in ["train", "valid", "test"]])
 
     logger.info("*" * 80)
     logger.info("Now you can train models using {} as the <data_dir> argument. "
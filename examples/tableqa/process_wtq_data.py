@@ -5,20 +5,30 @@ import os
 import shutil
 import zipfile
 import logging
-from tqdm import tqdm
+from functools import partial
+from itertools import islice
 
-from tapex.common.download import download_file
+from tapex.common.download import download_file, ensure_bpe_files
 from tapex.processor import get_default_processor
 from tapex.data_utils.preprocess_bpe import fairseq_bpe_translation
 from tapex.data_utils.preprocess_binary import fairseq_binary_translation
 from tapex.data_utils.format_converter import convert_fairseq_to_hf
+from tapex.data_utils.dataset_builder import build_fairseq_dataset
+from tapex.data_utils.table_store import TableStore
+from tapex.data_utils.build_manifest import BuildManifest, MANIFEST_FILE, BINARIZE_RESOURCE_FILES, DATA_UTILS_DIR, \
+    describe_processor
 
 RAW_DATASET_FOLDER = "raw_dataset"
 PROCESSED_DATASET_FOLDER = "dataset"
 TABLE_PATH = os.path.join(RAW_DATASET_FOLDER, "wtq")
-TABLE_PROCESSOR = get_default_processor(max_cell_length=15, max_input_length=1024)
+MAX_CELL_LENGTH = 15
+MAX_INPUT_LENGTH = 1024
+# the number of processes building the dataset, all cores by default
+NUM_WORKERS = None
 # Options: bart.base, bart.large, tapex.base, tapex.large
 MODEL_NAME = "tapex.base"
+# the BPE files of the model are also used by the tokenizer of the table processor, without the HuggingFace hub
+RESOURCE_DIR = os.path.abspath(MODEL_NAME)
 logger = logging.getLogger(__name__)
 
 
@@ -40,52 +50,71 @@ def download_wikitablequestions():
     return wtq_raw_path
 
 
-def build_wtq_fairseq_dataset(out_prefix, src_file, data_dir):
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
-
-    def _extract_content(_line: str):
-        _vals = [_.replace("\n", " ").strip() for _ in _line.strip("\n").split("\t")]
-        return _vals
-
-    def _read_table_from_file(_wtq_table_name: str):
-        rows = []
-        assert ".csv" in _wtq_table_name
-        # use the normalized table file
-        _wtq_table_name = _wtq_table_name.replace(".csv", ".tsv")
-        with open(os.path.join(TABLE_PATH, _wtq_table_name), "r", encoding="utf8") as table_f:
-            table_lines = table_f.readlines()
-            # the first line is header
-            header = _extract_content(table_lines[0])
-            for line in table_lines[1:]:
-                rows.append(_extract_content(line))
-
-        return {
-            "header": header,
-            "rows": rows
-        }
-
-    input_f = open("{}/{}.src".format(data_dir, out_prefix), "w", encoding="utf8")
-    output_f = open("{}/{}.tgt".format(data_dir, out_prefix), "w", encoding="utf8")
-
-    examples = open(src_file, "r", encoding="utf8").readlines()
-    for example in tqdm(examples[1:]):
-        _, question, table_name, answer = example.strip("\n").split("\t")
-        answer = answer.split("|")
+def _extract_content(_line: str):
+    _vals = [_.replace("\n", " ").strip() for _ in _line.strip("\n").split("\t")]
+    return _vals
+
+
+def _read_table_from_file(_wtq_table_name: str):
+    rows = []
+    assert ".csv" in _wtq_table_name
+    # use the normalized table file
+    _wtq_table_name = _wtq_table_name.replace(".csv", ".tsv")
+    with open(os.path.join(TABLE_PATH, _wtq_table_name), "r", encoding="utf8") as table_f:
+        table_lines = table_f.readlines()
+        # the first line is header
+        header = _extract_content(table_lines[0])
+        for line in table_lines[1:]:
+            rows.append(_extract_content(line))
+
+    return {
+        "header": header,
+        "rows": rows
+    }
+
+
+# many questions are asked on the same table, thus each table is parsed once and shared by all questions
+TABLE_STORE = TableStore(_read_table_from_file)
+
+
+def _split_example(example: str):
+    _, question, table_name, answer = example.strip("\n").split("\t")
+    return question, table_name, answer.split("|")
+
+
+def _build_wtq_example_processor(out_prefix):
+    """
+    Called once in each worker, which gets its own table processor and shares the tables loaded before forking.
+    """
+    # the table store hands out a fresh view for every question, so the truncation never modifies the parsed table
+    table_processor = get_default_processor(max_cell_length=MAX_CELL_LENGTH, max_input_length=MAX_INPUT_LENGTH,
+                                            resource_dir=RESOURCE_DIR)
+
+    def _process_example(example: str):
+        question, table_name, answer = _split_example(example)
         # must contain rows and header keys
-        table_content = _read_table_from_file(table_name)
+        table_content = TABLE_STORE.get(table_name)
         if out_prefix == "train":
             # in training, we employ answer to filter table rows to make LARGE tables fit into memory;
             # otherwise, we cannot utilize answer information
-            input_source = TABLE_PROCESSOR.process_input(table_content, question, answer).lower()
+            input_source, answer = table_processor.process_example(table_content, question, answer)
         else:
-            input_source = TABLE_PROCESSOR.process_input(table_content, question, []).lower()
-        output_target = TABLE_PROCESSOR.process_output(answer).lower()
-        input_f.write(input_source + "\n")
-        output_f.write(output_target + "\n")
+            input_source, _ = table_processor.process_example(table_content, question, [])
+        output_target = table_processor.process_output(answer).lower()
+        return input_source.lower(), output_target
 
-    input_f.close()
-    output_f.close()
+    return _process_example
+
+
+def build_wtq_fairseq_dataset(out_prefix, src_file, data_dir, num_workers=NUM_WORKERS):
+    # parse the referenced tables before forking workers, so that every table is parsed only once
+    with open(src_file, "r", encoding="utf8") as src_f:
+        TABLE_STORE.load(_split_example(example)[1] for example in islice(src_f, 1, None))
+    with open(src_file, "r", encoding="utf8") as src_f:
+        # skip the header line, and stream the remaining examples
+        examples = islice(src_f, 1, None)
+        build_fairseq_dataset(examples, partial(_build_wtq_example_processor, out_prefix), out_prefix, data_dir,
+                              num_workers=num_workers)
 
 
 def build_wtq_huggingface_dataset(fairseq_data_dir):
@@ -95,35 +124,57 @@ def build_wtq_huggingface_dataset(fairseq_data_dir):
 
 
 def preprocess_wtq_dataset(processed_data_dir):
-    fairseq_bpe_translation(processed_data_dir, resource_name=MODEL_NAME)
+    fairseq_bpe_translation(processed_data_dir, resource_name=MODEL_NAME, num_workers=NUM_WORKERS)
     fairseq_binary_translation(processed_data_dir, resource_name=MODEL_NAME)
 
 
 if __name__ == '__main__':
     logger.info("You are using the setting of {}".format(MODEL_NAME))
+    ensure_bpe_files(RESOURCE_DIR)
+    processed_wtq_data_dir = os.path.join(PROCESSED_DATASET_FOLDER, "wtq")
+    # stages whose inputs and settings are unchanged since the last run are skipped
+    manifest = BuildManifest(os.path.join(processed_wtq_data_dir, MANIFEST_FILE))
+    wtq_raw_data_dir = os.path.join(RAW_DATASET_FOLDER, "wtq")
 
     logger.info("*" * 80)
     logger.info("Prepare to download WikiTableQuestions from the official link...")
-    wtq_raw_data_dir = download_wikitablequestions()
+    manifest.run_stage("download", download_wikitablequestions, outputs=[wtq_raw_data_dir],
+                       check_output_contents=False)
     logger.info("Download finished! The original WikiTableQuestions dataset is saved in {}".format(wtq_raw_data_dir))
-    processed_wtq_data_dir = os.path.join(PROCESSED_DATASET_FOLDER, "wtq")
 
     logger.info("*" * 80)
     logger.info("Process the dataset and save the processed dataset in {}".format(processed_wtq_data_dir))
-    build_wtq_fairseq_dataset("train", os.path.join(wtq_raw_data_dir, "data", "random-split-1-train.tsv"),
-                              processed_wtq_data_dir)
-    build_wtq_fairseq_dataset("valid", os.path.join(wtq_raw_data_dir, "data", "random-split-1-dev.tsv"),
-                              processed_wtq_data_dir)
-    build_wtq_fairseq_dataset("test", os.path.join(wtq_raw_data_dir, "data", "pristine-unseen-tables.tsv"),
-                              processed_wtq_data_dir)
+    processor_config = describe_processor(get_default_processor(max_cell_length=MAX_CELL_LENGTH,
+                                                                max_input_length=MAX_INPUT_LENGTH,
+                                                                resource_dir=RESOURCE_DIR))
+    dataset_files = []
+    for split, split_file in [("train", "random-split-1-train.tsv"), ("valid", "random-split-1-dev.tsv"),
+                              ("test", "pristine-unseen-tables.tsv")]:
+        split_src_file = os.path.join(wtq_raw_data_dir, "data", split_file)
+        split_dataset_files = [os.path.join(processed_wtq_data_dir, "{}.{}".format(split, lang))
+                               for lang in ["src", "tgt"]]
+        # this script is an input as well, since it decides how examples are processed
+        manifest.run_stage("linearize.{}".format(split),
+                           partial(build_wtq_fairseq_dataset, split, split_src_file, processed_wtq_data_dir),
+                           inputs=[__file__, split_src_file, os.path.join(wtq_raw_data_dir, "csv")],
+                           outputs=split_dataset_files, config=processor_config)
+        dataset_files.extend(split_dataset_files)
 
     logger.info("*" * 80)
     logger.info("Begin to BPE and build the dataset binaries in {}/bin".format(processed_wtq_data_dir))
-    preprocess_wtq_dataset(processed_wtq_data_dir)
+    # the BPE and binarization depend on the model resources and the data utils besides the dataset files
+    binarize_inputs = dataset_files + [__file__, DATA_UTILS_DIR] + \
+        [os.path.join(MODEL_NAME, file_name) for file_name in BINARIZE_RESOURCE_FILES]
+    manifest.run_stage("binarize", partial(preprocess_wtq_dataset, processed_wtq_data_dir), inputs=binarize_inputs,
+                       outputs=[os.path.join(processed_wtq_data_dir, MODEL_NAME, "bin")],
+                       config={"model_name": MODEL_NAME})
 
     logger.info("*" * 80)
     logger.info("Begin to build the HuggingFace dataset version in {}".format(processed_wtq_data_dir))
-    build_wtq_huggingface_dataset(processed_wtq_data_dir)
+    manifest.run_stage("huggingface", partial(build_wtq_huggingface_dataset, processed_wtq_data_dir),
+                       inputs=dataset_files,
+                       outputs=[os.path.join(processed_wtq_data_dir, "{}.json".format(split))
+                                for split in ["train", "valid", "test"]])
 
     logger.info("*" * 80)
     logger.info("Now you can train models using {} as the <data_dir> argument. "
@@ -8,8 +8,12 @@ from fairseq_cli.generate import cli_main as fairseq_generate
 import logging
 import shlex
 import re
+import time
 from tapex.model_interface import TAPEXModelInterface
-from tapex.model_eval import evaluate_generate_file
+from tapex.model_eval import evaluate_generate_file, extract_structure_data, evaluate_predictions
+from tapex.serving.onnx_export import export_onnx
+from tapex.serving.http_server import PredictionServer
+from tapex.serving.decoding import DecodingConfig
 import os
 
 logger = logging.getLogger(__name__)
@@ -61,6 +65,69 @@ def set_predict_parser(parser_group):
                                 help="the model weight's name in the resource directory")
 
 
+def set_cpu_eval_parser(parser_group):
+    cpu_eval_parser = parser_group.add_parser("cpu-eval")
+    cpu_eval_parser.add_argument("--resource-dir", type=str, required=True, default="./tapex.base",
+                                 help="the resource dir which contains the model weights, vocab.bpe, "
+                                      "dict.src.txt, dict.tgt.txt and encoder.json.")
+    cpu_eval_parser.add_argument("--checkpoint-name", type=str, default="model.pt",
+                                 help="the model weight's name in the resource directory")
+    cpu_eval_parser.add_argument("--generate-file", type=str, required=True,
+                                 help="a held-out generate file produced by `eval` such as predict/generate-valid.txt, "
+                                      "whose sources and golden answers are used for evaluation.")
+    cpu_eval_parser.add_argument("--num-threads", type=int, default=None,
+                                 help="the number of intra-op threads, all cores are used by default.")
+    cpu_eval_parser.add_argument("--num-interop-threads", type=int, default=None,
+                                 help="the number of inter-op threads.")
+    cpu_eval_parser.add_argument("--max-tokens", type=int, default=4096,
+                                 help="the max padded tokens of a batch.")
+
+
+def set_export_parser(parser_group):
+    export_parser = parser_group.add_parser("export")
+    export_parser.add_argument("--resource-dir", type=str, required=True, default="./tapex.base",
+                               help="the resource dir which contains the model weights, vocab.bpe, "
+                                    "dict.src.txt, dict.tgt.txt and encoder.json.")
+    export_parser.add_argument("--checkpoint-name", type=str, default="model.pt",
+                               help="the model weight's name in the resource directory")
+    export_parser.add_argument("--output-dir", type=str, required=True,
+                               help="the directory to save the ONNX graphs, the dictionary and the BPE files.")
+    export_parser.add_argument("--generate-file", type=str, default=None,
+                               help="if provided, a generate file produced by `eval` whose sources are decoded by "
+                                    "both fairseq and ONNX Runtime to validate the exported model.")
+    export_parser.add_argument("--num-threads", type=int, default=None,
+                               help="the number of intra-op threads used in validation.")
+    export_parser.add_argument("--max-tokens", type=int, default=4096,
+                               help="the max padded tokens of a batch.")
+
+
+def set_serve_parser(parser_group):
+    serve_parser = parser_group.add_parser("serve")
+    serve_parser.add_argument("--resource-dir", type=str, required=True, default="./tapex.base",
+                              help="the resource dir which contains the model weights, vocab.bpe, "
+                                   "dict.src.txt, dict.tgt.txt and encoder.json.")
+    serve_parser.add_argument("--checkpoint-name", type=str, default="model.pt",
+                              help="the model weight's name in the resource directory")
+    serve_parser.add_argument("--backend", type=str, default="fairseq", choices=["fairseq", "onnx"],
+                              help="`onnx` serves the model exported by `export` from the resource directory.")
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1",
+                              help="the host to listen on.")
+    serve_parser.add_argument("--port", type=int, default=8080,
+                              help="the port to listen on.")
+    serve_parser.add_argument("--beam", type=int, default=5,
+                              help="the beam size of decoding.")
+    serve_parser.add_argument("--max-wait-ms", type=float, default=10.0,
+                              help="the longest time a request waits for other requests to share its batch.")
+    serve_parser.add_argument("--max-tokens", type=int, default=4096,
+                              help="the max padded tokens of a batch.")
+    serve_parser.add_argument("--max-request-bytes", type=int, default=1024 * 1024,
+                              help="requests with a larger body are rejected.")
+    serve_parser.add_argument("--max-batch-examples", type=int, default=64,
+                              help="batch requests with more examples are rejected.")
+    serve_parser.add_argument("--num-threads", type=int, default=None,
+                              help="the number of intra-op threads, all cores are used by default.")
+
+
 def train_fairseq_model(args):
     cmd = f"""
         fairseq-train {args.dataset_dir}/bin \
@@ -162,12 +229,104 @@ def predict_demo(args):
     logger.info("The answer should be : {}".format(answer))
 
 
+def serve_model(args):
+    serve_interface = TAPEXModelInterface(resource_dir=args.resource_dir,
+                                          checkpoint_name=args.checkpoint_name,
+                                          num_threads=args.num_threads,
+                                          use_inference_mode=True,
+                                          backend=args.backend)
+    server = PredictionServer(serve_interface,
+                              host=args.host,
+                              port=args.port,
+                              max_request_bytes=args.max_request_bytes,
+                              max_batch_examples=args.max_batch_examples,
+                              max_wait_ms=args.max_wait_ms,
+                              max_batch_tokens=args.max_tokens,
+                              decoding=DecodingConfig(beam=args.beam))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Stop serving")
+    finally:
+        server.shutdown()
+
+
+def evaluate_cpu_model(args):
+    """
+    Compare the fp32 model with its int8 dynamically quantized version on CPU, in both accuracy and latency.
+    """
+    with open(args.generate_file, "r", encoding="utf8") as generate_f:
+        data = extract_structure_data(generate_f.read())
+    # the sources in a generate file are already truncated and linearized
+    model_inputs = [source_str.lower() for _, _, source_str, _ in data]
+    accuracies, latencies = {}, {}
+    for quantize in [False, True]:
+        model_name = "int8" if quantize else "fp32"
+        cpu_interface = TAPEXModelInterface(resource_dir=args.resource_dir,
+                                            checkpoint_name=args.checkpoint_name,
+                                            quantize=quantize,
+                                            num_threads=args.num_threads,
+                                            num_interop_threads=args.num_interop_threads,
+                                            use_inference_mode=True)
+        if not quantize:
+            # compare both models on CPU
+            cpu_interface.model.cpu()
+        start_time = time.perf_counter()
+        predictions = cpu_interface.translate_batch(model_inputs, max_tokens=args.max_tokens)
+        latencies[model_name] = (time.perf_counter() - start_time) / max(len(model_inputs), 1)
+        logger.info("Evaluate the {} model on {} examples".format(model_name, len(model_inputs)))
+        accuracies[model_name] = evaluate_predictions(data, predictions, target_delimiter=", ")
+    logger.info("Denotation Accuracy : fp32 {:.3f}, int8 {:.3f}, delta {:+.3f}".format(
+        accuracies["fp32"], accuracies["int8"], accuracies["int8"] - accuracies["fp32"]))
+    logger.info("Latency per example : fp32 {:.1f} ms, int8 {:.1f} ms, speedup {:.2f}x".format(
+        latencies["fp32"] * 1000, latencies["int8"] * 1000, latencies["fp32"] / max(latencies["int8"], 1e-9)))
+
+
+def export_onnx_model(args):
+    """
+    Export the model into ONNX graphs, and optionally check that ONNX Runtime predicts the same answers as fairseq.
+    """
+    export_onnx(args.resource_dir, args.checkpoint_name, args.output_dir)
+    logger.info("Export the model into {}".format(args.output_dir))
+    if args.generate_file is None:
+        return
+    with open(args.generate_file, "r", encoding="utf8") as generate_f:
+        data = extract_structure_data(generate_f.read())
+    # the sources in a generate file are already truncated and linearized
+    model_inputs = [source_str.lower() for _, _, source_str, _ in data]
+    predictions, latencies = {}, {}
+    for backend, resource_dir in [("fairseq", args.resource_dir), ("onnx", args.output_dir)]:
+        backend_interface = TAPEXModelInterface(resource_dir=resource_dir,
+                                                checkpoint_name=args.checkpoint_name,
+                                                num_threads=args.num_threads,
+                                                use_inference_mode=True,
+                                                backend=backend)
+        if backend == "fairseq":
+            # compare both backends on CPU
+            backend_interface.model.cpu()
+        start_time = time.perf_counter()
+        predictions[backend] = backend_interface.translate_batch(model_inputs, max_tokens=args.max_tokens)
+        latencies[backend] = (time.perf_counter() - start_time) / max(len(model_inputs), 1)
+    num_same = sum([fairseq_pred == onnx_pred
+                    for fairseq_pred, onnx_pred in zip(predictions["fairseq"], predictions["onnx"])])
+    logger.info("ONNX Runtime predicts the same answers as fairseq on {} / {} examples".format(num_same,
+                                                                                          len(model_inputs)))
+    logger.info("Denotation Accuracy : fairseq {:.3f}, onnx {:.3f}".format(
+        evaluate_predictions(data, predictions["fairseq"], target_delimiter=", "),
+        evaluate_predictions(data, predictions["onnx"], target_delimiter=", ")))
+    logger.info("Latency per example : fairseq {:.1f} ms, onnx {:.1f} ms".format(
+        latencies["fairseq"] * 1000, latencies["onnx"] * 1000))
+
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     subparsers = parser.add_subparsers(dest="subcommand")
     set_train_parser(subparsers)
     set_eval_parser(subparsers)
     set_predict_parser(subparsers)
+    set_cpu_eval_parser(subparsers)
+    set_export_parser(subparsers)
+    set_serve_parser(subparsers)
 
     args = parser.parse_args()
     if args.subcommand == "train":
@@ -176,3 +335,9 @@ if __name__ == '__main__':
         evaluate_fairseq_model(args)
     elif args.subcommand == "predict":
         predict_demo(args)
+    elif args.subcommand == "cpu-eval":
+        evaluate_cpu_model(args)
+    elif args.subcommand == "export":
+        export_onnx_model(args)
+    elif args.subcommand == "serve":
+        serve_model(args)
@@ -28,4 +28,8 @@ setuptools.setup(
         "records",
         "pandas"
     ],
+    extras_require={
+        # exporting the model into ONNX graphs and serving them with ONNX Runtime
+        "onnx": ["onnx", "onnxruntime"]
+    },
 )
@@ -0,0 +1,81 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict
+
+
+class LRUCache(object):
+    """
+    A thread-safe LRU cache bounded by the total size of its entries, which also counts its hits and misses.
+    """
+
+    def __init__(self, max_size: int, size_func: Callable = None):
+        """
+        :param max_size: the maximum total size of all entries, in the unit returned by `size_func`
+        :param size_func: a function mapping (key, value) to the size of an entry; by default every entry counts 1,
+        i.e., `max_size` is the maximum number of entries
+        """
+        self.max_size = max_size
+        self.size_func = size_func if size_func is not None else (lambda key, value: 1)
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        entry_size = self.size_func(key, value)
+        with self._lock:
+            if key in self._data:
+                self._size -= self._data.pop(key)[1]
+            # an entry larger than the whole cache is never stored
+            if entry_size > self.max_size:
+                return
+            self._data[key] = (value, entry_size)
+            self._size += entry_size
+            while self._size > self.max_size:
+                _, (_, evict_size) = self._data.popitem(last=False)
+                self._size -= evict_size
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, entry_size = self._data.pop(key)
+            self._size -= entry_size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._size = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "entries": len(self._data),
+                "size": self._size,
+                "max_size": self.max_size
+            }
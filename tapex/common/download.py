@@ -74,3 +74,14 @@ def download_bpe_files(resource_dir):
     logger.info("Downloading `vocab.bpe` and `encoder.json` to `{}` ...".format(abs_resource_dir))
     download_file(DEFAULT_VOCAB_BPE, resource_dir)
     download_file(DEFAULT_ENCODER_JSON, resource_dir)
+
+
+def ensure_bpe_files(resource_dir):
+    """
+    Download `vocab.bpe` and `encoder.json` into `resource_dir` unless they exist, so that the tokenizer of the table
+    processor can be loaded from them without the HuggingFace hub
+    """
+    if not os.path.exists(os.path.join(resource_dir, "vocab.bpe")) or \
+            not os.path.exists(os.path.join(resource_dir, "encoder.json")):
+        download_bpe_files(resource_dir)
+    return os.path.abspath(resource_dir)
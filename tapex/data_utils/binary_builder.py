@@ -0,0 +1,123 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+A streaming builder of fairseq binary datasets, which truncates, linearizes, BPE-encodes and binarizes examples in one
+pass, without writing the intermediate text files
+"""
+import contextlib
+import logging
+import os
+import time
+from functools import partial
+from typing import Callable, Dict, Iterable, List
+
+import torch
+from fairseq.data import Dictionary, indexed_dataset
+from fairseq.data.encoders.gpt2_bpe import get_encoder
+from tqdm import tqdm
+
+from tapex.data_utils.dataset_builder import process_in_order
+
+logger = logging.getLogger(__name__)
+
+
+def _build_binarizing_processor(processor_factory: Callable, bpe, dictionaries: List[Dictionary], keep_text: bool):
+    process_func = processor_factory()
+
+    def _process_example(example):
+        result = process_func(example)
+        if result is None:
+            return None
+        lines = [line.strip() for line in result]
+        # the same as the BPE step, which skips an example if any of its sides is empty
+        if any(len(line) == 0 for line in lines):
+            return None
+        bpe_lines = [" ".join(map(str, bpe.encode(line))) for line in lines]
+        # the same as `fairseq-preprocess`, which appends eos and maps unknown tokens to unk
+        token_ids = [dictionary.encode_line(bpe_line, add_if_not_exist=False).numpy()
+                     for bpe_line, dictionary in zip(bpe_lines, dictionaries)]
+        return token_ids, (lines, bpe_lines) if keep_text else None
+
+    return _process_example
+
+
+def build_fairseq_binary_dataset(examples: Iterable, processor_factory: Callable, out_prefix: str, resource_dir: str,
+                                 dest_dir: str, text_dir: str = None, source_lang: str = "src",
+                                 target_lang: str = "tgt", num_workers: int = None, chunk_size: int = 64,
+                                 seed: int = 42) -> Dict:
+    """
+    Build the `{out_prefix}.{source_lang}-{target_lang}.{lang}.bin/.idx` files of a fairseq translation dataset in
+    `dest_dir` directly from examples, which are the same as the outputs of `build_fairseq_dataset`, `BPEEncoder` and
+    `fairseq_binary_translation` in turn, with the mmap dataset implementation.
+    The examples are processed by a pool of processes as in `build_fairseq_dataset`, where each worker also encodes
+    BPE with `encoder.json` and `vocab.bpe` and looks up `dict.src.txt` and `dict.tgt.txt` in `resource_dir`, which
+    are loaded once in this process.
+    :param processor_factory: the same as `build_fairseq_dataset`, whose example processor returns a (source, target)
+    pair, or None to skip an example
+    :param text_dir: if set, the text files `{out_prefix}.{lang}` and `{out_prefix}.bpe.{lang}` are also written into
+    it for debugging or building the HuggingFace dataset
+    :return: the statistics, including the number of examples, tokens and unknown tokens of each language
+    """
+    languages = [source_lang, target_lang]
+    dictionaries = [Dictionary.load(os.path.join(resource_dir, "dict.{}.txt".format(lang))) for lang in ["src", "tgt"]]
+    bpe = get_encoder(os.path.join(resource_dir, "encoder.json"), os.path.join(resource_dir, "vocab.bpe"))
+    for path in [dest_dir, text_dir]:
+        if path is not None and not os.path.exists(path):
+            os.makedirs(path)
+    for lang, dictionary in zip(languages, dictionaries):
+        dictionary.save(os.path.join(dest_dir, "dict.{}.txt".format(lang)))
+
+    start_time = time.perf_counter()
+    num_examples, num_skipped = 0, 0
+    num_tokens, num_unk_tokens = [0, 0], [0, 0]
+    with contextlib.ExitStack() as stack:
+        dataset_prefixes = [os.path.join(dest_dir, "{}.{}-{}.{}".format(out_prefix, source_lang, target_lang, lang))
+                            for lang in languages]
+        builders = [indexed_dataset.make_builder(indexed_dataset.data_file_path(prefix), "mmap",
+                                                 vocab_size=len(dictionary))
+                    for prefix, dictionary in zip(dataset_prefixes, dictionaries)]
+        text_files = []
+        if text_dir is not None:
+            text_files = [stack.enter_context(open(os.path.join(text_dir, file_name), "w", encoding="utf8"))
+                          for file_name in ["{}.{}".format(out_prefix, lang) for lang in languages] +
+                          ["{}.bpe.{}".format(out_prefix, lang) for lang in languages]]
+        progress_bar = stack.enter_context(tqdm(desc=out_prefix, unit="examples"))
+        binarizing_factory = partial(_build_binarizing_processor, processor_factory, bpe, dictionaries,
+                                     text_dir is not None)
+        for results in process_in_order(examples, binarizing_factory, num_workers=num_workers, chunk_size=chunk_size,
+                                        seed=seed):
+            for result in results:
+                if result is None:
+                    num_skipped += 1
+                    continue
+                token_ids, text_lines = result
+                for lang_idx, (builder, ids) in enumerate(zip(builders, token_ids)):
+                    builder.add_item(torch.from_numpy(ids))
+                    num_tokens[lang_idx] += len(ids)
+                    num_unk_tokens[lang_idx] += int((ids == dictionaries[lang_idx].unk_index).sum())
+                if text_lines is not None:
+                    lines, bpe_lines = text_lines
+                    for text_f, line in zip(text_files, lines + bpe_lines):
+                        text_f.write(line + "\n")
+                num_examples += 1
+            progress_bar.update(len(results))
+        for prefix, builder in zip(dataset_prefixes, builders):
+            builder.finalize(indexed_dataset.index_file_path(prefix))
+
+    elapsed_time = time.perf_counter() - start_time
+    stats = {
+        "num_examples": num_examples,
+        "num_skipped": num_skipped,
+        "seconds": elapsed_time,
+        "examples_per_sec": (num_examples + num_skipped) / elapsed_time if elapsed_time > 0 else 0.0
+    }
+    for lang_idx, lang in enumerate(languages):
+        stats["num_tokens_{}".format(lang)] = num_tokens[lang_idx]
+        stats["num_unk_tokens_{}".format(lang)] = num_unk_tokens[lang_idx]
+        logger.info("[{}] {}: {} sents, {} tokens, {:.3}% replaced by {}".format(
+            lang, dataset_prefixes[lang_idx], num_examples, num_tokens[lang_idx],
+            100.0 * num_unk_tokens[lang_idx] / max(num_tokens[lang_idx], 1), dictionaries[lang_idx].unk_word))
+    logger.info("Binarize {} examples in {:.1f}s ({:.0f} examples/sec), skipped {} examples".format(
+        num_examples, elapsed_time, stats["examples_per_sec"], num_skipped))
+    return stats
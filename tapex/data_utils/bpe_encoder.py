@@ -0,0 +1,133 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+A GPT-2 BPE encoder for dataset files, which keeps one pool of processes for all the files it encodes
+"""
+import contextlib
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fairseq.data.encoders.gpt2_bpe import get_encoder
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# the BPE encoder in a worker process, inherited from the parent by forking
+_WORKER_BPE = None
+
+
+def _init_worker(bpe):
+    global _WORKER_BPE
+    _WORKER_BPE = bpe
+
+
+def _encode_lines(bpe, lines: Tuple[str, ...], keep_empty: bool) -> Optional[List[str]]:
+    # the same as `MultiprocessingEncoder.encode_lines` of fairseq, the aligned lines are filtered together
+    enc_lines = []
+    for line in lines:
+        line = line.strip()
+        if len(line) == 0 and not keep_empty:
+            return None
+        enc_lines.append(" ".join(map(str, bpe.encode(line))))
+    return enc_lines
+
+
+def _encode_chunk(chunk: List[Tuple[str, ...]], keep_empty: bool) -> List[Optional[List[str]]]:
+    return [_encode_lines(_WORKER_BPE, lines, keep_empty) for lines in chunk]
+
+
+def _iter_chunks(lines: Iterator, chunk_size: int) -> Iterator[List]:
+    while True:
+        chunk = list(islice(lines, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class BPEEncoder(object):
+    """
+    Encode text files into GPT-2 BPE ids, with the same outputs as `multiprocessing_bpe_encoder` of fairseq.
+    Unlike calling that script once per file, `encoder.json` and `vocab.bpe` are loaded only once, and the pool of
+    processes is kept until `close`, so that all splits and languages of a dataset are encoded by the same workers.
+    Files are streamed in chunks with a bounded number of chunks in flight, thus the memory does not grow with the
+    size of the files.
+    """
+
+    def __init__(self, encoder_json: str, vocab_bpe: str, num_workers: int = None, chunk_size: int = 1000,
+                 keep_empty: bool = False):
+        """
+        :param num_workers: the number of processes, all cores by default, where 1 means encoding in this process
+        :param chunk_size: the number of lines sent to a worker at once
+        :param keep_empty: if false, the aligned lines are skipped when any of them is empty, the same as fairseq
+        """
+        self.num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+        self.chunk_size = chunk_size
+        self.keep_empty = keep_empty
+        self.bpe = get_encoder(encoder_json, vocab_bpe)
+        # workers are forked with the loaded encoder, instead of loading it again in each worker
+        self._pool = multiprocessing.Pool(self.num_workers, initializer=_init_worker, initargs=(self.bpe,)) \
+            if self.num_workers > 1 else None
+
+    def _iter_encoded_chunks(self, lines: Iterator) -> Iterator[List[Optional[List[str]]]]:
+        if self._pool is None:
+            for chunk in _iter_chunks(lines, self.chunk_size):
+                yield [_encode_lines(self.bpe, aligned_lines, self.keep_empty) for aligned_lines in chunk]
+            return
+        pending_chunks = deque()
+        for chunk in _iter_chunks(lines, self.chunk_size):
+            pending_chunks.append(self._pool.apply_async(_encode_chunk, (chunk, self.keep_empty)))
+            # chunks are finished out of order, but always taken from the head of the window
+            if len(pending_chunks) >= 4 * self.num_workers:
+                yield pending_chunks.popleft().get()
+        while len(pending_chunks) > 0:
+            yield pending_chunks.popleft().get()
+
+    def encode_files(self, inputs: List[str], outputs: List[str]) -> Dict:
+        """
+        Encode the aligned lines of `inputs` (e.g., the `.src` and `.tgt` files of a split) into `outputs`.
+        :return: the statistics, including the number of lines and `lines_per_sec`
+        """
+        assert len(inputs) == len(outputs), "number of input and output paths should match"
+        start_time = time.perf_counter()
+        num_lines, num_filtered = 0, 0
+        with contextlib.ExitStack() as stack:
+            input_files = [stack.enter_context(open(path, "r", encoding="utf-8")) for path in inputs]
+            output_files = [stack.enter_context(open(path, "w", encoding="utf-8")) for path in outputs]
+            progress_bar = stack.enter_context(tqdm(desc=os.path.basename(inputs[0]), unit="lines"))
+            for results in self._iter_encoded_chunks(zip(*input_files)):
+                for enc_lines in results:
+                    if enc_lines is None:
+                        num_filtered += 1
+                        continue
+                    for enc_line, output_f in zip(enc_lines, output_files):
+                        output_f.write(enc_line + "\n")
+                num_lines += len(results)
+                progress_bar.update(len(results))
+        elapsed_time = time.perf_counter() - start_time
+        stats = {
+            "num_lines": num_lines,
+            "num_filtered": num_filtered,
+            "seconds": elapsed_time,
+            "lines_per_sec": num_lines / elapsed_time if elapsed_time > 0 else 0.0
+        }
+        logger.info("BPE {} lines of {} in {:.1f}s ({:.0f} lines/sec), filtered {} empty lines".format(
+            num_lines, " and ".join(inputs), elapsed_time, stats["lines_per_sec"], num_filtered))
+        return stats
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,166 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+A content-addressed manifest of the preprocessing stages, which skips the stages whose inputs are unchanged
+"""
+import hashlib
+import json
+import logging
+import os
+from typing import Callable, Dict, Iterable
+
+import tapex.processor
+from tapex.processor import LazyTokenizer
+from tapex.processor.lazy_tokenizer import DEFAULT_TOKENIZER_NAME
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "build_manifest.json"
+# the source of the BPE and binarization utils, whose changes invalidate the dataset binaries
+DATA_UTILS_DIR = os.path.dirname(os.path.abspath(__file__))
+# the files of a model resource directory read by the BPE and binarization stages
+BINARIZE_RESOURCE_FILES = ["dict.src.txt", "dict.tgt.txt", "encoder.json", "vocab.bpe"]
+
+
+def _source_digest(package_dir: str) -> str:
+    source_hash = hashlib.sha256()
+    for file_name in sorted(os.listdir(package_dir)):
+        if file_name.endswith(".py"):
+            with open(os.path.join(package_dir, file_name), "rb") as source_f:
+                source_hash.update(file_name.encode("utf8"))
+                source_hash.update(source_f.read())
+    return source_hash.hexdigest()
+
+
+def describe_processor(table_processor) -> Dict:
+    """
+    Describe the settings of a `TableProcessor` which affect its outputs, without loading its tokenizer.
+    The source code of `tapex.processor` is included as well, so that changing the truncation or linearization
+    invalidates the outputs.
+    """
+    truncators = [truncate_func.config() for truncate_func in table_processor.table_truncate_funcs]
+    splitter = table_processor.table_split_func.config() if table_processor.table_split_func is not None else None
+    tokenizer = table_processor.table_truncate_funcs[0].tokenizer if table_processor.table_truncate_funcs else None
+    if isinstance(tokenizer, LazyTokenizer):
+        # identified by the directory of its BPE files, without loading it
+        tokenizer_name = tokenizer.resource_dir if tokenizer.resource_dir is not None else DEFAULT_TOKENIZER_NAME
+    else:
+        tokenizer_name = getattr(tokenizer, "name_or_path", type(tokenizer).__name__)
+    return {
+        "linearizer": type(table_processor.table_linearize_func).__name__,
+        "truncators": truncators,
+        "splitter": splitter,
+        "target_delimiter": table_processor.target_delimiter,
+        "tokenizer": tokenizer_name,
+        "source": _source_digest(os.path.dirname(os.path.abspath(tapex.processor.__file__)))
+    }
+
+
+class BuildManifest(object):
+    """
+    Record each stage of a preprocessing script by a key hashing its input files and its config (e.g., the settings
+    of the table processor and the tokenizer), together with the content hashes of its outputs.
+    A stage is skipped if its key is unchanged and its outputs are still the recorded ones, so that changing one split
+    or one setting only reruns the affected stages. Since the outputs of a stage are the inputs of the next stages by
+    content, a stage rerun with the same outputs does not invalidate the stages after it.
+    File hashes are cached by their size and modification time, so that large files are only read when they change.
+    """
+
+    def __init__(self, manifest_path: str):
+        self.manifest_path = manifest_path
+        self.files = {}
+        self.stages = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r", encoding="utf8") as manifest_f:
+                manifest = json.load(manifest_f)
+            self.files = manifest.get("files", {})
+            self.stages = manifest.get("stages", {})
+
+    def save(self):
+        manifest_dir = os.path.dirname(self.manifest_path)
+        if manifest_dir and not os.path.exists(manifest_dir):
+            os.makedirs(manifest_dir)
+        # write into a temporary file first, so that an interrupted run never leaves a broken manifest
+        temp_path = self.manifest_path + ".tmp"
+        with open(temp_path, "w", encoding="utf8") as manifest_f:
+            json.dump({"files": self.files, "stages": self.stages}, manifest_f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    def file_digest(self, path: str):
+        """
+        The sha256 of a file, or of the relative paths and digests of all files in a directory, None if it is missing.
+        """
+        if os.path.isdir(path):
+            dir_hash = hashlib.sha256()
+            for root, dir_names, file_names in os.walk(path):
+                # the caches of python and other hidden files do not belong to the contents
+                dir_names[:] = sorted(_ for _ in dir_names if not _.startswith(".") and _ != "__pycache__")
+                for file_name in sorted(file_names):
+                    if file_name.startswith("."):
+                        continue
+                    file_path = os.path.join(root, file_name)
+                    dir_hash.update(os.path.relpath(file_path, path).encode("utf8"))
+                    dir_hash.update(self.file_digest(file_path).encode("utf8"))
+            return dir_hash.hexdigest()
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        cache_key = os.path.abspath(path)
+        cached = self.files.get(cache_key)
+        if cached is not None and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+            return cached["sha256"]
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as read_f:
+            for block in iter(lambda: read_f.read(1 << 20), b""):
+                file_hash.update(block)
+        self.files[cache_key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash.hexdigest()}
+        return file_hash.hexdigest()
+
+    def stage_key(self, inputs: Iterable[str], config: Dict = None) -> str:
+        key = {
+            "inputs": [[path, self.file_digest(path)] for path in inputs],
+            "config": config if config is not None else {}
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf8")).hexdigest()
+
+    def is_up_to_date(self, name: str, key: str, outputs: Iterable[str], check_contents: bool = True) -> bool:
+        record = self.stages.get(name)
+        if record is None or record["key"] != key:
+            return False
+        recorded_outputs = record["outputs"]
+        for path in outputs:
+            if not check_contents:
+                if not os.path.exists(path):
+                    return False
+                continue
+            digest = self.file_digest(path)
+            if digest is None or path not in recorded_outputs or digest != recorded_outputs[path]:
+                return False
+        return True
+
+    def run_stage(self, name: str, stage_func: Callable, inputs: Iterable[str] = (), outputs: Iterable[str] = (),
+                  config: Dict = None, check_output_contents: bool = True):
+        """
+        Call `stage_func` without arguments unless the stage is up to date, and record it after it finishes.
+        :param inputs: the files or directories read by the stage, which may be missing until the stage creates them
+        :param outputs: the files or directories written by the stage
+        :param config: the JSON-serializable settings which affect the outputs
+        :param check_output_contents: if false, the outputs only need to exist, e.g., for downloaded datasets which
+        are too large to hash and are checked by the stages reading them
+        :return: the return value of `stage_func`, or None if the stage is skipped
+        """
+        inputs, outputs = list(inputs), list(outputs)
+        key = self.stage_key(inputs, config)
+        if self.is_up_to_date(name, key, outputs, check_contents=check_output_contents):
+            logger.info("Skip the stage `{}` since its inputs and outputs are unchanged".format(name))
+            return None
+        result = stage_func()
+        # some inputs (e.g., the BPE files) may be downloaded by the stage itself, thus hash them again
+        key = self.stage_key(inputs, config)
+        self.stages[name] = {
+            "key": key,
+            "outputs": {path: self.file_digest(path) if check_output_contents else None for path in outputs}
+        }
+        self.save()
+        return result
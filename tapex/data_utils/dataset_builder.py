@@ -0,0 +1,109 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+A streaming builder of fairseq translation datasets, which processes examples with a pool of processes
+"""
+import logging
+import multiprocessing
+import os
+import random
+from collections import deque
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# the function processing examples in a worker process, built by the factory passed to `build_fairseq_dataset`
+_WORKER_PROCESS_FUNC = None
+
+
+def _init_worker(processor_factory: Callable):
+    global _WORKER_PROCESS_FUNC
+    _WORKER_PROCESS_FUNC = processor_factory()
+
+
+def _process_examples(process_func: Callable, start_idx: int, chunk: List, seed: int) -> List:
+    results = []
+    for example_idx, example in enumerate(chunk, start=start_idx):
+        # truncators delete rows randomly, so seed each example by its index to make the result independent of
+        # which worker processes it and what that worker has processed before
+        random.seed(seed + example_idx)
+        results.append(process_func(example))
+    return results
+
+
+def _process_chunk(start_idx: int, chunk: List, seed: int) -> List[Optional[Tuple[str, str]]]:
+    return _process_examples(_WORKER_PROCESS_FUNC, start_idx, chunk, seed)
+
+
+def _iter_chunks(examples: Iterable, chunk_size: int) -> Iterator[Tuple[int, List]]:
+    examples = iter(examples)
+    start_idx = 0
+    while True:
+        chunk = list(islice(examples, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield start_idx, chunk
+        start_idx += len(chunk)
+
+
+def process_in_order(examples: Iterable, processor_factory: Callable, num_workers: int = None, chunk_size: int = 64,
+                     max_pending_chunks: int = None, seed: int = 42) -> Iterator[List]:
+    """
+    Process a stream of examples with a pool of processes, and yield the results chunk by chunk in the original order.
+    Only a bounded window of chunks is in flight, so examples are read lazily and the memory does not grow with the
+    size of the dataset. The results do not depend on `num_workers` or `chunk_size`, since the random generator is
+    seeded by `seed` plus the index of each example before it is processed.
+    :param processor_factory: a function without arguments which is called once in every worker, and returns the
+    function processing an example. It can hold per-worker state such as a table processor and a table cache, and it
+    is inherited by forking, thus it must be picklable on platforms which do not fork
+    :param num_workers: the number of processes, all cores by default, where 1 means processing in this process
+    :param max_pending_chunks: the maximum number of chunks in flight, 4 per worker by default
+    """
+    num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+    if num_workers <= 1:
+        process_func = processor_factory()
+        for start_idx, chunk in _iter_chunks(examples, chunk_size):
+            yield _process_examples(process_func, start_idx, chunk, seed)
+        return
+    max_pending_chunks = max_pending_chunks if max_pending_chunks is not None else 4 * num_workers
+    with multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(processor_factory,)) as pool:
+        pending_chunks = deque()
+        for start_idx, chunk in _iter_chunks(examples, chunk_size):
+            pending_chunks.append(pool.apply_async(_process_chunk, (start_idx, chunk, seed)))
+            # chunks are finished out of order, but always taken from the head of the window
+            if len(pending_chunks) >= max_pending_chunks:
+                yield pending_chunks.popleft().get()
+        while len(pending_chunks) > 0:
+            yield pending_chunks.popleft().get()
+
+
+def build_fairseq_dataset(examples: Iterable, processor_factory: Callable, out_prefix: str, data_dir: str,
+                          num_workers: int = None, chunk_size: int = 64, seed: int = 42) -> int:
+    """
+    Build the `{out_prefix}.src` and `{out_prefix}.tgt` files of a fairseq translation dataset in `data_dir`, where
+    the example processor returns a (source, target) pair, or None to skip an example. The lines are written in the
+    same order as `examples`, no matter how many workers are used.
+    :return: the number of written examples
+    """
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    num_written = 0
+    with open(os.path.join(data_dir, "{}.src".format(out_prefix)), "w", encoding="utf8") as input_f, \
+            open(os.path.join(data_dir, "{}.tgt".format(out_prefix)), "w", encoding="utf8") as output_f, \
+            tqdm(desc=out_prefix, unit="examples") as progress_bar:
+        for results in process_in_order(examples, processor_factory, num_workers=num_workers, chunk_size=chunk_size,
+                                        seed=seed):
+            for result in results:
+                if result is None:
+                    continue
+                input_source, output_target = result
+                input_f.write(input_source + "\n")
+                output_f.write(output_target + "\n")
+                num_written += 1
+            progress_bar.update(len(results))
+    logger.info("Write {} examples into {}/{}.src and {}.tgt".format(num_written, data_dir, out_prefix, out_prefix))
+    return num_written
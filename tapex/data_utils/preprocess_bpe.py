@@ -9,11 +9,9 @@ A wrapper to wrap the BPE preprocessing procedure for different tasks:
 import argparse
 import logging
 import os
-import sys
-
-from fairseq.examples.roberta.multiprocessing_bpe_encoder import main as bpe_main
 
 from tapex.common.download import download_model_weights, download_bpe_files
+from tapex.data_utils.bpe_encoder import BPEEncoder
 
 logger = logging.getLogger(__name__)
 
@@ -68,10 +66,17 @@ def setup_class_bpe_arguments(args, data_dir, resource_dir, prefix):
     }
 
 
-def fairseq_bpe_translation(data_dir, resource_name, resource_dir=None, with_test_set=True):
+def _build_bpe_encoder(args_command, num_workers):
+    logger.info("Load the BPE encoder from `{}` and `{}`".format(args_command["--encoder-json"],
+                                                                  args_command["--vocab-bpe"]))
+    return BPEEncoder(args_command["--encoder-json"], args_command["--vocab-bpe"], num_workers=num_workers)
+
+
+def fairseq_bpe_translation(data_dir, resource_name, resource_dir=None, with_test_set=True, num_workers=None):
     """
     BPE script which wrapped the original fairseq BPE for translation tasks.
-    The function is equivalent to calling the following script:
+    The function has the same outputs as calling the following script for each file, but all files are encoded by
+    one pool of processes, where the source and target files of a split are encoded together:
     ```
     python -m examples.roberta.multiprocessing_bpe_encoder \
                 --encoder-json "$resource_dir/encoder.json" \
@@ -88,6 +93,8 @@ def fairseq_bpe_translation(data_dir, resource_name, resource_dir=None, with_tes
     :param resource_name: corresponding resource files will be automatically downloaded by specifying this parameter.
     You must select one from the choices of `bart.base`, `bart.large`, `tapex.base` and `tapex.large`.
     :param with_test_set: if true, process the test set; otherwise not.
+    :param num_workers: the number of BPE processes shared by all files, all cores by default.
+    :return: the statistics of each split, including the number of lines and `lines_per_sec`.
     """
     if resource_dir is None:
         resource_dir = os.path.abspath(resource_name)
@@ -118,24 +125,22 @@ def fairseq_bpe_translation(data_dir, resource_name, resource_dir=None, with_tes
     # bpe on files of data_folder
     bpe_parser = get_bpe_parser()
     args = bpe_parser.parse_args()
-    for prefix in dataset_prefix:
-        for language in ["src", "tgt"]:
-            args_command = setup_translation_bpe_arguments(args, data_dir, resource_dir, prefix, language)
-            arguments = []
-            for key, value in args_command.items():
-                arguments.append(key)
-                arguments.append(value)
-            sys.argv = ["call"] + arguments
-            logging.info("BPE files by calling `python -m fairseq.examples.roberta.multiprocessing_bpe_encoder "
-                         "{}`".format(" ".join(arguments)))
-            bpe_main()
-            sys.argv = ["call"]
-
-
-def fairseq_bpe_classification(data_dir, resource_name, resource_dir=None, with_test_set=True):
+    split_stats = {}
+    with _build_bpe_encoder(setup_translation_bpe_arguments(args, data_dir, resource_dir, "train", "src"),
+                            num_workers) as bpe_encoder:
+        for prefix in dataset_prefix:
+            args_commands = [setup_translation_bpe_arguments(args, data_dir, resource_dir, prefix, language)
+                             for language in ["src", "tgt"]]
+            split_stats[prefix] = bpe_encoder.encode_files([_["--inputs"] for _ in args_commands],
+                                                           [_["--outputs"] for _ in args_commands])
+    return split_stats
+
+
+def fairseq_bpe_classification(data_dir, resource_name, resource_dir=None, with_test_set=True, num_workers=None):
     """
     BPE script which wrapped the original fairseq BPE for sentence prediction tasks (i.e., classification).
-    The function is equivalent to calling the following script:
+    The function has the same outputs as calling the following script for each file, but all files are encoded by
+    one pool of processes:
     ```
     python -m examples.roberta.multiprocessing_bpe_encoder \
                 --encoder-json "$resource_dir/encoder.json" \
@@ -152,6 +157,8 @@ def fairseq_bpe_classification(data_dir, resource_name, resource_dir=None, with_
     :param resource_name: corresponding resource files will be automatically downloaded by specifying this parameter.
     You must select one from the choices of `bart.base`, `bart.large`, `tapex.base` and `tapex.large`.
     :param with_test_set: if true, process the test set; otherwise not.
+    :param num_workers: the number of BPE processes shared by all files, all cores by default.
+    :return: the statistics of each split, including the number of lines and `lines_per_sec`.
     """
     if resource_dir is None:
         resource_dir = os.path.abspath(resource_name)
@@ -179,12 +186,10 @@ def fairseq_bpe_classification(data_dir, resource_name, resource_dir=None, with_
     # bpe on files of data_folder
     bpe_parser = get_bpe_parser()
     args = bpe_parser.parse_args()
-    for prefix in dataset_prefix:
-        args_command = setup_class_bpe_arguments(args, data_dir, resource_dir, prefix)
-        arguments = []
-        for key, value in args_command.items():
-            arguments.append(key)
-            arguments.append(value)
-        sys.argv = ["call"] + arguments
-        bpe_main()
-        sys.argv = ["call"]
+    split_stats = {}
+    with _build_bpe_encoder(setup_class_bpe_arguments(args, data_dir, resource_dir, "train"),
+                            num_workers) as bpe_encoder:
+        for prefix in dataset_prefix:
+            args_command = setup_class_bpe_arguments(args, data_dir, resource_dir, prefix)
+            split_stats[prefix] = bpe_encoder.encode_files([args_command["--inputs"]], [args_command["--outputs"]])
+    return split_stats
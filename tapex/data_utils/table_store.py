@@ -0,0 +1,66 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+A store of parsed tables, so that a table shared by many questions is only read and parsed once
+"""
+import logging
+import sys
+from typing import Callable, Dict, Iterable
+
+from tapex.common.cache import LRUCache
+from tapex.processor import ColumnarTable, TableView
+
+logger = logging.getLogger(__name__)
+
+
+class TableStore(object):
+    """
+    Parse each table once by `load_func` (e.g., reading a TSV or CSV file), and keep it as a compact `ColumnarTable`
+    whose strings are interned. Every `get` hands out a fresh `TableView`, so truncating the view for one question
+    never modifies the parsed table seen by the others.
+    Tables loaded before a process pool is forked are shared by all workers, so each table is parsed once in total.
+    """
+
+    def __init__(self, load_func: Callable[[str], Dict], max_tables: int = None):
+        """
+        :param load_func: a function mapping a table name to a table dict `{"header": [...], "rows": [[...]]}`
+        :param max_tables: the maximum number of parsed tables kept in memory, unbounded by default
+        """
+        self.load_func = load_func
+        self._tables = LRUCache(max_size=max_tables if max_tables is not None else sys.maxsize)
+
+    def get(self, table_name: str) -> TableView:
+        table = self._tables.get(table_name)
+        if table is None:
+            table = ColumnarTable.from_dict(self.load_func(table_name))
+            self._tables.put(table_name, table)
+        return TableView(table)
+
+    def load(self, table_names: Iterable[str], ignore_errors: bool = False):
+        """
+        Parse the tables which are not loaded yet, e.g., all tables referenced by a dataset before forking workers.
+        :param ignore_errors: if true, a table failing to parse is logged and skipped, and `get` will raise again
+        """
+        num_loaded = 0
+        for table_name in table_names:
+            if table_name in self._tables:
+                continue
+            try:
+                self._tables.put(table_name, ColumnarTable.from_dict(self.load_func(table_name)))
+            except Exception:
+                if not ignore_errors:
+                    raise
+                logger.error("Fail to load the table {}".format(table_name))
+                continue
+            num_loaded += 1
+        logger.info("Load {} tables, {} tables in the store".format(num_loaded, len(self._tables)))
+
+    def __contains__(self, table_name: str) -> bool:
+        return table_name in self._tables
+
+    def __len__(self):
+        return len(self._tables)
+
+    def stats(self) -> Dict:
+        return self._tables.stats()
@@ -78,3 +78,15 @@ def evaluate_generate_file(generate_file_path, target_delimiter):
         for example, correct in zip(data, correct_arr):
             eval_file.write(str(correct) + "\t" + "\t".join(example) + "\n")
         eval_file.close()
+
+
+def evaluate_predictions(data: List, predictions: List[str], target_delimiter: str) -> float:
+    """
+    Evaluate new predictions of the sources in `data` (i.e., the output of `extract_structure_data`),
+    and return the denotation accuracy. It is used to compare models on the same held-out generate file.
+    """
+    assert len(data) == len(predictions), "Each example should have exactly one prediction."
+    new_data = [(predict_str, ground_str, source_str, predict_id)
+                for predict_str, (_, ground_str, source_str, predict_id) in zip(predictions, data)]
+    correct_arr = evaluate(new_data, target_delimiter)
+    return sum(correct_arr) / len(correct_arr) if len(correct_arr) > 0 else 0.0
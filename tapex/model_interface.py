@@ -2,12 +2,16 @@
 # Licensed under the MIT license.
 
 import logging
-from typing import Dict, List
+import os
+from typing import Dict, List, Tuple
 
 import torch.cuda
-from fairseq.models.bart import BARTModel
 
 from tapex.processor import get_default_processor
+from tapex.serving.cpu_inference import quantize_linear_layers, set_cpu_threads
+from tapex.serving.decoding import DecodingConfig, estimate_max_len_b
+from tapex.serving.encode_cache import TableEncodeCache
+from tapex.serving.prediction_cache import PredictionCache, checkpoint_identity
 
 logger = logging.getLogger(__name__)
 
@@ -17,23 +21,230 @@ class TAPEXModelInterface:
     A simple model interface to tapex for online prediction
     """
 
-    def __init__(self, resource_dir, checkpoint_name, table_processor=None):
-        self.model = BARTModel.from_pretrained(model_name_or_path=resource_dir,
-                                               checkpoint_file=checkpoint_name)
-        if torch.cuda.is_available():
-            self.model.cuda()
-        self.model.eval()
+    def __init__(self, resource_dir, checkpoint_name, table_processor=None, encode_cache: TableEncodeCache = None,
+                 prediction_cache: PredictionCache = None, quantize: bool = False, num_threads: int = None,
+                 num_interop_threads: int = None, use_inference_mode: bool = False, backend: str = "fairseq"):
+        """
+        :param encode_cache: if provided, the token ids of tables are cached and reused by all questions on the
+        same (truncated) table, and only the questions are encoded again
+        :param prediction_cache: if provided, the answers of `predict` and `predict_batch` are memoized, so that an
+        identical (question, truncated table) pair is not decoded again with the same checkpoint and decoding parameters
+        :param quantize: if true, run the model on CPU with dynamic int8 quantization of its linear layers
+        :param num_threads: the number of intra-op threads of PyTorch, all cores are used by default
+        :param num_interop_threads: the number of inter-op threads of PyTorch
+        :param use_inference_mode: if true, decode under `torch.inference_mode`, which skips the version counting and
+        view tracking of tensors that `torch.no_grad` still does
+        :param backend: `fairseq` loads `checkpoint_name` from `resource_dir`, and `onnx` runs the graphs exported by
+        `export_onnx` into `resource_dir` with ONNX Runtime on CPU (where `checkpoint_name` is ignored)
+        """
+        assert backend in ["fairseq", "onnx"], "Unsupported backend `{}`.".format(backend)
+        self.backend = backend
+        if backend == "onnx":
+            assert not quantize, "The int8 quantization is only supported by the fairseq backend."
+            # neither fairseq nor the checkpoint are loaded, which saves most of the start-up time
+            from tapex.serving.onnx_model import ONNXBARTModel
+            from tapex.serving.onnx_export import DECODER_FILE
+            self.model = ONNXBARTModel(resource_dir, num_threads=num_threads)
+            checkpoint_name = DECODER_FILE
+        else:
+            from fairseq.models.bart import BARTModel
+            set_cpu_threads(num_threads=num_threads, num_interop_threads=num_interop_threads)
+            self.model = BARTModel.from_pretrained(model_name_or_path=resource_dir,
+                                                   checkpoint_file=checkpoint_name)
+            self.model.eval()
+            if quantize:
+                # the quantized linear layers only run on CPU
+                quantize_linear_layers(self.model)
+            elif torch.cuda.is_available():
+                self.model.cuda()
+        self.use_inference_mode = use_inference_mode
         if table_processor is not None:
             self.tab_processor = table_processor
         else:
-            self.tab_processor = get_default_processor(max_cell_length=15, max_input_length=1024)
-
-    def predict(self, question: str, table_context: Dict) -> List[str]:
-        # process input
-        model_input = self.tab_processor.process_input(table_context, question, []).lower()
-        model_output = self.model.translate(
-            sentences=[model_input],
-            beam=5
-        )
+            # never modify the caller's tables, which are often shared across requests
+            self.tab_processor = get_default_processor(max_cell_length=15, max_input_length=1024,
+                                                       resource_dir=resource_dir, copy_on_write=True)
+        self.encode_cache = encode_cache
+        self.prediction_cache = prediction_cache
+        # a replaced checkpoint gets a new identity, so that predictions of the old checkpoint are never reused
+        self.checkpoint_identity = checkpoint_identity(os.path.join(resource_dir, checkpoint_name))
+        if quantize:
+            self.checkpoint_identity += ":int8"
+        elif backend == "onnx":
+            self.checkpoint_identity += ":onnx"
+
+    def predict(self, question: str, table_context: Dict, decoding: DecodingConfig = None) -> List[str]:
         # the result should be a list of answers, and we only care about the answer itself instead of score
-        return model_output
+        return self.predict_batch(questions=[question], table_contexts=[table_context], decoding=decoding)
+
+    def predict_batch(self, questions: List[str], table_contexts: List[Dict],
+                      max_tokens: int = 4096, beam: int = 5, decoding: DecodingConfig = None) -> List[str]:
+        """
+        Predict answers for many (question, table) pairs at once.
+        Inputs are grouped into length-bucketed batches whose padded size is bounded by `max_tokens`,
+        which plays the same role as `--max-tokens` in fairseq, and each bucket is decoded in one call.
+        :param decoding: the decoding settings, which default to a beam search of size `beam`
+        :return: one answer string for each pair, in the same order as the inputs
+        """
+        assert len(questions) == len(table_contexts), "Each question should be paired with exactly one table."
+        decoding = decoding if decoding is not None else DecodingConfig(beam=beam)
+        # process all inputs together so that the processor can tokenize the tables in batches
+        linear_tables = self.tab_processor.process_tables(table_contexts, questions, [[] for _ in questions])
+        if self.prediction_cache is None:
+            tokenized_inputs = self.encode_linearized(questions, linear_tables)
+            return self.generate_batch(tokenized_inputs, max_tokens=max_tokens, decoding=decoding)
+
+        cache_keys = [self.prediction_cache.build_key(question, linear_table, self.checkpoint_identity,
+                                                      **decoding.generate_kwargs())
+                      for question, linear_table in zip(questions, linear_tables)]
+        model_outputs = [self.prediction_cache.get(cache_key) for cache_key in cache_keys]
+        # identical inputs within the batch are decoded only once
+        miss_indices = {}
+        for idx, model_output in enumerate(model_outputs):
+            if model_output is None:
+                miss_indices.setdefault(cache_keys[idx], idx)
+        if len(miss_indices) > 0:
+            miss_indices = list(miss_indices.values())
+            tokenized_inputs = self.encode_linearized([questions[idx] for idx in miss_indices],
+                                                      [linear_tables[idx] for idx in miss_indices])
+            miss_outputs = self.generate_batch(tokenized_inputs, max_tokens=max_tokens, decoding=decoding)
+            decoded_outputs = {}
+            for idx, model_output in zip(miss_indices, miss_outputs):
+                decoded_outputs[cache_keys[idx]] = model_output
+                self.prediction_cache.put(cache_keys[idx], model_output, model_identity=self.checkpoint_identity)
+            model_outputs = [decoded_outputs[cache_key] if model_output is None else model_output
+                             for cache_key, model_output in zip(cache_keys, model_outputs)]
+        return model_outputs
+
+    def predict_batch_nbest(self, questions: List[str], table_contexts: List[Dict], max_tokens: int = 4096,
+                            decoding: DecodingConfig = None) -> List[List[Tuple[str, float]]]:
+        """
+        The same as `predict_batch`, but return the `decoding.nbest` best answers of each pair with their scores,
+        i.e., the length-normalized log-likelihoods, from the best to the worst.
+        """
+        assert len(questions) == len(table_contexts), "Each question should be paired with exactly one table."
+        decoding = decoding if decoding is not None else DecodingConfig()
+        tokenized_inputs = self.encode_examples(questions, table_contexts)
+        batched_hypos = self.generate_hypos_batch(tokenized_inputs, max_tokens=max_tokens, decoding=decoding)
+        return [[(self.model.decode(hypo["tokens"]), float(hypo["score"])) for hypo in hypos[:decoding.nbest]]
+                for hypos in batched_hypos]
+
+    def estimate_max_len_b(self, answers: List[str], coverage: float = 0.99, margin: int = 2) -> int:
+        """
+        Derive the `max_len_b` of `DecodingConfig` from answers, e.g., the `train.tgt` of a dataset.
+        """
+        return estimate_max_len_b([self.model.encode(answer.lower()).numel() for answer in answers],
+                                  coverage=coverage, margin=margin)
+
+    def encode_examples(self, questions: List[str], table_contexts: List[Dict]) -> List[torch.LongTensor]:
+        """
+        Truncate, linearize and encode (question, table) pairs into the token ids of model inputs.
+        """
+        linear_tables = self.tab_processor.process_tables(table_contexts, questions, [[] for _ in questions])
+        return self.encode_linearized(questions, linear_tables)
+
+    def encode_linearized(self, questions: List[str], linear_tables: List[str]) -> List[torch.LongTensor]:
+        """
+        Encode questions with their truncated and linearized tables into the token ids of model inputs.
+        """
+        if self.encode_cache is None:
+            return [self.model.encode((question + " " + linear_table).lower())
+                    for question, linear_table in zip(questions, linear_tables)]
+        return [self.encode_cache.encode(self.model, question.lower(), linear_table.lower())
+                for question, linear_table in zip(questions, linear_tables)]
+
+    def preprocess(self, question: str, table_context: Dict) -> str:
+        """
+        Truncate and linearize a table with its question into the model input string.
+        """
+        return self.tab_processor.process_input(table_context, question, []).lower()
+
+    def translate_batch(self, model_inputs: List[str], max_tokens: int = 4096, beam: int = 5,
+                        decoding: DecodingConfig = None) -> List[str]:
+        """
+        Decode already processed model inputs with length-bucketed batching.
+        """
+        tokenized_inputs = [self.model.encode(model_input) for model_input in model_inputs]
+        return self.generate_batch(tokenized_inputs, max_tokens=max_tokens, beam=beam, decoding=decoding)
+
+    def predict_chunked(self, question: str, table_context: Dict,
+                        max_tokens: int = 4096, beam: int = 5, decoding: DecodingConfig = None) -> List[str]:
+        """
+        The same as `predict`, but a table too large to fit into the model is split into chunks instead of
+        having its rows deleted, see `predict_batch_chunked`.
+        """
+        return self.predict_batch_chunked(questions=[question], table_contexts=[table_context],
+                                          max_tokens=max_tokens, beam=beam, decoding=decoding)
+
+    def predict_batch_chunked(self, questions: List[str], table_contexts: List[Dict],
+                              max_tokens: int = 4096, beam: int = 5, decoding: DecodingConfig = None) -> List[str]:
+        """
+        Predict answers for many (question, table) pairs, where each table is split into chunks which fit into the
+        model. The chunks of all tables are decoded together as one batch, and the answer of each pair is the answer
+        of its chunk with the best beam score. The number of chunks is bounded by the `max_chunks` of the processor.
+        :return: one answer string for each pair, in the same order as the inputs
+        """
+        assert len(questions) == len(table_contexts), "Each question should be paired with exactly one table."
+        chunked_inputs = self.tab_processor.process_chunked_inputs(table_contexts, questions)
+        tokenized_inputs = [self.model.encode(model_input.lower())
+                            for model_inputs in chunked_inputs for model_input in model_inputs]
+        batched_hypos = self.generate_hypos_batch(tokenized_inputs, max_tokens=max_tokens, beam=beam,
+                                                  decoding=decoding)
+        model_outputs = []
+        chunk_offset = 0
+        for model_inputs in chunked_inputs:
+            chunk_hypos = batched_hypos[chunk_offset: chunk_offset + len(model_inputs)]
+            chunk_offset += len(model_inputs)
+            # scores are normalized by the length of hypotheses, so they are comparable across chunks
+            best_hypo = max((hypos[0] for hypos in chunk_hypos), key=lambda hypo: float(hypo["score"]))
+            model_outputs.append(self.model.decode(best_hypo["tokens"]))
+        return model_outputs
+
+    def generate_batch(self, tokenized_inputs: List, max_tokens: int = 4096, beam: int = 5,
+                       decoding: DecodingConfig = None) -> List[str]:
+        """
+        Decode already tokenized model inputs (i.e., the output of `self.model.encode`) with length-bucketed batching.
+        """
+        batched_hypos = self.generate_hypos_batch(tokenized_inputs, max_tokens=max_tokens, beam=beam,
+                                                  decoding=decoding)
+        return [self.model.decode(hypos[0]["tokens"]) for hypos in batched_hypos]
+
+    def generate_hypos_batch(self, tokenized_inputs: List, max_tokens: int = 4096, beam: int = 5,
+                             decoding: DecodingConfig = None) -> List[List[Dict]]:
+        """
+        The same as `generate_batch`, but return all hypotheses of each input, in which each hypothesis has its
+        `tokens` and `score`, from the best to the worst.
+        """
+        generate_kwargs = (decoding if decoding is not None else DecodingConfig(beam=beam)).generate_kwargs()
+        if generate_kwargs["beam"] == 1 and self.backend == "fairseq":
+            # fairseq only sets the beam size of the decoder attentions for a beam search, and never resets it
+            self.model.model.set_beam_size(1)
+        batched_hypos = [None] * len(tokenized_inputs)
+        with torch.inference_mode(mode=self.use_inference_mode):
+            for bucket in self._build_buckets(tokenized_inputs, max_tokens):
+                bucket_hypos = self.model.generate([tokenized_inputs[idx] for idx in bucket], **generate_kwargs)
+                for idx, hypos in zip(bucket, bucket_hypos):
+                    batched_hypos[idx] = hypos
+        return batched_hypos
+
+    @staticmethod
+    def _build_buckets(tokenized_inputs: List, max_tokens: int) -> List[List[int]]:
+        """
+        Group input indices by length so that the padded size of each bucket does not exceed `max_tokens`.
+        An input longer than `max_tokens` is still decoded, alone in its own bucket.
+        """
+        # sort by length so that inputs of a similar length share a bucket and little padding is wasted
+        sorted_indices = sorted(range(len(tokenized_inputs)), key=lambda idx: tokenized_inputs[idx].numel())
+        buckets = []
+        bucket, bucket_max_len = [], 0
+        for idx in sorted_indices:
+            input_len = tokenized_inputs[idx].numel()
+            # the bucket is padded to its longest input, so check the padded size if this input joins
+            if len(bucket) > 0 and max(bucket_max_len, input_len) * (len(bucket) + 1) > max_tokens:
+                buckets.append(bucket)
+                bucket, bucket_max_len = [], 0
+            bucket.append(idx)
+            bucket_max_len = max(bucket_max_len, input_len)
+        if len(bucket) > 0:
+            buckets.append(bucket)
+        return buckets
@@ -1,21 +1,49 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+from .columnar_table import ColumnarTable
 from .table_linearize import IndexedRowTableLinearize
-from .table_truncate import CellLimitTruncate, RowDeleteTruncate
+from .table_truncate import CellLimitTruncate, RowDeleteTruncate, RelevanceRowTruncate, ColumnPruneTruncate
 from .table_processor import TableProcessor
-from transformers import AutoTokenizer
+from .table_split import RowChunkSplit
+from .table_view import TableView
+from .token_cache import TokenCache
+from .lazy_tokenizer import LazyTokenizer, get_shared_tokenizer
 
 
-def get_default_processor(max_cell_length, max_input_length):
+def get_default_processor(max_cell_length, max_input_length, token_cache=None, resource_dir=None,
+                          copy_on_write=False, prune_columns=False, max_chunks=8):
     table_linearize_func = IndexedRowTableLinearize()
+    # the fast (Rust) tokenizer is loaded from the local BPE files in `resource_dir` on its first use,
+    # and it encodes a batch of cells or rows with offsets in one call
+    tokenizer = get_shared_tokenizer(resource_dir)
+    # all truncators share one tokenizer, and thus can share the token cache as well
+    if token_cache is None:
+        token_cache = TokenCache()
     table_truncate_funcs = [
         CellLimitTruncate(max_cell_length=max_cell_length,
-                          tokenizer=AutoTokenizer.from_pretrained(pretrained_model_name_or_path="facebook/bart-large"),
-                          max_input_length=max_input_length),
+                          tokenizer=tokenizer,
+                          max_input_length=max_input_length,
+                          token_cache=token_cache),
         RowDeleteTruncate(table_linearize=table_linearize_func,
-                          max_input_length=max_input_length)
+                          tokenizer=tokenizer,
+                          max_input_length=max_input_length,
+                          token_cache=token_cache)
     ]
+    if prune_columns:
+        # drop irrelevant columns of wide tables before deleting rows
+        table_truncate_funcs.insert(1, ColumnPruneTruncate(table_linearize=table_linearize_func,
+                                                           tokenizer=tokenizer,
+                                                           max_input_length=max_input_length,
+                                                           token_cache=token_cache))
+    # split large tables into chunks instead of deleting rows, only used by `process_chunked_inputs`
+    table_split_func = RowChunkSplit(table_linearize=table_linearize_func,
+                                     max_chunks=max_chunks,
+                                     tokenizer=tokenizer,
+                                     max_input_length=max_input_length,
+                                     token_cache=token_cache)
     processor = TableProcessor(table_linearize_func=table_linearize_func,
-                               table_truncate_funcs=table_truncate_funcs)
+                               table_truncate_funcs=table_truncate_funcs,
+                               copy_on_write=copy_on_write,
+                               table_split_func=table_split_func)
     return processor
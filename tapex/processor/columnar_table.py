@@ -0,0 +1,200 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+A compact, column-major table which can be used wherever a table dict `{"header": [...], "rows": [[...]]}` is expected
+"""
+import sys
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, List
+
+
+def _build_column(values: List):
+    """
+    Store a column of integers or floats in a typed array, and intern the strings of other columns.
+    """
+    # bool is a subclass of int, but it should still be linearized as `True` / `False`
+    if len(values) > 0 and all(type(value) is int for value in values):
+        try:
+            return array("q", values)
+        except OverflowError:
+            pass
+    elif len(values) > 0 and all(type(value) is float for value in values):
+        return array("d", values)
+    return [sys.intern(value) if type(value) is str else value for value in values]
+
+
+class ColumnarTable(Mapping):
+    """
+    A table stored column by column, where deleted rows are only dropped from the list of live row ids.
+    It behaves like a read-only table dict: `table["header"]` is the header, `table["rows"]` is a sequence of
+    row views which supports `del` and cell assignment, and `table["id"]` is the table id if any.
+    Rows may be shorter or longer than the header as in a table dict: the cells beyond the header make up extra
+    columns, and the missing cells of short rows are padded in the columns but never show up in the rows.
+    """
+
+    def __init__(self, header: List, columns: List, table_id=None, row_lens: array = None):
+        """
+        :param row_lens: the number of cells of each row by physical id, None if every row has all columns
+        """
+        self.header = list(header)
+        self.columns = columns
+        self.table_id = table_id
+        num_rows = len(columns[0]) if len(columns) > 0 else 0
+        # physical ids of the live rows in order
+        self.row_ids = array("l", range(num_rows))
+        self.row_lens = row_lens
+        # the indices of the kept columns in the original table, which tell the cells within each row length
+        self.col_ids = list(range(len(columns)))
+
+    @classmethod
+    def from_dict(cls, table_content: Dict) -> "ColumnarTable":
+        header = table_content["header"]
+        rows = table_content["rows"]
+        row_lens = [len(row) for row in rows]
+        num_columns = max([len(header)] + row_lens)
+        columns = [_build_column([row[col_idx] if col_idx < len(row) else None for row in rows])
+                   for col_idx in range(num_columns)]
+        if all(row_len == num_columns for row_len in row_lens):
+            row_lens = None
+        else:
+            row_lens = array("l", row_lens)
+        return cls(header, columns, table_id=table_content.get("id"), row_lens=row_lens)
+
+    def to_dict(self) -> Dict:
+        table_content = {
+            "header": list(self.header),
+            "rows": [list(row) for row in self.rows]
+        }
+        if self.table_id is not None:
+            table_content["id"] = self.table_id
+        return table_content
+
+    @property
+    def rows(self) -> "ColumnarRows":
+        return ColumnarRows(self)
+
+    def __getitem__(self, key):
+        if key == "header":
+            return self.header
+        elif key == "rows":
+            return self.rows
+        elif key == "id" and self.table_id is not None:
+            return self.table_id
+        raise KeyError(key)
+
+    def __iter__(self):
+        keys = ["header", "rows"]
+        if self.table_id is not None:
+            keys.append("id")
+        return iter(keys)
+
+    def __len__(self):
+        return 3 if self.table_id is not None else 2
+
+    def get_cell(self, row_id: int, col_idx: int):
+        return self.columns[col_idx][row_id]
+
+    def set_cell(self, row_id: int, col_idx: int, value):
+        column = self.columns[col_idx]
+        if isinstance(column, array):
+            try:
+                column[row_id] = value
+                return
+            except (TypeError, OverflowError):
+                # the value does not fit in the typed array anymore, fall back to a list
+                column = self.columns[col_idx] = list(column)
+        column[row_id] = sys.intern(value) if type(value) is str else value
+
+    def delete_rows(self, row_indices: Iterable[int]):
+        """
+        Delete rows by their current positions (not physical ids) in one pass, which costs O(n) in total
+        rather than O(n) for every `del rows[i]` on a list.
+        """
+        drop_positions = set(row_indices)
+        if len(drop_positions) == 0:
+            return
+        self.row_ids = array("l", [row_id for position, row_id in enumerate(self.row_ids)
+                                   if position not in drop_positions])
+
+    def delete_columns(self, col_indices: Iterable[int]):
+        """
+        Delete columns by their positions.
+        """
+        drop_positions = set(col_indices)
+        self.header = [header for position, header in enumerate(self.header) if position not in drop_positions]
+        self.columns = [column for position, column in enumerate(self.columns) if position not in drop_positions]
+        self.col_ids = [col_id for position, col_id in enumerate(self.col_ids) if position not in drop_positions]
+
+
+class ColumnarRows(Sequence):
+    """
+    The live rows of a `ColumnarTable`, in which each row is a view on the columns.
+    """
+
+    def __init__(self, table: ColumnarTable):
+        self.table = table
+
+    def __len__(self):
+        return len(self.table.row_ids)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [ColumnarRow(self.table, row_id) for row_id in self.table.row_ids[position]]
+        return ColumnarRow(self.table, self.table.row_ids[position])
+
+    def __iter__(self):
+        for row_id in self.table.row_ids:
+            yield ColumnarRow(self.table, row_id)
+
+    def __delitem__(self, position):
+        # only the live row ids are removed, the columns are never touched
+        del self.table.row_ids[position]
+
+
+class ColumnarRow(Sequence):
+    """
+    A row view of a `ColumnarTable`, assigning a cell writes through to its column.
+    """
+
+    def __init__(self, table: ColumnarTable, row_id: int):
+        self.table = table
+        self.row_id = row_id
+
+    def __len__(self):
+        if self.table.row_lens is None:
+            return len(self.table.columns)
+        # a short row only has the kept columns within its length, which are a prefix of the sorted ids
+        return bisect_left(self.table.col_ids, self.table.row_lens[self.row_id])
+
+    def _check_index(self, col_idx: int) -> int:
+        if self.table.row_lens is None:
+            return col_idx
+        row_len = len(self)
+        if col_idx < 0:
+            col_idx += row_len
+        if not 0 <= col_idx < row_len:
+            raise IndexError("row index out of range")
+        return col_idx
+
+    def __getitem__(self, col_idx):
+        if isinstance(col_idx, slice):
+            return [column[self.row_id] for column in self.table.columns[:len(self)][col_idx]]
+        return self.table.columns[self._check_index(col_idx)][self.row_id]
+
+    def __setitem__(self, col_idx, value):
+        self.table.set_cell(self.row_id, self._check_index(col_idx), value)
+
+    def __iter__(self):
+        columns = self.table.columns if self.table.row_lens is None else islice(self.table.columns, len(self))
+        for column in columns:
+            yield column[self.row_id]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
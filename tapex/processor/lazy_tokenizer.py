@@ -0,0 +1,84 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for loading the BPE tokenizer lazily from local resource files and sharing it across truncators
+"""
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# the tokenizer used when there are no local BPE files
+DEFAULT_TOKENIZER_NAME = "facebook/bart-large"
+
+_SHARED_TOKENIZERS = {}
+_SHARED_TOKENIZERS_LOCK = threading.Lock()
+
+
+def load_tokenizer(resource_dir: str = None):
+    """
+    Load a fast BART tokenizer, preferring the `encoder.json` and `vocab.bpe` in `resource_dir`
+    (i.e., the files placed by `download_bpe_files`) so that no network or hub cache lookup is needed.
+    BART shares the BPE of GPT-2, therefore the tokens are the same as `facebook/bart-large`.
+    """
+    # transformers takes seconds to import, so it is only imported when a tokenizer is really used
+    from transformers import AutoTokenizer, BartTokenizerFast
+
+    if resource_dir is not None:
+        encoder_json = os.path.join(resource_dir, "encoder.json")
+        vocab_bpe = os.path.join(resource_dir, "vocab.bpe")
+        if os.path.exists(encoder_json) and os.path.exists(vocab_bpe):
+            logger.info("Loading the tokenizer from `{}` and `{}`".format(encoder_json, vocab_bpe))
+            # the keyword names of the two files differ across transformers versions, but their order does not
+            return BartTokenizerFast(encoder_json, vocab_bpe)
+        logger.warning("Cannot find `encoder.json` and `vocab.bpe` in `{}`, "
+                       "fall back to `{}`".format(resource_dir, DEFAULT_TOKENIZER_NAME))
+    return AutoTokenizer.from_pretrained(pretrained_model_name_or_path=DEFAULT_TOKENIZER_NAME, use_fast=True)
+
+
+class LazyTokenizer(object):
+    """
+    A proxy of the tokenizer which is only loaded on its first use, it can be used wherever a tokenizer is expected.
+    """
+
+    def __init__(self, resource_dir: str = None):
+        self.resource_dir = resource_dir
+        self._tokenizer = None
+        self._lock = threading.Lock()
+
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    self._tokenizer = load_tokenizer(self.resource_dir)
+        return self._tokenizer
+
+    def __call__(self, *args, **kwargs):
+        return self.tokenizer(*args, **kwargs)
+
+    def __getattr__(self, name):
+        # never load the tokenizer for private or special attributes, e.g., when being copied or pickled
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def __getstate__(self):
+        # the tokenizer is loaded again after unpickling, e.g., in another worker process
+        return {"resource_dir": self.resource_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["resource_dir"])
+
+
+def get_shared_tokenizer(resource_dir: str = None) -> LazyTokenizer:
+    """
+    Return the lazy tokenizer shared by all callers using the same `resource_dir`.
+    """
+    cache_key = os.path.abspath(resource_dir) if resource_dir is not None else None
+    with _SHARED_TOKENIZERS_LOCK:
+        if cache_key not in _SHARED_TOKENIZERS:
+            _SHARED_TOKENIZERS[cache_key] = LazyTokenizer(resource_dir)
+        return _SHARED_TOKENIZERS[cache_key]
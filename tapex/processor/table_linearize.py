@@ -6,7 +6,7 @@ Utils for linearizing the table content into a flatten sequence
 """
 import abc
 import abc
-from typing import Dict, List, List
+from typing import Dict, List, Tuple
 
 
 class TableLinearize(abc.ABC):
@@ -40,35 +40,62 @@ class IndexedRowTableLinearize(TableLinearize):
     FORMAT: col: col1 | col2 | col3 row 1 : val1 | val2 | val3 row 2 : ...
     """
 
-    def process_table(self, table_content: Dict):
+    def process_table(self, table_content: Dict, start_row_index: int = 1):
         """
         Given a table, TableLinearize aims at converting it into a flatten sequence with special symbols.
+        :param start_row_index: the index of the first row, which is larger than 1 when the table is a chunk
+        of a larger table and its rows should keep their indices in the larger table
+        """
+        table_str, _ = self.process_table_with_offsets(table_content, start_row_index=start_row_index)
+        return table_str
+
+    def process_table_with_offsets(self, table_content: Dict, start_row_index: int = 1) -> Tuple[str, List[int]]:
+        """
+        The same as `process_table`, but also return the character offset where each row starts, so that callers can
+        slice rows out of the flatten sequence instead of linearizing the table again, e.g., `table_str[:offsets[k]]`
+        followed by `rstrip()` keeps the header with the first k rows.
         """
         assert "header" in table_content and "rows" in table_content, self.PROMPT_MESSAGE
-        # process header
-        _table_str = self.process_header(table_content["header"]) + " "
-        # process rows
+        # collect all parts and join them only once, to avoid repeatedly copying the growing string
+        header_str = self.process_header(table_content["header"])
+        table_parts = [header_str]
+        row_offsets = []
+        # the length of the parts so far, plus one separating space
+        current_offset = len(header_str) + 1
         for i, row_example in enumerate(table_content["rows"]):
             # NOTE: the row should start from row 1 instead of 0
-            _table_str += self.process_row(row_example, row_index=i + 1) + " "
-        return _table_str.strip()
+            row_str = self.process_row(row_example, row_index=i + start_row_index)
+            table_parts.append(row_str)
+            row_offsets.append(current_offset)
+            current_offset += len(row_str) + 1
+        # stripping never changes the offsets since the header always starts with `col`
+        return " ".join(table_parts).strip(), row_offsets
 
     def process_header(self, headers: List):
         """
         Given a list of headers, TableLinearize aims at converting it into a flatten sequence with special symbols.
         """
-        return "col : " + " | ".join(headers)
+        return "col : " + " | ".join([self.process_cell(header) for header in headers])
 
     def process_row(self, row: List, row_index: int):
         """
         Given a row, TableLinearize aims at converting it into a flatten sequence with special symbols.
         """
-        row_str = ""
-        row_cell_values = []
-        for cell_value in row:
-            if isinstance(cell_value, int):
-                row_cell_values.append(str(cell_value))
-            else:
-                row_cell_values.append(cell_value)
-        row_str += " | ".join(row_cell_values)
-        return "row " + str(row_index) + " : " + row_str
+        return "row " + str(row_index) + " : " + self.process_row_content(row)
+
+    def process_row_content(self, row: List):
+        """
+        Given a row, return its cell values joined by the cell separator, i.e., the row without its index prefix.
+        """
+        return " | ".join([self.process_cell(cell_value) for cell_value in row])
+
+    @staticmethod
+    def process_cell(cell_value) -> str:
+        """
+        Convert a cell value into its string form, numbers are formatted by `str` and a missing value is empty.
+        """
+        if isinstance(cell_value, str):
+            return cell_value
+        if cell_value is None:
+            return ""
+        return str(cell_value)
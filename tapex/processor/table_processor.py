@@ -1,24 +1,46 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from .table_linearize import TableLinearize
-from .table_truncate import TableTruncate
+from .table_split import RowChunkSplit
+from .table_truncate import TableTruncate, RowDeleteTruncate, ColumnPruneTruncate
+from .table_view import TableView
 
 
 class TableProcessor(object):
 
     def __init__(self, table_linearize_func: TableLinearize,
                  table_truncate_funcs: List[TableTruncate],
-                 target_delimiter: str = ", "):
+                 target_delimiter: str = ", ",
+                 copy_on_write: bool = False,
+                 table_split_func: RowChunkSplit = None):
+        """
+        :param copy_on_write: if true, truncators work on a `TableView` over the table and on a copy of the answer,
+        so the caller's table and answer are never modified and the table can be shared across questions and threads.
+        Use `process_example` to get the answer after truncating in this mode.
+        :param table_split_func: the splitter used by `process_chunked_inputs`
+        """
         self.table_linearize_func = table_linearize_func
         self.table_truncate_funcs = table_truncate_funcs
         self.target_delimiter = target_delimiter
+        self.copy_on_write = copy_on_write
+        self.table_split_func = table_split_func
 
     def process_input(self, table_content: Dict, question: str, answer: List[str]) -> str:
         """
         Preprocess a sentence into the expected format for model translate.
         """
+        joint_input, _ = self.process_example(table_content, question, answer)
+        return joint_input
+
+    def process_example(self, table_content: Dict, question: str, answer: List[str]) -> Tuple[str, List[str]]:
+        """
+        The same as `process_input`, but also return the answer, whose values follow the truncated cells.
+        """
+        if self.copy_on_write:
+            table_content = TableView(table_content)
+            answer = list(answer)
         # modify a table internally
         for truncate_func in self.table_truncate_funcs:
             truncate_func.truncate_table(table_content, question, answer)
@@ -26,7 +48,53 @@ class TableProcessor(object):
         linear_table = self.table_linearize_func.process_table(table_content)
         # concat question with linear_table
         joint_input = question + " " + linear_table
-        return joint_input
+        return joint_input, answer
+
+    def process_inputs(self, table_contents: List[Dict], questions: List[str], answers: List[List[str]]) -> List[str]:
+        """
+        Preprocess many sentences at once, which lets every truncator tokenize the content of all tables in batches.
+        The result is the same as calling `process_input` on each example in order.
+        """
+        linear_tables = self.process_tables(table_contents, questions, answers)
+        return [question + " " + linear_table for question, linear_table in zip(questions, linear_tables)]
+
+    def process_tables(self, table_contents: List[Dict], questions: List[str], answers: List[List[str]]) -> List[str]:
+        """
+        The same as `process_inputs`, but return the linearized tables without the questions in front of them.
+        """
+        if self.copy_on_write:
+            table_contents = [TableView(table_content) for table_content in table_contents]
+            answers = [list(answer) for answer in answers]
+        for truncate_func in self.table_truncate_funcs:
+            truncate_func.prepare_tables(table_contents)
+            for table_content, question, answer in zip(table_contents, questions, answers):
+                truncate_func.truncate_table(table_content, question, answer)
+        return [self.table_linearize_func.process_table(table_content) for table_content in table_contents]
+
+    def process_chunked_inputs(self, table_contents: List[Dict], questions: List[str]) -> List[List[str]]:
+        """
+        Preprocess many sentences at once like `process_inputs`, but a table which is too large is split into chunks
+        by `table_split_func` rather than having its rows deleted. Truncators deleting rows or columns to fit into
+        memory are skipped, and the other truncators (e.g., `CellLimitTruncate`) still apply to the whole table.
+        The caller's tables are never modified.
+        :return: the model inputs of each (question, table) pair, one for each chunk of the table
+        """
+        assert self.table_split_func is not None, "A `table_split_func` is required to split tables into chunks."
+        table_contents = [TableView(table_content) for table_content in table_contents]
+        for truncate_func in self.table_truncate_funcs:
+            if isinstance(truncate_func, (RowDeleteTruncate, ColumnPruneTruncate)):
+                continue
+            truncate_func.prepare_tables(table_contents)
+            for table_content, question in zip(table_contents, questions):
+                truncate_func.truncate_table(table_content, question, [])
+        self.table_split_func.prepare_tables(table_contents)
+        chunked_inputs = []
+        for table_content, question in zip(table_contents, questions):
+            # the table is linearized once, and its chunks are sliced out by row offsets
+            chunked_inputs.append([question + " " + linear_chunk
+                                   for linear_chunk in self.table_split_func.split_linearized_table(table_content,
+                                                                                                    question)])
+        return chunked_inputs
 
     def process_output(self, answer: List[str]) -> str:
         """
@@ -0,0 +1,94 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for splitting a large table into chunks which each fit in memory, instead of deleting rows
+"""
+import logging
+from typing import Dict, List, Tuple
+
+from tapex.processor.table_linearize import TableLinearize
+from tapex.processor.table_truncate import RowDeleteTruncate
+from tapex.processor.table_view import TableView
+
+logger = logging.getLogger(__name__)
+
+
+class RowChunkSplit(RowDeleteTruncate):
+    """
+    Split the rows of a table into consecutive chunks, where each chunk with the question and the header fits into
+    `max_input_length`. Every chunk repeats the header, and its rows keep their indices in the whole table, so that
+    `row 37 : ...` is still `row 37` in the second chunk. Used as a truncator, only the first chunk is kept.
+    """
+
+    def __init__(self, table_linearize: TableLinearize, max_chunks: int = 8, **kwargs):
+        """
+        :param max_chunks: the maximum number of chunks of a table, the rows beyond are dropped
+        """
+        # the token cost of a row is computed in the same way as the single pass mode
+        super().__init__(table_linearize=table_linearize, single_pass=True, **kwargs)
+        self.max_chunks = max_chunks
+
+    def config(self) -> Dict:
+        config = super().config()
+        config["max_chunks"] = self.max_chunks
+        return config
+
+    def truncate_table(self, table_content: Dict, question: str, answer: List):
+        chunk_bounds = self.split_row_bounds(table_content, question)
+        del table_content["rows"][chunk_bounds[0][1]:]
+
+    def split_table(self, table_content: Dict, question: str) -> List[Tuple[TableView, int]]:
+        """
+        :return: a list of (chunk, the index of its first row), where each chunk is a `TableView` over the table
+        """
+        if not isinstance(table_content, TableView):
+            table_content = TableView(table_content)
+        return [(table_content.select_rows(start, end), start + 1)
+                for start, end in self.split_row_bounds(table_content, question)]
+
+    def split_linearized_table(self, table_content: Dict, question: str) -> List[str]:
+        """
+        The same as linearizing each chunk of `split_table` with its start row index, but the whole table is only
+        linearized once, and each chunk is sliced out of it by the row offsets.
+        :return: the linearized chunks of the table
+        """
+        table_str, row_offsets = self.table_linearize.process_table_with_offsets(table_content)
+        if len(row_offsets) == 0:
+            return [table_str]
+        header_str = table_str[:row_offsets[0] - 1]
+        # the end of each row is the start of the next row, minus the separating space
+        row_ends = [row_offset - 1 for row_offset in row_offsets[1:]] + [len(table_str)]
+        linear_chunks = []
+        for start, end in self.split_row_bounds(table_content, question):
+            # strip in the same way as linearizing the chunk alone
+            linear_chunks.append((header_str + " " + table_str[row_offsets[start]:row_ends[end - 1]]).strip())
+        return linear_chunks
+
+    def split_row_bounds(self, table_content: Dict, question: str) -> List[Tuple[int, int]]:
+        """
+        Greedily pack consecutive rows into chunks.
+        :return: the [start, end) row positions of each chunk, there is always at least one (maybe empty) chunk
+        """
+        remain_token_len = self.estimate_remain_token_len(table_content, question)
+        row_token_lens = self.batch_count_tokens([" " + self.table_linearize.process_row_content(row_example)
+                                                  for row_example in table_content["rows"]])
+        # rows are indexed by their positions in the whole table, not in the chunk
+        row_index_token_lens = self.batch_count_tokens(["row {} :".format(ind + 1)
+                                                        for ind in range(len(row_token_lens))])
+        chunk_bounds = []
+        chunk_start, chunk_token_len = 0, 0
+        for ind, (row_token_len, row_index_token_len) in enumerate(zip(row_token_lens, row_index_token_lens)):
+            # a row which cannot fit even alone still makes up its own chunk, and is truncated by the model
+            if ind > chunk_start and chunk_token_len + row_token_len + row_index_token_len > remain_token_len:
+                chunk_bounds.append((chunk_start, ind))
+                chunk_start, chunk_token_len = ind, 0
+            chunk_token_len += row_token_len + row_index_token_len
+        chunk_bounds.append((chunk_start, len(row_token_lens)))
+
+        if len(chunk_bounds) > self.max_chunks:
+            if "id" in table_content:
+                logger.warning("Table {} has {} chunks, only the first {} chunks are kept".format(
+                    table_content["id"], len(chunk_bounds), self.max_chunks))
+            chunk_bounds = chunk_bounds[:self.max_chunks]
+        return chunk_bounds
@@ -4,35 +4,160 @@
 from abc import ABC
 import math
 import random
-from typing import List, Dict, Tuple
+from bisect import bisect_right
+from itertools import accumulate
+from typing import List, Dict, Tuple, TYPE_CHECKING
 import logging
-from transformers import AutoTokenizer, BasicTokenizer
-from tapex.processor.table_linearize import TableLinearize
+import re
+import numpy as np
+from tapex.common.cache import LRUCache
+from tapex.processor.columnar_table import ColumnarTable
+from tapex.processor.lazy_tokenizer import get_shared_tokenizer
+from tapex.processor.table_linearize import TableLinearize, IndexedRowTableLinearize
+from tapex.processor.table_view import TableView
+from tapex.processor.token_cache import TokenCache
+
+if TYPE_CHECKING:
+    from transformers import BasicTokenizer
 
 logger = logging.getLogger(__name__)
 
 # truncate will randomly drop rows
 random.seed(42)
 
+# distinguish a missing cache entry from a cached `None`
+_CACHE_MISS = object()
+
+
+def delete_rows(table_content: Dict, drop_row_indices: set):
+    """
+    Delete rows by their current positions in one pass.
+    """
+    if isinstance(table_content, (ColumnarTable, TableView)):
+        # only the kept row indices are updated
+        table_content.delete_rows(drop_row_indices)
+    elif len(drop_row_indices) > 0:
+        # compact the kept rows, and keep the same list object for the caller
+        table_content["rows"][:] = [row for _row_idx, row in enumerate(table_content["rows"])
+                                    if _row_idx not in drop_row_indices]
+
+
+def delete_columns(table_content: Dict, drop_col_indices: set):
+    """
+    Delete columns by their current positions, from both the header and every row.
+    """
+    if len(drop_col_indices) == 0:
+        return
+    if isinstance(table_content, (ColumnarTable, TableView)):
+        table_content.delete_columns(drop_col_indices)
+    else:
+        table_content["header"][:] = [header for col_idx, header in enumerate(table_content["header"])
+                                      if col_idx not in drop_col_indices]
+        for row in table_content["rows"]:
+            row[:] = [cell for col_idx, cell in enumerate(row) if col_idx not in drop_col_indices]
+
+
+def related_row_indices(lower_rows: List[frozenset], question: str, answer: List) -> set:
+    """
+    The rows which `RowDeleteTruncate` never deletes at random: the rows with a lower-cased cell appearing in the
+    question or the answer, and their neighbours within two rows.
+    """
+    if len(answer) == 0:
+        answer_set = set([])
+    else:
+        answer_set = set([ans_ex.lower() for ans_ex in answer])
+    # add question key words into answer set
+    if question is not None:
+        answer_set.update(question.split())
+    question_set = set(question.strip("?!.,").split(" "))
+    # a row is related if any of its lower-cased cells appears in the answer set or the question set
+    query_set = answer_set | question_set
+    related_indices = set()
+    for _row_idx, lower_row in enumerate(lower_rows):
+        if not lower_row.isdisjoint(query_set):
+            # add neighbours to preserve information aggressively
+            related_indices.update(range(max(_row_idx - 2, 0), min(_row_idx + 3, len(lower_rows))))
+    return related_indices
+
 
 class TableTruncate(ABC):
 
-    def __init__(self, tokenizer: BasicTokenizer = None, max_input_length: int = 1024):
+    def __init__(self, tokenizer: "BasicTokenizer" = None, max_input_length: int = 1024,
+                 token_cache: TokenCache = None, resource_dir: str = None):
         """
         The class `TableTruncate` is used to compress a table to fit in memory.
-        :param tokenizer: a huggingface transformer's tokenizer, to be used on BPE encoding to estimate expected tokens
+        :param tokenizer: a huggingface transformer's tokenizer, to be used on BPE encoding to estimate expected tokens.
+        If not provided, the tokenizer shared by all truncators is lazily loaded on first use.
         :param max_input_length: the maximum length of `question` and `table`, i.e., the max position id of a model
+        :param token_cache: an optional cache of token counts and truncated strings, which can be shared across
+        truncators using the same tokenizer
+        :param resource_dir: the directory of `encoder.json` and `vocab.bpe` which the shared tokenizer is loaded from
+        if `tokenizer` is not provided, otherwise the tokenizer of `facebook/bart-large` is loaded from the hub
         """
         if tokenizer is None:
-            self.tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path="facebook/bart-large")
+            self.tokenizer = get_shared_tokenizer(resource_dir)
         else:
             self.tokenizer = tokenizer
         self.max_length = max_input_length
+        self.token_cache = token_cache
+
+    def config(self) -> Dict:
+        """
+        The settings which affect the truncated tables, e.g., to tell whether a preprocessed dataset is stale.
+        """
+        return {"type": type(self).__name__, "max_input_length": self.max_length}
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Count the BPE tokens of a text, consulting the token cache if any.
+        """
+        if self.token_cache is None:
+            return len(self.tokenizer.tokenize(text))
+        cache_key = ("count", text)
+        token_len = self.token_cache.get(cache_key, _CACHE_MISS)
+        if token_len is _CACHE_MISS:
+            token_len = len(self.tokenizer.tokenize(text))
+            self.token_cache.put(cache_key, token_len)
+        return token_len
+
+    def batch_count_tokens(self, texts: List[str]) -> List[int]:
+        """
+        Count the BPE tokens of many texts, where all texts missing in the token cache are encoded in one
+        tokenizer call. It is much faster with a fast (Rust) tokenizer.
+        """
+        token_lens = [None] * len(texts)
+        pending_indices = []
+        for idx, text in enumerate(texts):
+            if self.token_cache is not None:
+                token_len = self.token_cache.get(("count", text), _CACHE_MISS)
+                if token_len is not _CACHE_MISS:
+                    token_lens[idx] = token_len
+                    continue
+            pending_indices.append(idx)
+        if len(pending_indices) > 0:
+            pending_texts = list(dict.fromkeys(texts[idx] for idx in pending_indices))
+            encodings = self.tokenizer(pending_texts, add_special_tokens=False)
+            pending_token_lens = {}
+            for text, input_ids in zip(pending_texts, encodings["input_ids"]):
+                pending_token_lens[text] = len(input_ids)
+                if self.token_cache is not None:
+                    self.token_cache.put(("count", text), len(input_ids))
+            for idx in pending_indices:
+                token_lens[idx] = pending_token_lens[texts[idx]]
+        return token_lens
+
+    def prepare_tables(self, table_contents: List[Dict]):
+        """
+        Optionally warm up on a batch of tables before `truncate_table` is called on each of them,
+        e.g., tokenizing the content of all tables in one batch and keeping the results in the token cache.
+        """
+        pass
 
     def truncate_table(self, table_content: Dict, question: str, answer: List):
         """
         Given a table, return a truncated table with the same format.
         We enable optionally providing question and answer for precise truncating.
+        The table can be a table dict, a `ColumnarTable` or a `TableView`.
         :return: no return value, but may modify table_content and answer
         """
         pass
@@ -47,11 +172,32 @@ class CellLimitTruncate(TableTruncate):
         super().__init__(**kwargs)
         self.max_cell_length = max_cell_length
 
+    def config(self) -> Dict:
+        config = super().config()
+        config["max_cell_length"] = self.max_cell_length
+        return config
+
+    def prepare_tables(self, table_contents: List[Dict]):
+        # the results are only reusable through the token cache
+        if self.token_cache is None:
+            return
+        cell_values = list(dict.fromkeys(cell for table_content in table_contents
+                                         for row in table_content["rows"]
+                                         for cell in row if isinstance(cell, str)))
+        self.truncate_cells(cell_values)
+
     def truncate_table(self, table_content: Dict, question: str, answer: List):
+        # truncate all distinct string cells of the table in one batch
+        cell_values = list(dict.fromkeys(cell for row in table_content["rows"]
+                                         for cell in row if isinstance(cell, str)))
+        truncate_values = dict(zip(cell_values, self.truncate_cells(cell_values)))
         cell_mapping = {}
         for row in table_content["rows"]:
             for i, cell in enumerate(row):
-                truncate_cell = self.truncate_cell(cell)
+                if isinstance(cell, str):
+                    truncate_cell = truncate_values[cell]
+                else:
+                    truncate_cell = self.truncate_cell(cell)
                 if truncate_cell is not None:
                     cell_mapping[cell] = truncate_cell
                     row[i] = truncate_cell
@@ -65,6 +211,54 @@ class CellLimitTruncate(TableTruncate):
         # do not process on these cases
         if isinstance(cell_value, int) or isinstance(cell_value, float):
             return cell_value
+        if self.token_cache is None:
+            return self._truncate_cell(cell_value)
+        cache_key = ("cell", cell_value, str(self.max_cell_length))
+        truncate_value = self.token_cache.get(cache_key, _CACHE_MISS)
+        if truncate_value is _CACHE_MISS:
+            truncate_value = self._truncate_cell(cell_value)
+            self.token_cache.put(cache_key, truncate_value)
+        return truncate_value
+
+    def truncate_cells(self, cell_values: List[str]) -> List:
+        """
+        Truncate many string cells, where all cells missing in the token cache are encoded in one tokenizer call.
+        With a fast tokenizer, the truncation boundary comes from the character offsets of the tokens.
+        :return: for each cell, the same value as `truncate_cell`
+        """
+        truncate_values = [None] * len(cell_values)
+        pending_indices = []
+        for idx, cell_value in enumerate(cell_values):
+            if cell_value.strip() == "":
+                truncate_values[idx] = cell_value
+                continue
+            if self.token_cache is not None:
+                truncate_value = self.token_cache.get(("cell", cell_value, str(self.max_cell_length)), _CACHE_MISS)
+                if truncate_value is not _CACHE_MISS:
+                    truncate_values[idx] = truncate_value
+                    continue
+            pending_indices.append(idx)
+        if len(pending_indices) == 0:
+            return truncate_values
+
+        if getattr(self.tokenizer, "is_fast", False):
+            encodings = self.tokenizer([cell_values[idx] for idx in pending_indices],
+                                       add_special_tokens=False,
+                                       return_offsets_mapping=True)
+            for idx, offsets in zip(pending_indices, encodings["offset_mapping"]):
+                if len(offsets) >= self.max_cell_length:
+                    # keep the original text up to the end of the last retained token
+                    truncate_values[idx] = cell_values[idx][:offsets[self.max_cell_length - 1][1]]
+        else:
+            for idx in pending_indices:
+                truncate_values[idx] = self._truncate_cell(cell_values[idx])
+
+        if self.token_cache is not None:
+            for idx in pending_indices:
+                self.token_cache.put(("cell", cell_values[idx], str(self.max_cell_length)), truncate_values[idx])
+        return truncate_values
+
+    def _truncate_cell(self, cell_value: str):
         if cell_value.strip() != "":
             try_tokens = self.tokenizer.tokenize(cell_value)
             if len(try_tokens) >= self.max_cell_length:
@@ -83,9 +277,27 @@ class RowDeleteTruncate(TableTruncate):
     but do not make it too small (e.g., just lower than the limitation is ok).
     """
 
-    def __init__(self, table_linearize: TableLinearize, **kwargs):
+    def __init__(self, table_linearize: TableLinearize, single_pass: bool = False,
+                 row_cells_cache_size: int = 64, **kwargs):
+        """
+        :param table_linearize: the linearizer whose output length should fit into `max_input_length`
+        :param single_pass: if true, tokenize the content of each row only once and derive both the delete ratio
+        and the number of kept rows from the per-row token counts. It requires `IndexedRowTableLinearize`.
+        :param row_cells_cache_size: the number of original tables whose lower-cased row cells are cached, which
+        only applies to tables truncated through a `TableView`, i.e., in the copy-on-write mode.
+        """
         super().__init__(**kwargs)
         self.table_linearize = table_linearize
+        self.single_pass = single_pass
+        self.row_cells_cache = LRUCache(max_size=row_cells_cache_size)
+        if single_pass:
+            assert isinstance(table_linearize, IndexedRowTableLinearize), \
+                "The single pass mode relies on the row format of `IndexedRowTableLinearize`."
+
+    def config(self) -> Dict:
+        config = super().config()
+        config["single_pass"] = self.single_pass
+        return config
 
     def truncate_table(self, table_content: Dict, question: str, answer: List):
         """
@@ -93,6 +305,9 @@ class RowDeleteTruncate(TableTruncate):
         :param question: natural language sentence
         :param answer: if for training, is the supervision; otherwise will be empty
         """
+        if self.single_pass:
+            self.truncate_table_single_pass(table_content, question, answer)
+            return
         delete_ratio, remain_token_len = self.estimate_delete_ratio(table_content, question)
         # randomly delete unrelated rows
         self.delete_unrealted_rows(table_content, question, answer, delete_ratio)
@@ -100,7 +315,7 @@ class RowDeleteTruncate(TableTruncate):
         maximum_keep_rows = 0
         for ind, row_example in enumerate(table_content["rows"]):
             value_string = self.table_linearize.process_row(row_example, ind + 1)
-            value_token_len = len(self.tokenizer.tokenize(value_string))
+            value_token_len = self.count_tokens(value_string)
             # over the size limit, and take action
             if value_token_len > remain_token_len:
                 break
@@ -108,24 +323,67 @@ class RowDeleteTruncate(TableTruncate):
             maximum_keep_rows += 1
         del table_content["rows"][maximum_keep_rows:]
 
-    def estimate_delete_ratio(self, table_content: Dict, question: str):
+    def prepare_tables(self, table_contents: List[Dict]):
+        # only the single pass mode reuses the token counts of row contents through the token cache
+        if not self.single_pass or self.token_cache is None:
+            return
+        self.batch_count_tokens([" " + self.table_linearize.process_row_content(row_example)
+                                 for table_content in table_contents
+                                 for row_example in table_content["rows"]])
+
+    def truncate_table_single_pass(self, table_content: Dict, question: str, answer: List):
+        """
+        The same truncating principle as `truncate_table`, but each row is tokenized once.
+        A row is linearized as `row {index} : {content}`, and the BPE never merges across the space before
+        the content, so the tokens of a row are the tokens of its index prefix plus the tokens of its content.
+        The content does not change when rows are re-indexed, and the prefix cost is added arithmetically.
+        """
+        remain_token_len = self.estimate_remain_token_len(table_content, question)
+        # the content and the index prefix of all rows are encoded in two batched tokenizer calls
+        row_token_lens = self.batch_count_tokens([" " + self.table_linearize.process_row_content(row_example)
+                                                  for row_example in table_content["rows"]])
+        row_index_token_lens = self.batch_count_tokens(["row {} :".format(ind + 1)
+                                                        for ind in range(len(row_token_lens))])
+        value_token_len = sum(row_token_len + row_index_token_len
+                              for row_token_len, row_index_token_len in zip(row_token_lens, row_index_token_lens))
+        if value_token_len < remain_token_len:
+            delete_ratio = 0.0
+        else:
+            delete_ratio = 1.0 - remain_token_len / value_token_len
+        # randomly delete unrelated rows
+        drop_row_indices = self.delete_unrealted_rows(table_content, question, answer, delete_ratio)
+        keep_row_token_lens = [row_token_len for ind, row_token_len in enumerate(row_token_lens)
+                               if ind not in drop_row_indices]
+        # guarantee the result < self.max_length, where rows are indexed by their positions after deleting
+        keep_row_prefix_lens = list(accumulate(row_token_len + row_index_token_len
+                                               for row_token_len, row_index_token_len
+                                               in zip(keep_row_token_lens, row_index_token_lens)))
+        maximum_keep_rows = bisect_right(keep_row_prefix_lens, remain_token_len)
+        del table_content["rows"][maximum_keep_rows:]
+
+    def estimate_remain_token_len(self, table_content: Dict, question: str) -> int:
+        """
+        The remaining token space for rows after the question and the header.
+        """
         assert "header" in table_content and "rows" in table_content
-        number_of_rows = len(table_content["rows"])
         # calculate the tokens of header, special tokens will only be pre-prepended into question
         question_tokens = self.tokenizer.tokenize(question, add_special_tokens=True)
         # calculate the tokens of header
         header_string = self.table_linearize.process_header(table_content["header"])
-        header_tokens = self.tokenizer.tokenize(header_string, add_special_tokens=False)
+        header_token_len = self.count_tokens(header_string)
         # split all cell values into tokens and see how many can be accommodated
-        used_token_len = len(question_tokens) + len(header_tokens)
+        used_token_len = len(question_tokens) + header_token_len
         # remaining token space for rows
-        remain_token_len = self.max_length - used_token_len
+        return self.max_length - used_token_len
+
+    def estimate_delete_ratio(self, table_content: Dict, question: str):
+        remain_token_len = self.estimate_remain_token_len(table_content, question)
 
         value_string = ""
         for _, row_example in enumerate(table_content["rows"]):
             # use a general index to roughly estimate the overall token len
             value_string += self.table_linearize.process_row(row_example, 100) + " "
-        value_token_len = len(self.tokenizer.tokenize(value_string))
+        value_token_len = self.count_tokens(value_string)
 
         if value_token_len < remain_token_len:
             # no row will be deleted
@@ -137,39 +395,220 @@ class RowDeleteTruncate(TableTruncate):
     def delete_unrealted_rows(self, table_content: Dict, question: str, answer: List, delete_ratio: float):
         """
         The argument answer is used only during training.
+        :return: the set of original indices of the deleted rows
         """
-        truncated_unrelated_indices = []
-        related_indices = []
-        if len(answer) == 0:
-            answer_set = set([])
-        else:
-            answer_set = set([ans_ex.lower() for ans_ex in answer])
-        # add question key words into answer set
-        if question is not None:
-            answer_set.update(question.split())
-        question_set = set(question.strip("?!.,").split(" "))
-        row_max_len = len(table_content["rows"])
-        for _row_idx, row in enumerate(table_content["rows"]):
-            lower_row = set([str(cell).lower() for cell in row])
-            if len(lower_row & answer_set) == 0 and len(lower_row & question_set) == 0:
-                truncated_unrelated_indices.append(_row_idx)
-            else:
-                # add neighbours to preserve information aggressively
-                related_indices.extend([_row_idx - 2, _row_idx - 1,
-                                        _row_idx,
-                                        _row_idx + 1, _row_idx + 2])
-
-        # remove the neighbours
-        truncated_unrelated_indices = [_row_idx for _row_idx in truncated_unrelated_indices
+        lower_rows = self.get_lower_row_cells(table_content)
+        related_indices = related_row_indices(lower_rows, question, answer)
+        truncated_unrelated_indices = [_row_idx for _row_idx in range(len(lower_rows))
                                        if _row_idx not in related_indices]
         # select some cases to drop
         drop_items = min(len(truncated_unrelated_indices), int(len(table_content["rows"]) * delete_ratio))
-        drop_row_indices = random.choices(truncated_unrelated_indices, k=drop_items)
+        drop_row_indices = set(random.choices(truncated_unrelated_indices, k=drop_items))
 
-        for _row_idx in reversed(range(row_max_len)):
-            if _row_idx in drop_row_indices:
-                del table_content["rows"][_row_idx]
+        delete_rows(table_content, drop_row_indices)
 
         # only when the drop ratio is too large, logging for warning.
         if "id" in table_content and len(drop_row_indices) > 0:
             logger.warning("Delete {:.2f} rows in table {}".format(len(drop_row_indices), table_content["id"]))
+        return drop_row_indices
+
+    def get_lower_row_cells(self, table_content: Dict) -> List[frozenset]:
+        """
+        Return the set of lower-cased cell values of each row.
+        For a `TableView`, the sets of the original table are computed once and cached, since the original table is
+        shared across questions, and only the rows with replaced cells are computed again.
+        """
+        if not isinstance(table_content, TableView) or table_content.col_indices is not None:
+            return [frozenset([str(cell).lower() for cell in row]) for row in table_content["rows"]]
+        base_table = table_content.table_content
+        # the cached entry holds the original table itself, so that its id cannot be reused by another table
+        cache_entry = self.row_cells_cache.get(id(base_table))
+        if cache_entry is None or cache_entry[0] is not base_table:
+            cache_entry = (base_table, [frozenset([str(cell).lower() for cell in row])
+                                        for row in table_content.base_rows])
+            self.row_cells_cache.put(id(base_table), cache_entry)
+        base_lower_rows = cache_entry[1]
+        replaced_row_indices = set(row_idx for row_idx, _ in table_content.replaced_cells)
+        lower_rows = []
+        for row_idx, row in zip(table_content.row_indices, table_content["rows"]):
+            if row_idx in replaced_row_indices:
+                lower_rows.append(frozenset([str(cell).lower() for cell in row]))
+            else:
+                lower_rows.append(base_lower_rows[row_idx])
+        return lower_rows
+
+
+class ColumnPruneTruncate(TableTruncate):
+    """
+    Wide tables spend most tokens on columns unrelated to the question. This truncator ranks columns by the overlap
+    between the question and their header / cells, and drops the least relevant columns until the table fits in memory.
+    Columns containing an answer are never dropped, so the answer can still be found in the table.
+    It only applies to wide tables, and it is expected to run before `RowDeleteTruncate`: since the row truncator can
+    delete the rows unrelated to the question, columns are only dropped if the header and the related rows (i.e., the
+    rows `RowDeleteTruncate` keeps) do not fit in memory. Rows are not touched.
+    """
+
+    WORD_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, table_linearize: TableLinearize, min_table_columns: int = 30, min_keep_columns: int = 8,
+                 **kwargs):
+        """
+        :param table_linearize: the linearizer whose output length should fit into `max_input_length`
+        :param min_table_columns: only tables with at least this many columns are pruned, and narrower tables are
+        left to the row truncators
+        :param min_keep_columns: the minimum number of columns to keep
+        """
+        super().__init__(**kwargs)
+        self.table_linearize = table_linearize
+        self.min_table_columns = min_table_columns
+        self.min_keep_columns = min_keep_columns
+
+    def config(self) -> Dict:
+        config = super().config()
+        config["min_table_columns"] = self.min_table_columns
+        config["min_keep_columns"] = self.min_keep_columns
+        return config
+
+    def truncate_table(self, table_content: Dict, question: str, answer: List):
+        header = table_content["header"]
+        rows = table_content["rows"]
+        num_columns = len(header)
+        if num_columns < self.min_table_columns or num_columns <= self.min_keep_columns:
+            return
+        lower_rows = [frozenset([str(cell).lower() for cell in row]) for row in rows]
+        keep_row_indices = sorted(related_row_indices(lower_rows, question, answer))
+        # each cell costs its own tokens and the token of the separator ` |` before or after it
+        header_token_lens = self.batch_count_tokens([" " + self.table_linearize.process_cell(col_name)
+                                                     for col_name in header])
+        column_token_lens = [header_token_len + 1 for header_token_len in header_token_lens]
+        # rows may have fewer or more cells than the header, thus each cell is charged to its own column, and the
+        # cells without a column are charged to the table
+        cell_texts, cell_col_indices = [], []
+        for row_idx in keep_row_indices:
+            for col_idx, cell in enumerate(rows[row_idx]):
+                cell_texts.append(" " + self.table_linearize.process_cell(cell))
+                cell_col_indices.append(col_idx)
+        extra_token_len = 0
+        for col_idx, cell_token_len in zip(cell_col_indices, self.batch_count_tokens(cell_texts)):
+            if col_idx < num_columns:
+                column_token_lens[col_idx] += cell_token_len + 1
+            else:
+                extra_token_len += cell_token_len + 1
+        # besides columns, the question and the index prefix of each kept row take up the space
+        table_token_len = len(self.tokenizer.tokenize(question, add_special_tokens=True)) + \
+            self.count_tokens("col :") + sum(column_token_lens) + extra_token_len + \
+            sum(self.batch_count_tokens(["row {} :".format(ind + 1) for ind in range(len(keep_row_indices))]))
+        if table_token_len <= self.max_length:
+            return
+
+        question_words = set(self.WORD_PATTERN.findall(question.lower()))
+        answer_set = set([str(ans_ex).lower() for ans_ex in answer])
+        protected_columns = set()
+        cell_overlaps = [0] * num_columns
+        for row in rows:
+            for col_idx, cell in zip(range(num_columns), row):
+                lower_cell = self.table_linearize.process_cell(cell).lower()
+                if lower_cell in answer_set:
+                    protected_columns.add(col_idx)
+                if not question_words.isdisjoint(self.WORD_PATTERN.findall(lower_cell)):
+                    cell_overlaps[col_idx] += 1
+        # a matched header is the strongest evidence, then the number of matched cells
+        column_scores = [(len(set(self.WORD_PATTERN.findall(self.table_linearize.process_cell(col_name).lower()))
+                              & question_words), cell_overlaps[col_idx])
+                         for col_idx, col_name in enumerate(header)]
+
+        # drop the least relevant columns first, and the most expensive one among equally relevant columns
+        drop_order = sorted([col_idx for col_idx in range(num_columns) if col_idx not in protected_columns],
+                            key=lambda col_idx: (column_scores[col_idx], -column_token_lens[col_idx], -col_idx))
+        drop_col_indices = set()
+        for col_idx in drop_order:
+            if table_token_len <= self.max_length or num_columns - len(drop_col_indices) <= self.min_keep_columns:
+                break
+            drop_col_indices.add(col_idx)
+            table_token_len -= column_token_lens[col_idx]
+        delete_columns(table_content, drop_col_indices)
+
+        if "id" in table_content and len(drop_col_indices) > 0:
+            logger.warning("Delete {} columns in table {}".format(len(drop_col_indices), table_content["id"]))
+
+
+class RelevanceRowTruncate(RowDeleteTruncate):
+    """
+    Instead of randomly deleting unrelated rows, score every row by BM25 between its cell words and the question
+    (and the answer if provided), and keep the rows with the best score per token that fit into memory.
+    The kept rows stay in their original order, and rows without any overlap are kept in order if space remains.
+    """
+
+    WORD_PATTERN = re.compile(r"\w+")
+
+    def __init__(self, table_linearize: TableLinearize, k1: float = 1.2, b: float = 0.75, **kwargs):
+        """
+        :param k1: the term frequency saturation of BM25
+        :param b: the row length normalization of BM25
+        """
+        # the token cost of a row is computed in the same way as the single pass mode
+        super().__init__(table_linearize=table_linearize, single_pass=True, **kwargs)
+        self.k1 = k1
+        self.b = b
+
+    def config(self) -> Dict:
+        config = super().config()
+        config["k1"] = self.k1
+        config["b"] = self.b
+        return config
+
+    def truncate_table(self, table_content: Dict, question: str, answer: List):
+        remain_token_len = self.estimate_remain_token_len(table_content, question)
+        row_token_lens = self.batch_count_tokens([" " + self.table_linearize.process_row_content(row_example)
+                                                  for row_example in table_content["rows"]])
+        row_index_token_lens = self.batch_count_tokens(["row {} :".format(ind + 1)
+                                                        for ind in range(len(row_token_lens))])
+        if sum(row_token_lens) + sum(row_index_token_lens) <= remain_token_len:
+            # no row will be deleted
+            return
+
+        # a row can be moved to any position, so charge the most expensive index prefix to be safe
+        row_costs = np.array(row_token_lens, dtype=np.float64) + max(row_index_token_lens)
+        row_scores = self.score_rows(table_content, question, answer)
+        # greedy knapsack: the highest score per token first, ties are broken by the original order
+        keep_order = np.argsort(-row_scores / np.maximum(row_costs, 1.0), kind="stable")
+        keep_row_indices = []
+        used_token_len = 0
+        for row_idx in keep_order.tolist():
+            if used_token_len + row_costs[row_idx] <= remain_token_len:
+                keep_row_indices.append(row_idx)
+                used_token_len += row_costs[row_idx]
+        keep_row_indices = set(keep_row_indices)
+        delete_rows(table_content, set(range(len(row_token_lens))) - keep_row_indices)
+
+        if "id" in table_content:
+            logger.warning("Delete {:.2f} rows in table {}".format(len(row_token_lens) - len(keep_row_indices),
+                                                                   table_content["id"]))
+
+    def score_rows(self, table_content: Dict, question: str, answer: List) -> np.ndarray:
+        """
+        Compute the BM25 score of each row, where each row is a document and the question words are the query.
+        """
+        query_text = question + " " + " ".join([str(ans_ex) for ans_ex in answer])
+        query_terms = list(dict.fromkeys(self.WORD_PATTERN.findall(query_text.lower())))
+        num_rows = len(table_content["rows"])
+        if num_rows == 0 or len(query_terms) == 0:
+            return np.zeros(num_rows, dtype=np.float64)
+
+        term_ids = {term: term_id for term_id, term in enumerate(query_terms)}
+        term_freqs = np.zeros((num_rows, len(query_terms)), dtype=np.float64)
+        row_lens = np.zeros(num_rows, dtype=np.float64)
+        for row_idx, row_example in enumerate(table_content["rows"]):
+            row_words = self.WORD_PATTERN.findall(self.table_linearize.process_row_content(row_example).lower())
+            row_lens[row_idx] = len(row_words)
+            for word in row_words:
+                term_id = term_ids.get(word)
+                if term_id is not None:
+                    term_freqs[row_idx, term_id] += 1
+
+        doc_freqs = (term_freqs > 0).sum(axis=0)
+        idf = np.log(1.0 + (num_rows - doc_freqs + 0.5) / (doc_freqs + 0.5))
+        avg_row_len = max(row_lens.mean(), 1.0)
+        length_norm = self.k1 * (1.0 - self.b + self.b * row_lens / avg_row_len)
+        bm25 = term_freqs * (self.k1 + 1.0) / (term_freqs + length_norm[:, None])
+        return (bm25 * idf[None, :]).sum(axis=1)
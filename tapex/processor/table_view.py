@@ -0,0 +1,183 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+A copy-on-write view over a table, which lets truncators work without modifying the original table
+"""
+from bisect import bisect_left
+from collections.abc import Mapping, Sequence
+from typing import Dict, Iterable, List
+
+
+class TableView(Mapping):
+    """
+    A lightweight view over a table dict (or a `ColumnarTable`), which only records the kept row indices, the kept
+    column indices and the replaced cells. Truncating a view never changes the original table, so one table can be
+    shared across questions and threads without copying. Keys other than `header` and `rows` are read from the
+    original table.
+    """
+
+    def __init__(self, table_content: Mapping):
+        self.table_content = table_content
+        self.base_rows = table_content["rows"]
+        # indices (in the original table) of the kept rows in order
+        self.row_indices = list(range(len(self.base_rows)))
+        # indices (in the original table) of the kept columns in order, None means all columns are kept
+        self.col_indices = None
+        # (row index in the original table, column index in the original table) -> replaced value
+        self.replaced_cells = {}
+
+    @property
+    def header(self) -> List:
+        base_header = self.table_content["header"]
+        if self.col_indices is None:
+            return base_header
+        # the kept columns may include the cells beyond the header of long rows
+        return [base_header[col_idx] for col_idx in self.col_indices[:bisect_left(self.col_indices, len(base_header))]]
+
+    @property
+    def rows(self) -> "TableViewRows":
+        return TableViewRows(self)
+
+    def __getitem__(self, key):
+        if key == "header":
+            return self.header
+        elif key == "rows":
+            return self.rows
+        return self.table_content[key]
+
+    def __iter__(self):
+        return iter(self.table_content)
+
+    def __len__(self):
+        return len(self.table_content)
+
+    def get_cell(self, row_idx: int, col_idx: int):
+        cell_key = (row_idx, col_idx)
+        if cell_key in self.replaced_cells:
+            return self.replaced_cells[cell_key]
+        return self.base_rows[row_idx][col_idx]
+
+    def set_cell(self, row_idx: int, col_idx: int, value):
+        base_value = self.base_rows[row_idx][col_idx]
+        if value is base_value or value == base_value:
+            # nothing to record if the value is not really replaced
+            self.replaced_cells.pop((row_idx, col_idx), None)
+        else:
+            self.replaced_cells[(row_idx, col_idx)] = value
+
+    def delete_rows(self, row_indices: Iterable[int]):
+        """
+        Delete rows by their current positions in the view, in one pass.
+        """
+        drop_positions = set(row_indices)
+        if len(drop_positions) == 0:
+            return
+        self.row_indices = [row_idx for position, row_idx in enumerate(self.row_indices)
+                            if position not in drop_positions]
+
+    def delete_columns(self, col_indices: Iterable[int]):
+        """
+        Delete columns by their current positions in the view.
+        """
+        drop_positions = set(col_indices)
+        if len(drop_positions) == 0:
+            return
+        if self.col_indices is None:
+            # keep the cells beyond the header as a table dict does
+            num_columns = max([len(self.table_content["header"])] + [len(row) for row in self.base_rows])
+            self.col_indices = list(range(num_columns))
+        self.col_indices = [col_idx for position, col_idx in enumerate(self.col_indices)
+                            if position not in drop_positions]
+
+    def select_rows(self, start: int, end: int) -> "TableView":
+        """
+        Return a new view which keeps the rows at positions [start, end) of this view, with the same kept columns
+        and replaced cells. Neither this view nor the original table is modified.
+        """
+        view = TableView(self.table_content)
+        view.row_indices = self.row_indices[start:end]
+        view.col_indices = None if self.col_indices is None else list(self.col_indices)
+        view.replaced_cells = dict(self.replaced_cells)
+        return view
+
+    def base_col_index(self, position: int) -> int:
+        """
+        Map the position of a column in the view to its index in the original table.
+        """
+        if self.col_indices is None:
+            return position
+        return self.col_indices[position]
+
+    def to_dict(self) -> Dict:
+        """
+        Materialize the view into a new table dict.
+        """
+        table_content = dict(self.table_content)
+        table_content["header"] = list(self.header)
+        table_content["rows"] = [list(row) for row in self.rows]
+        return table_content
+
+
+class TableViewRows(Sequence):
+    """
+    The kept rows of a `TableView`.
+    """
+
+    def __init__(self, view: TableView):
+        self.view = view
+
+    def __len__(self):
+        return len(self.view.row_indices)
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [TableViewRow(self.view, row_idx) for row_idx in self.view.row_indices[position]]
+        return TableViewRow(self.view, self.view.row_indices[position])
+
+    def __iter__(self):
+        for row_idx in self.view.row_indices:
+            yield TableViewRow(self.view, row_idx)
+
+    def __delitem__(self, position):
+        del self.view.row_indices[position]
+
+
+class TableViewRow(Sequence):
+    """
+    A row of a `TableView`, assigning a cell only records the replacement in the view.
+    """
+
+    def __init__(self, view: TableView, row_idx: int):
+        self.view = view
+        self.row_idx = row_idx
+
+    def __len__(self):
+        if self.view.col_indices is not None:
+            # a short row only has the kept columns within its length, which are a prefix of the sorted indices
+            return bisect_left(self.view.col_indices, len(self.view.base_rows[self.row_idx]))
+        return len(self.view.base_rows[self.row_idx])
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[idx] for idx in range(len(self))[position]]
+        if position < 0:
+            position += len(self)
+        return self.view.get_cell(self.row_idx, self.view.base_col_index(position))
+
+    def __setitem__(self, position, value):
+        if position < 0:
+            position += len(self)
+        self.view.set_cell(self.row_idx, self.view.base_col_index(position), value)
+
+    def __iter__(self):
+        if len(self.view.replaced_cells) == 0 and self.view.col_indices is None:
+            return iter(self.view.base_rows[self.row_idx])
+        return (self.view.get_cell(self.row_idx, self.view.base_col_index(position))
+                for position in range(len(self)))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
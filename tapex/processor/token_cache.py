@@ -0,0 +1,32 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for caching the BPE results of cells and rows, which are shared across table truncators
+"""
+from tapex.common.cache import LRUCache
+
+# roughly the memory overhead of a cache entry besides its strings, in bytes
+ENTRY_OVERHEAD = 128
+
+
+def _estimate_entry_size(key, value):
+    entry_size = ENTRY_OVERHEAD
+    for part in key:
+        if isinstance(part, str):
+            entry_size += len(part)
+    if isinstance(value, str):
+        entry_size += len(value)
+    return entry_size
+
+
+class TokenCache(LRUCache):
+    """
+    A size-aware LRU cache of token counts and truncated strings keyed by cell or row text.
+    Popular tables are asked by many questions, and sharing one cache across the truncators of a processor
+    avoids tokenizing identical content again and again.
+    Note that a cache should only be shared by truncators using the same tokenizer.
+    """
+
+    def __init__(self, max_size_in_bytes: int = 64 * 1024 * 1024):
+        super().__init__(max_size=max_size_in_bytes, size_func=_estimate_entry_size)
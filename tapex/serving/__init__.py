@@ -0,0 +1,11 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+from .batch_scheduler import MicroBatchScheduler
+from .encode_cache import TableEncodeCache
+from .prediction_cache import PredictionCache
+from .decoding import DecodingConfig
+from .onnx_export import export_onnx
+from .onnx_model import ONNXBARTModel
+from .worker_pool import WorkerPool
+from .http_server import PredictionServer
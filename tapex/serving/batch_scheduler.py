@@ -0,0 +1,248 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for dynamically batching concurrent prediction requests in front of a model interface
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List
+
+from tapex.serving.decoding import DecodingConfig
+
+logger = logging.getLogger(__name__)
+
+
+class _PendingRequest(object):
+
+    def __init__(self, tokenized_input, future: Future, deadline_ms: float = None):
+        self.tokenized_input = tokenized_input
+        self.input_len = tokenized_input.numel()
+        self.future = future
+        self.enqueue_time = time.perf_counter()
+        # the time by which the request should be answered, None means no deadline
+        self.deadline = self.enqueue_time + deadline_ms / 1000.0 if deadline_ms is not None else None
+
+
+class MicroBatchScheduler(object):
+    """
+    Queue incoming predict calls and run them through the model in micro-batches.
+    A batch is dispatched as soon as the oldest queued request has waited `max_wait_ms`, or the queued requests
+    fill `max_batch_tokens` (padded tokens, in the same sense as `--max-tokens` in fairseq) or `max_batch_size`.
+    Preprocessing runs in the calling thread, while a single background thread owns the model.
+    A request can carry a deadline: if its batch is not expected to finish in time with the configured decoding
+    (e.g., when the queue is long), the batch falls back to greedy decoding with the same length limits.
+    """
+
+    def __init__(self, model_interface, max_wait_ms: float = 10.0, max_batch_tokens: int = 4096,
+                 max_batch_size: int = 64, beam: int = 5, stats_window: int = 1000,
+                 decoding: DecodingConfig = None):
+        """
+        :param model_interface: a `TAPEXModelInterface` (or any object with `encode_examples` and `generate_batch`)
+        :param max_wait_ms: the longest time a request waits for other requests to share its batch
+        :param max_batch_tokens: the maximum padded tokens of a batch
+        :param max_batch_size: the maximum number of requests in a batch
+        :param beam: the beam size used for every batch
+        :param stats_window: the number of recent batches / requests used to report statistics
+        :param decoding: the decoding settings used for every batch, which default to a beam search of size `beam`
+        """
+        self.model_interface = model_interface
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.decoding = decoding if decoding is not None else DecodingConfig(beam=beam)
+        self.fallback_decoding = self.decoding.to_greedy()
+        # the moving average of the time to decode a padded token with `decoding`, used to predict missed deadlines
+        self._decode_time_per_token = None
+
+        self._queue = deque()
+        self._queue_tokens = 0
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._stats_lock = threading.Lock()
+        self._fill_ratios = deque(maxlen=stats_window)
+        self._batch_sizes = deque(maxlen=stats_window)
+        self._queue_waits = deque(maxlen=stats_window)
+        self._num_batches = 0
+        self._num_requests = 0
+        self._num_fallback_batches = 0
+
+        self._worker = threading.Thread(target=self._run, name="tapex-batch-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, question: str, table_context: Dict, deadline_ms: float = None) -> Future:
+        """
+        Thread-safe way to enqueue a prediction, the returned future resolves to the same value as `predict`.
+        :param deadline_ms: the expected latency of the request, which is counted from now on
+        """
+        # the table encode cache of the model interface (if any) is used here as well
+        tokenized_input = self.model_interface.encode_examples([question], [table_context])[0]
+        return self.submit_encoded(tokenized_input, deadline_ms=deadline_ms)
+
+    def submit_encoded(self, tokenized_input, deadline_ms: float = None) -> Future:
+        """
+        The same as `submit`, but for an input already encoded by the model interface, e.g., when the caller
+        preprocesses a batch of requests at once.
+        """
+        future = Future()
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The scheduler has been closed and cannot accept new requests.")
+            self._queue.append(_PendingRequest(tokenized_input, future, deadline_ms=deadline_ms))
+            self._queue_tokens += tokenized_input.numel()
+            self._condition.notify()
+        return future
+
+    def predict(self, question: str, table_context: Dict, timeout: float = None,
+                deadline_ms: float = None) -> List[str]:
+        """
+        Blocking prediction, which has the same return value as `TAPEXModelInterface.predict`.
+        """
+        return [self.submit(question, table_context, deadline_ms=deadline_ms).result(timeout=timeout)]
+
+    async def predict_async(self, question: str, table_context: Dict, deadline_ms: float = None) -> List[str]:
+        """
+        Asyncio prediction, which has the same return value as `TAPEXModelInterface.predict`.
+        Note that preprocessing still happens synchronously before the request is enqueued.
+        """
+        answer = await asyncio.wrap_future(self.submit(question, table_context, deadline_ms=deadline_ms))
+        return [answer]
+
+    def stats(self) -> Dict:
+        """
+        Report the batching statistics over the recent window.
+        `fill_ratio` is the fraction of `max_batch_tokens` (or of the padded tokens of a batch, if a single request
+        exceeds it) used by real (not padded) tokens of a batch, which is at most 1,
+        and `queue_wait_ms` is the time between enqueuing a request and dispatching its batch.
+        `num_fallback_batches` is the number of batches decoded greedily to meet deadlines.
+        The statistics of the table encode cache are reported as `encode_cache` if the model interface has one.
+        """
+        with self._stats_lock:
+            fill_ratios = list(self._fill_ratios)
+            batch_sizes = list(self._batch_sizes)
+            queue_waits = sorted(self._queue_waits)
+            num_batches, num_requests = self._num_batches, self._num_requests
+            num_fallback_batches = self._num_fallback_batches
+
+        def _percentile(sorted_values, ratio):
+            if len(sorted_values) == 0:
+                return 0.0
+            return sorted_values[min(len(sorted_values) - 1, int(ratio * len(sorted_values)))]
+
+        batch_stats = {
+            "num_batches": num_batches,
+            "num_requests": num_requests,
+            "num_fallback_batches": num_fallback_batches,
+            "queue_size": len(self._queue),
+            "avg_batch_size": sum(batch_sizes) / len(batch_sizes) if batch_sizes else 0.0,
+            "avg_fill_ratio": sum(fill_ratios) / len(fill_ratios) if fill_ratios else 0.0,
+            "queue_wait_ms_p50": _percentile(queue_waits, 0.5) * 1000.0,
+            "queue_wait_ms_p95": _percentile(queue_waits, 0.95) * 1000.0
+        }
+        encode_cache = getattr(self.model_interface, "encode_cache", None)
+        if encode_cache is not None:
+            batch_stats["encode_cache"] = encode_cache.stats()
+        return batch_stats
+
+    def close(self, wait: bool = True):
+        """
+        Stop accepting new requests. The requests already queued will still be served.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if wait:
+            self._worker.join()
+
+    def _collect_batch(self) -> List[_PendingRequest]:
+        with self._condition:
+            while True:
+                while len(self._queue) == 0:
+                    if self._closed:
+                        return []
+                    self._condition.wait()
+                # wait for more requests until the window of the oldest request expires or the batch is full
+                dispatch_time = self._queue[0].enqueue_time + self.max_wait
+                while not self._closed and self._queue_tokens < self.max_batch_tokens \
+                        and len(self._queue) < self.max_batch_size:
+                    remain_time = dispatch_time - time.perf_counter()
+                    if remain_time <= 0:
+                        break
+                    self._condition.wait(remain_time)
+                # take requests in arrival order while the padded batch still fits
+                batch, batch_max_len = [], 0
+                while len(self._queue) > 0 and len(batch) < self.max_batch_size:
+                    if self._queue[0].future.cancelled():
+                        # the caller has given up on the request (e.g., on a timeout), thus drop it
+                        self._queue_tokens -= self._queue.popleft().input_len
+                        continue
+                    input_len = self._queue[0].input_len
+                    if len(batch) > 0 and max(batch_max_len, input_len) * (len(batch) + 1) > self.max_batch_tokens:
+                        break
+                    request = self._queue.popleft()
+                    self._queue_tokens -= request.input_len
+                    # a request can no longer be cancelled once it is running
+                    if not request.future.set_running_or_notify_cancel():
+                        continue
+                    batch.append(request)
+                    batch_max_len = max(batch_max_len, input_len)
+                # wait again if all the queued requests have been cancelled
+                if len(batch) > 0:
+                    return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if len(batch) == 0:
+                # only happens when the scheduler is closed and drained
+                return
+            dispatch_time = time.perf_counter()
+            batch_tokens = max(request.input_len for request in batch) * len(batch)
+            with self._stats_lock:
+                self._num_batches += 1
+                self._num_requests += len(batch)
+                self._batch_sizes.append(len(batch))
+                # a single request longer than `max_batch_tokens` still makes up its own batch
+                self._fill_ratios.append(sum(request.input_len for request in batch) /
+                                         max(self.max_batch_tokens, batch_tokens))
+                self._queue_waits.extend(dispatch_time - request.enqueue_time for request in batch)
+            decoding = self._choose_decoding(batch, batch_tokens, dispatch_time)
+            if decoding is self.fallback_decoding:
+                with self._stats_lock:
+                    self._num_fallback_batches += 1
+            try:
+                answers = self.model_interface.generate_batch([request.tokenized_input for request in batch],
+                                                              max_tokens=self.max_batch_tokens,
+                                                              decoding=decoding)
+            except Exception as e:
+                logger.exception("Failed to run a batch of {} requests".format(len(batch)))
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            if decoding is self.decoding:
+                decode_time_per_token = (time.perf_counter() - dispatch_time) / batch_tokens
+                if self._decode_time_per_token is None:
+                    self._decode_time_per_token = decode_time_per_token
+                else:
+                    self._decode_time_per_token = 0.9 * self._decode_time_per_token + 0.1 * decode_time_per_token
+            for request, answer in zip(batch, answers):
+                request.future.set_result(answer)
+
+    def _choose_decoding(self, batch: List[_PendingRequest], batch_tokens: int, dispatch_time: float):
+        """
+        Fall back to greedy decoding if any request of the batch is expected to miss its deadline.
+        """
+        deadlines = [request.deadline for request in batch if request.deadline is not None]
+        if len(deadlines) == 0 or self.decoding.beam == 1:
+            return self.decoding
+        # before the first batch is timed, only the requests already out of time fall back
+        expected_decode_time = batch_tokens * self._decode_time_per_token \
+            if self._decode_time_per_token is not None else 0.0
+        if dispatch_time + expected_decode_time > min(deadlines):
+            return self.fallback_decoding
+        return self.decoding
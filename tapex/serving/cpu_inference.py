@@ -0,0 +1,49 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for running the model efficiently on CPU
+"""
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def set_cpu_threads(num_threads: int = None, num_interop_threads: int = None):
+    """
+    Set the number of threads used within an operator (e.g., a matrix multiplication) and across operators.
+    By default PyTorch uses all cores, which oversubscribes the machine when several model processes run on it.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # it can only be set once, before any inter-op parallel work has started
+            logger.warning("Cannot set the number of inter-op threads after parallel work has started, "
+                           "keep it as {}".format(torch.get_num_interop_threads()))
+    logger.info("Use {} intra-op threads and {} inter-op threads".format(torch.get_num_threads(),
+                                                                        torch.get_num_interop_threads()))
+
+
+def _is_encoder_self_attention(module_name: str) -> bool:
+    return module_name.startswith("encoder.") and ".self_attn." in module_name
+
+
+def quantize_linear_layers(bart):
+    """
+    Apply PyTorch dynamic int8 quantization to the linear layers of a fairseq `BARTHubInterface` in place, which only
+    runs on CPU. The projections of encoder self-attention are kept in fp32, since fairseq passes their weights to the
+    fused attention of PyTorch directly, which does not accept quantized weights. The decoder attentions always
+    decode incrementally and call their projections, so they are quantized together with all feed-forward layers and
+    the output projection, which cover most of the compute in beam search.
+    """
+    # the hub interface refers to the same model under several names, so only quantize the model itself
+    linear_names = set(name for name, module in bart.model.named_modules()
+                       if isinstance(module, torch.nn.Linear) and not _is_encoder_self_attention(name))
+    torch.quantization.quantize_dynamic(bart.model, qconfig_spec=linear_names, dtype=torch.qint8, inplace=True)
+    logger.info("Quantize {} linear layers into int8".format(len(linear_names)))
+    return bart
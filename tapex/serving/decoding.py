@@ -0,0 +1,72 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for configuring how answers are decoded
+"""
+import math
+from typing import Dict, List
+
+
+class DecodingConfig(object):
+    """
+    The decoding settings of a prediction. A setting left as None follows the generation config of the checkpoint,
+    e.g., fairseq decodes at most `max_len_a * source_length + max_len_b` tokens (200 tokens by default).
+    Answers are usually a few tokens, so a small `max_len_b` saves most decoding steps of a hypothesis which does not
+    stop by itself. Note that fairseq already stops decoding an input once `beam` hypotheses have finished.
+    """
+
+    def __init__(self, beam: int = 5, max_len_a: float = None, max_len_b: int = None, min_len: int = None,
+                 lenpen: float = None, nbest: int = 1):
+        """
+        :param beam: the beam size, and 1 means greedy decoding
+        :param max_len_a: the maximum length of an answer grows by `max_len_a` with every source token
+        :param max_len_b: the maximum length of an answer (when `max_len_a` is 0), including the `<s>` and `</s>`
+        :param min_len: the minimum length of an answer
+        :param lenpen: the length penalty, where < 1.0 favors shorter answers and > 1.0 favors longer ones
+        :param nbest: the number of hypotheses (with their scores) returned for each input, at most `beam`
+        """
+        assert nbest <= beam, "Cannot return {} hypotheses from a beam of {}.".format(nbest, beam)
+        self.beam = beam
+        self.max_len_a = max_len_a
+        self.max_len_b = max_len_b
+        self.min_len = min_len
+        self.lenpen = lenpen
+        self.nbest = nbest
+
+    @classmethod
+    def greedy(cls, max_len_a: float = None, max_len_b: int = None) -> "DecodingConfig":
+        return cls(beam=1, max_len_a=max_len_a, max_len_b=max_len_b)
+
+    def to_greedy(self) -> "DecodingConfig":
+        """
+        The greedy decoding with the same length limits, which is used when a request is running out of time.
+        """
+        return DecodingConfig(beam=1, max_len_a=self.max_len_a, max_len_b=self.max_len_b, min_len=self.min_len,
+                              lenpen=self.lenpen, nbest=1)
+
+    def generate_kwargs(self) -> Dict:
+        """
+        The keyword arguments of `BARTHubInterface.generate`, where settings left as None are not passed.
+        """
+        generate_kwargs = {"beam": self.beam}
+        for name in ["max_len_a", "max_len_b", "min_len", "lenpen"]:
+            if getattr(self, name) is not None:
+                generate_kwargs[name] = getattr(self, name)
+        return generate_kwargs
+
+    def __repr__(self):
+        return "DecodingConfig(beam={}, max_len_a={}, max_len_b={}, min_len={}, lenpen={}, nbest={})".format(
+            self.beam, self.max_len_a, self.max_len_b, self.min_len, self.lenpen, self.nbest)
+
+
+def estimate_max_len_b(answer_lens: List[int], coverage: float = 0.99, margin: int = 2) -> int:
+    """
+    Derive `max_len_b` from the distribution of answer lengths, e.g., the lengths of encoded answers in the training
+    set. The result covers the `coverage` quantile of answers, plus a `margin` of tokens for safety.
+    :param answer_lens: the number of tokens of each answer, including `<s>` and `</s>`
+    """
+    assert len(answer_lens) > 0, "At least one answer is required to estimate the answer length."
+    sorted_lens = sorted(answer_lens)
+    quantile_idx = min(len(sorted_lens) - 1, max(0, int(math.ceil(coverage * len(sorted_lens))) - 1))
+    return sorted_lens[quantile_idx] + margin
@@ -0,0 +1,60 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for caching the encoded tables, which are shared by all questions asked on the same table
+"""
+import hashlib
+
+import torch
+
+from tapex.common.cache import LRUCache
+
+# roughly the memory overhead of a cache entry besides its token ids, in bytes
+ENTRY_OVERHEAD = 256
+
+
+def _estimate_entry_size(key, value):
+    return ENTRY_OVERHEAD + len(key) + value.numel() * value.element_size()
+
+
+class TableEncodeCache(LRUCache):
+    """
+    A size-aware LRU cache of the token ids (i.e., BPE and dictionary lookup) of linearized tables, keyed by the hash
+    of the linearized (truncated) table. Many questions, e.g., the follow-up questions of an SQA session, are asked on
+    the same table, and only their questions need to be encoded again.
+
+    A model input is `question + " " + table`, and the GPT-2 BPE never merges across the space before the table,
+    so the token ids of the input are exactly the ids of the question followed by the cached ids of the table.
+    Note that the encoder states of the table cannot be reused in the same way: the question comes first and the
+    encoder attends bidirectionally, so every state of the table segment depends on the question.
+    A cache should only be used with one model (i.e., one BPE and one dictionary).
+    """
+
+    def __init__(self, max_size_in_bytes: int = 256 * 1024 * 1024):
+        super().__init__(max_size=max_size_in_bytes, size_func=_estimate_entry_size)
+
+    def encode(self, bart, question: str, linear_table: str) -> torch.LongTensor:
+        """
+        The same as `bart.encode(question + " " + linear_table)`, where `bart` is a fairseq `BARTHubInterface`.
+        """
+        if question[-1:].isspace():
+            # consecutive spaces are merged by the BPE, so the table segment depends on the question
+            return bart.encode(question + " " + linear_table)
+        cache_key = hashlib.sha1(linear_table.encode("utf-8")).digest()
+        table_ids = self.get(cache_key)
+        if table_ids is None:
+            table_ids = self._encode_segment(bart, " " + linear_table)
+            self.put(cache_key, table_ids)
+        question_ids = self._encode_segment(bart, question)
+        dictionary = bart.task.source_dictionary
+        # truncate the input in the same way as `bart.encode`, leaving space for `<s>` and `</s>`
+        input_ids = torch.cat([question_ids, table_ids])[:min(bart.max_positions) - 2]
+        return torch.cat([input_ids.new_tensor([dictionary.bos()]), input_ids,
+                          input_ids.new_tensor([dictionary.eos()])])
+
+    @staticmethod
+    def _encode_segment(bart, text: str) -> torch.LongTensor:
+        if text == "":
+            return torch.LongTensor([])
+        return bart.task.source_dictionary.encode_line(bart.bpe.encode(text), append_eos=False).long()
@@ -0,0 +1,260 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for serving predictions over HTTP with the standard library, including health and Prometheus metrics endpoints
+"""
+import json
+import logging
+import threading
+import time
+from concurrent.futures import wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Tuple
+
+from tapex.serving.batch_scheduler import MicroBatchScheduler
+
+logger = logging.getLogger(__name__)
+
+# the upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGES = ("preprocess", "encode", "decode")
+
+
+class RequestError(Exception):
+    """
+    An invalid request, which is answered with its HTTP status code and message.
+    """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class LatencyHistogram(object):
+    """
+    A thread-safe Prometheus histogram with a single label, rendered in the Prometheus text format.
+    """
+
+    def __init__(self, name: str, description: str, label_name: str, buckets: Tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_name = label_name
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        # label value -> (the count of each bucket, sum, count)
+        self._series = {}
+
+    def observe(self, label_value: str, value: float):
+        with self._lock:
+            if label_value not in self._series:
+                self._series[label_value] = [[0] * len(self.buckets), 0.0, 0]
+            series = self._series[label_value]
+            for idx, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series[0][idx] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        with self._lock:
+            for label_value, (bucket_counts, total, count) in sorted(self._series.items()):
+                label = '{}="{}"'.format(self.label_name, label_value)
+                for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, upper_bound, bucket_count))
+                lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label, count))
+                lines.append("{}_sum{{{}}} {}".format(self.name, label, total))
+                lines.append("{}_count{{{}}} {}".format(self.name, label, count))
+        return lines
+
+
+class PredictionServer(object):
+    """
+    A lightweight HTTP server around `TAPEXModelInterface`, which only depends on the standard library.
+    Requests of all connections share a `MicroBatchScheduler`, so that examples of concurrent requests are decoded
+    in the same batches. The endpoints are:
+        POST /predict          {"question": str, "table": {"header": [...], "rows": [[...]]}, "deadline_ms": float}
+                               -> {"answer": str}
+        POST /predict_batch    {"examples": [{"question": str, "table": {...}}, ...], "deadline_ms": float}
+                               -> {"answers": [str]}
+        GET  /healthz          -> {"status": "ok"}
+        GET  /metrics          -> the Prometheus text format
+    where `deadline_ms` is optional. The latency of each request is reported by stage: `preprocess` (truncating and
+    linearizing tables), `encode` (BPE and dictionary lookup) and `decode` (waiting for a batch and generating).
+    """
+
+    def __init__(self, model_interface, host: str = "127.0.0.1", port: int = 8080,
+                 max_request_bytes: int = 1024 * 1024, max_batch_examples: int = 64, request_timeout: float = 60.0,
+                 **scheduler_kwargs):
+        """
+        :param model_interface: a `TAPEXModelInterface`
+        :param max_request_bytes: requests with a larger body are rejected with 413
+        :param max_batch_examples: batch requests with more examples are rejected with 413
+        :param request_timeout: the longest time (in seconds) to wait for the answers of a request, after which the
+        request is answered with 504 and its examples still queued are dropped
+        :param scheduler_kwargs: the keyword arguments of `MicroBatchScheduler`, e.g., `max_wait_ms` and `decoding`
+        """
+        self.model_interface = model_interface
+        self.scheduler = MicroBatchScheduler(model_interface, **scheduler_kwargs)
+        self.max_request_bytes = max_request_bytes
+        self.max_batch_examples = max_batch_examples
+        self.request_timeout = request_timeout
+        self.stage_latency = LatencyHistogram("tapex_stage_latency_seconds",
+                                              "The latency of each stage of a request.", "stage")
+        self.request_latency = LatencyHistogram("tapex_request_latency_seconds",
+                                                "The latency of a request.", "endpoint")
+        self._counter_lock = threading.Lock()
+        self._num_responses = {}
+        self._num_examples = 0
+        self.httpd = ThreadingHTTPServer((host, port), _PredictionHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.prediction_server = self
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.httpd.server_address
+
+    def serve_forever(self):
+        logger.info("Serve predictions on http://{}:{}".format(*self.address))
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.scheduler.close()
+
+    def predict_examples(self, examples: List[Dict], deadline_ms: float = None) -> List[str]:
+        questions, table_contexts = [], []
+        for example in examples:
+            if not isinstance(example, dict) or not isinstance(example.get("question"), str) \
+                    or not isinstance(example.get("table"), dict):
+                raise RequestError(400, "Every example requires a `question` string and a `table` object.")
+            questions.append(example["question"])
+            table_contexts.append(example["table"])
+
+        start_time = time.perf_counter()
+        try:
+            linear_tables = self.model_interface.tab_processor.process_tables(table_contexts, questions,
+                                                                              [[] for _ in questions])
+        except (KeyError, TypeError, ValueError, IndexError) as e:
+            raise RequestError(400, "Cannot process the table: {!r}".format(e))
+        encode_time = time.perf_counter()
+        tokenized_inputs = self.model_interface.encode_linearized(questions, linear_tables)
+        decode_time = time.perf_counter()
+        futures = [self.scheduler.submit_encoded(tokenized_input, deadline_ms=deadline_ms)
+                   for tokenized_input in tokenized_inputs]
+        # the timeout applies to the whole request rather than to each of its examples
+        _, not_done = wait(futures, timeout=self.request_timeout)
+        if len(not_done) > 0:
+            # the queued examples are dropped by the scheduler, and the running ones are left to finish
+            for future in not_done:
+                future.cancel()
+            raise RequestError(504, "The prediction did not finish in {} seconds.".format(self.request_timeout))
+        answers = [future.result() for future in futures]
+        end_time = time.perf_counter()
+
+        self.stage_latency.observe("preprocess", encode_time - start_time)
+        self.stage_latency.observe("encode", decode_time - encode_time)
+        self.stage_latency.observe("decode", end_time - decode_time)
+        with self._counter_lock:
+            self._num_examples += len(examples)
+        return answers
+
+    def count_response(self, endpoint: str, status: int, latency: float):
+        self.request_latency.observe(endpoint, latency)
+        with self._counter_lock:
+            self._num_responses[(endpoint, status)] = self._num_responses.get((endpoint, status), 0) + 1
+
+    def render_metrics(self) -> str:
+        lines = self.stage_latency.render() + self.request_latency.render()
+        with self._counter_lock:
+            lines += ["# HELP tapex_responses_total The number of responses by endpoint and status code.",
+                      "# TYPE tapex_responses_total counter"]
+            for (endpoint, status), count in sorted(self._num_responses.items()):
+                lines.append('tapex_responses_total{{endpoint="{}",status="{}"}} {}'.format(endpoint, status, count))
+            lines += ["# HELP tapex_examples_total The number of predicted examples.",
+                      "# TYPE tapex_examples_total counter",
+                      "tapex_examples_total {}".format(self._num_examples)]
+        scheduler_stats = self.scheduler.stats()
+        for name in ["queue_size", "avg_batch_size", "avg_fill_ratio"]:
+            lines += ["# TYPE tapex_scheduler_{} gauge".format(name),
+                      "tapex_scheduler_{} {}".format(name, scheduler_stats[name])]
+        return "\n".join(lines) + "\n"
+
+
+class _PredictionHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        start_time = time.perf_counter()
+        server = self.server.prediction_server
+        if self.path == "/healthz":
+            status = self._send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            status = self._send(200, server.render_metrics().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            status = self._send_json(404, {"error": "Unknown endpoint `{}`.".format(self.path)})
+        server.count_response(self.path if status != 404 else "unknown", status, time.perf_counter() - start_time)
+
+    def do_POST(self):
+        start_time = time.perf_counter()
+        server = self.server.prediction_server
+        try:
+            if self.path not in ["/predict", "/predict_batch"]:
+                raise RequestError(404, "Unknown endpoint `{}`.".format(self.path))
+            request = self._read_json(server.max_request_bytes)
+            deadline_ms = request.get("deadline_ms")
+            if deadline_ms is not None and not isinstance(deadline_ms, (int, float)):
+                raise RequestError(400, "`deadline_ms` should be a number.")
+            if self.path == "/predict":
+                answers = server.predict_examples([request], deadline_ms=deadline_ms)
+                status = self._send_json(200, {"answer": answers[0]})
+            else:
+                examples = request.get("examples")
+                if not isinstance(examples, list) or len(examples) == 0:
+                    raise RequestError(400, "`examples` should be a non-empty list.")
+                if len(examples) > server.max_batch_examples:
+                    raise RequestError(413, "At most {} examples are allowed in a request.".format(
+                        server.max_batch_examples))
+                answers = server.predict_examples(examples, deadline_ms=deadline_ms)
+                status = self._send_json(200, {"answers": answers})
+        except RequestError as e:
+            status = self._send_json(e.status, {"error": e.message})
+        except Exception as e:
+            logger.exception("Failed to serve a request on `{}`".format(self.path))
+            status = self._send_json(500, {"error": repr(e)})
+        server.count_response(self.path if status != 404 else "unknown", status, time.perf_counter() - start_time)
+
+    def _read_json(self, max_request_bytes: int) -> Dict:
+        try:
+            content_length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            raise RequestError(411, "The request requires a `Content-Length`.")
+        if content_length < 0:
+            raise RequestError(400, "The `Content-Length` should not be negative.")
+        if content_length > max_request_bytes:
+            raise RequestError(413, "The request body exceeds {} bytes.".format(max_request_bytes))
+        try:
+            request = json.loads(self.rfile.read(content_length).decode("utf-8"))
+        except (UnicodeDecodeError, ValueError):
+            raise RequestError(400, "The request body is not valid JSON.")
+        if not isinstance(request, dict):
+            raise RequestError(400, "The request body should be a JSON object.")
+        return request
+
+    def _send_json(self, status: int, body: Dict) -> int:
+        return self._send(status, json.dumps(body, ensure_ascii=False).encode("utf-8"), "application/json")
+
+    def _send(self, status: int, body: bytes, content_type: str) -> int:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return status
+
+    def log_message(self, format, *args):
+        # the access log is verbose under load, so it is only kept at the debug level
+        logger.debug("%s - %s", self.address_string(), format % args)
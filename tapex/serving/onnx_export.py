@@ -0,0 +1,136 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for exporting a fine-tuned TAPEX (BART) checkpoint into ONNX graphs which run without fairseq
+"""
+import json
+import logging
+import os
+import shutil
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+ENCODER_FILE = "encoder.onnx"
+DECODER_FILE = "decoder.onnx"
+CONFIG_FILE = "onnx_config.json"
+DICT_FILE = "dict.src.txt"
+
+
+class _EncoderWrapper(torch.nn.Module):
+
+    def __init__(self, encoder, padding_idx: int):
+        super().__init__()
+        self.encoder = encoder
+        self.padding_idx = padding_idx
+
+    def forward(self, src_tokens):
+        src_lengths = src_tokens.ne(self.padding_idx).long().sum(dim=1)
+        encoder_out = self.encoder(src_tokens, src_lengths=src_lengths)
+        return encoder_out["encoder_out"][0], encoder_out["encoder_padding_mask"][0]
+
+
+class _DecoderWrapper(torch.nn.Module):
+    """
+    One decoding step without incremental states: the whole prefix is decoded again, and only the log-probabilities
+    of the last position are returned. Answers are a few tokens, so recomputing the prefix costs little.
+    """
+
+    def __init__(self, decoder):
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, prev_output_tokens, encoder_out, encoder_padding_mask):
+        decoder_out, _ = self.decoder(prev_output_tokens, encoder_out={
+            "encoder_out": [encoder_out],
+            "encoder_padding_mask": [encoder_padding_mask],
+            "encoder_embedding": [],
+            "encoder_states": [],
+            "src_tokens": [],
+            "src_lengths": []
+        })
+        return torch.log_softmax(decoder_out[:, -1, :].float(), dim=-1)
+
+
+def export_onnx(resource_dir: str, checkpoint_name: str, output_dir: str, opset_version: int = 14):
+    """
+    Export the encoder and the decoder of a checkpoint into `output_dir`, together with the dictionary, the BPE files
+    and the generation config, which is everything `ONNXBARTModel` needs.
+    """
+    from fairseq.models.bart import BARTModel
+
+    bart = BARTModel.from_pretrained(model_name_or_path=resource_dir, checkpoint_file=checkpoint_name)
+    bart.eval()
+    model = bart.model
+    dictionary = bart.task.source_dictionary
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    # the causal mask of the decoder is cached and sliced by the target length, and tracing would freeze the cache of
+    # the example length into the graph, so build the cache for all positions beforehand
+    max_decoder_positions = model.decoder.max_positions()
+    model.decoder._future_mask = torch.triu(
+        torch.full([max_decoder_positions, max_decoder_positions], float("-inf")), 1)
+
+    # the example batch must contain padding, since fairseq only masks the padding when there is any
+    src_tokens = torch.LongTensor([[dictionary.bos(), 100, 101, 102, 103, dictionary.eos()],
+                                   [dictionary.bos(), 100, 101, dictionary.eos(), dictionary.pad(), dictionary.pad()]])
+    # the export restores the training mode of the wrappers (and so of the model), thus they must be in eval mode
+    encoder_wrapper = _EncoderWrapper(model.encoder, dictionary.pad()).eval()
+    encoder_path = os.path.join(output_dir, ENCODER_FILE)
+    with torch.no_grad():
+        torch.onnx.export(encoder_wrapper, (src_tokens,), encoder_path,
+                          input_names=["src_tokens"],
+                          output_names=["encoder_out", "encoder_padding_mask"],
+                          dynamic_axes={"src_tokens": {0: "batch", 1: "src_len"},
+                                        "encoder_out": {0: "src_len", 1: "batch"},
+                                        "encoder_padding_mask": {0: "batch", 1: "src_len"}},
+                          opset_version=opset_version)
+        encoder_out, encoder_padding_mask = encoder_wrapper(src_tokens)
+    logger.info("Export the encoder into `{}`".format(encoder_path))
+
+    prev_output_tokens = torch.LongTensor([[dictionary.eos(), dictionary.bos(), 100],
+                                           [dictionary.eos(), dictionary.bos(), 101]])
+    decoder_wrapper = _DecoderWrapper(model.decoder).eval()
+    decoder_path = os.path.join(output_dir, DECODER_FILE)
+    with torch.no_grad():
+        torch.onnx.export(decoder_wrapper, (prev_output_tokens, encoder_out, encoder_padding_mask), decoder_path,
+                          input_names=["prev_output_tokens", "encoder_out", "encoder_padding_mask"],
+                          output_names=["lprobs"],
+                          dynamic_axes={"prev_output_tokens": {0: "batch", 1: "tgt_len"},
+                                        "encoder_out": {0: "src_len", 1: "batch"},
+                                        "encoder_padding_mask": {0: "batch", 1: "src_len"},
+                                        "lprobs": {0: "batch"}},
+                          opset_version=opset_version)
+    logger.info("Export the decoder into `{}`".format(decoder_path))
+
+    # restore the lazily built causal mask of the decoder
+    model.decoder._future_mask = torch.empty(0)
+
+    dictionary.save(os.path.join(output_dir, DICT_FILE))
+    for bpe_file in ["encoder.json", "vocab.bpe"]:
+        if os.path.exists(os.path.join(resource_dir, bpe_file)):
+            shutil.copy(os.path.join(resource_dir, bpe_file), os.path.join(output_dir, bpe_file))
+        else:
+            logger.warning("Cannot find `{}` in `{}`, please put it into `{}`".format(bpe_file, resource_dir,
+                                                                                      output_dir))
+    generation_cfg = bart.cfg.generation
+    onnx_config = {
+        "max_source_positions": min(bart.max_positions),
+        "max_decoder_positions": max_decoder_positions,
+        "bos": dictionary.bos(),
+        "pad": dictionary.pad(),
+        "eos": dictionary.eos(),
+        "unk": dictionary.unk(),
+        "generation": {
+            "max_len_a": generation_cfg.max_len_a,
+            "max_len_b": generation_cfg.max_len_b,
+            "min_len": generation_cfg.min_len,
+            "lenpen": generation_cfg.lenpen
+        }
+    }
+    with open(os.path.join(output_dir, CONFIG_FILE), "w", encoding="utf8") as config_f:
+        json.dump(onnx_config, config_f, indent=2)
+    return bart
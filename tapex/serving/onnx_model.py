@@ -0,0 +1,259 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for running the ONNX graphs exported by `export_onnx` with ONNX Runtime, without importing fairseq
+"""
+import json
+import logging
+import os
+import re
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+from tapex.processor.lazy_tokenizer import get_shared_tokenizer
+from tapex.serving.onnx_export import CONFIG_FILE, DECODER_FILE, DICT_FILE, ENCODER_FILE
+
+logger = logging.getLogger(__name__)
+
+SPACE_NORMALIZER = re.compile(r"\s+")
+
+
+class TokenDictionary(object):
+    """
+    A read-only counterpart of the fairseq `Dictionary`, mapping BPE symbols to the indices of the model.
+    """
+
+    def __init__(self, dict_path: str, bos: int = 0, pad: int = 1, eos: int = 2, unk: int = 3):
+        # the special symbols come first, in the same order as fairseq
+        self.symbols = ["<s>", "<pad>", "</s>", "<unk>"]
+        self.bos_index, self.pad_index, self.eos_index, self.unk_index = bos, pad, eos, unk
+        with open(dict_path, "r", encoding="utf8") as dict_f:
+            for line in dict_f:
+                symbol, field = line.rstrip().rsplit(" ", 1)
+                if field == "#fairseq:overwrite":
+                    symbol, _ = symbol.rsplit(" ", 1)
+                self.symbols.append(symbol)
+        self.indices = {symbol: idx for idx, symbol in enumerate(self.symbols)}
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def bos(self):
+        return self.bos_index
+
+    def pad(self):
+        return self.pad_index
+
+    def eos(self):
+        return self.eos_index
+
+    def unk(self):
+        return self.unk_index
+
+    def index(self, symbol: str) -> int:
+        return self.indices.get(symbol, self.unk_index)
+
+    def encode_line(self, line: str, append_eos: bool = True) -> torch.IntTensor:
+        symbols = SPACE_NORMALIZER.sub(" ", line).strip().split()
+        ids = [self.index(symbol) for symbol in symbols]
+        if append_eos:
+            ids.append(self.eos_index)
+        return torch.IntTensor(ids)
+
+    def string(self, tensor) -> str:
+        return " ".join(self.symbols[idx] for idx in tensor.tolist()
+                        if idx not in (self.bos_index, self.eos_index))
+
+
+class GPT2BPE(object):
+    """
+    The GPT-2 BPE of fairseq on top of the fast tokenizer, where a token is written as its GPT-2 id.
+    """
+
+    def __init__(self, resource_dir: str):
+        self.tokenizer = get_shared_tokenizer(resource_dir)
+
+    def encode(self, text: str) -> str:
+        return " ".join(str(token_id) for token_id in self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def decode(self, text: str) -> str:
+        token_ids = [int(token) for token in text.split() if token.isdigit()]
+        return self.tokenizer.decode(token_ids, clean_up_tokenization_spaces=False)
+
+
+class _ONNXTask(object):
+
+    def __init__(self, dictionary: TokenDictionary):
+        self.source_dictionary = dictionary
+        self.target_dictionary = dictionary
+
+
+class ONNXBARTModel(object):
+    """
+    Run an exported model on CPU with ONNX Runtime. It keeps the parts of the fairseq `BARTHubInterface` used by
+    `TAPEXModelInterface` (`encode`, `decode`, `generate`, `bpe`, `task` and `max_positions`), and its beam search
+    follows the `SequenceGenerator` of fairseq, so that both return the same hypotheses.
+    Loading it does not import fairseq, and the per-step overhead is a single call of the decoder graph.
+    """
+
+    def __init__(self, model_dir: str, num_threads: int = None):
+        """
+        :param model_dir: the output directory of `export_onnx`
+        :param num_threads: the number of intra-op threads of ONNX Runtime, all cores by default
+        """
+        # onnxruntime is an optional dependency, which is only required by this backend
+        import onnxruntime
+
+        with open(os.path.join(model_dir, CONFIG_FILE), "r", encoding="utf8") as config_f:
+            self.config = json.load(config_f)
+        dictionary = TokenDictionary(os.path.join(model_dir, DICT_FILE), bos=self.config["bos"],
+                                     pad=self.config["pad"], eos=self.config["eos"], unk=self.config["unk"])
+        self.task = _ONNXTask(dictionary)
+        self.bpe = GPT2BPE(model_dir)
+        self.max_positions = (self.config["max_source_positions"], self.config["max_decoder_positions"])
+        session_options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            session_options.intra_op_num_threads = num_threads
+            session_options.inter_op_num_threads = 1
+        self.encoder_session = onnxruntime.InferenceSession(os.path.join(model_dir, ENCODER_FILE), session_options,
+                                                            providers=["CPUExecutionProvider"])
+        self.decoder_session = onnxruntime.InferenceSession(os.path.join(model_dir, DECODER_FILE), session_options,
+                                                            providers=["CPUExecutionProvider"])
+        logger.info("Load the ONNX model from `{}`".format(model_dir))
+
+    def encode(self, sentence: str) -> torch.LongTensor:
+        tokens = self.bpe.encode(sentence)
+        if len(tokens.split(" ")) > min(self.max_positions) - 2:
+            tokens = " ".join(tokens.split(" ")[:min(self.max_positions) - 2])
+        return self.task.source_dictionary.encode_line("<s> " + tokens + " </s>", append_eos=False).long()
+
+    def decode(self, tokens: torch.LongTensor) -> str:
+        dictionary = self.task.source_dictionary
+        tokens = tokens.cpu().numpy()
+        if tokens[0] == dictionary.bos():
+            tokens = tokens[1:]
+        eos_mask = tokens == dictionary.eos()
+        doc_mask = eos_mask[1:] & eos_mask[:-1]
+        sentences = np.split(tokens, doc_mask.nonzero()[0] + 1)
+        sentences = [self.bpe.decode(dictionary.string(sentence)) for sentence in sentences]
+        if len(sentences) == 1:
+            return sentences[0]
+        return sentences
+
+    def generate(self, tokenized_sentences: List[torch.LongTensor], beam: int = 5, max_len_a: float = None,
+                 max_len_b: int = None, min_len: int = None, lenpen: float = None) -> List[List[Dict]]:
+        """
+        Decode a batch of encoded inputs, and return the `beam` hypotheses of each input from the best to the worst.
+        """
+        generation_cfg = self.config["generation"]
+        max_len_a = generation_cfg["max_len_a"] if max_len_a is None else max_len_a
+        max_len_b = generation_cfg["max_len_b"] if max_len_b is None else max_len_b
+        min_len = generation_cfg["min_len"] if min_len is None else min_len
+        lenpen = generation_cfg["lenpen"] if lenpen is None else lenpen
+
+        dictionary = self.task.source_dictionary
+        src_len = max(len(tokens) for tokens in tokenized_sentences)
+        src_tokens = np.full((len(tokenized_sentences), src_len), dictionary.pad(), dtype=np.int64)
+        for idx, tokens in enumerate(tokenized_sentences):
+            src_tokens[idx, :len(tokens)] = tokens.numpy()
+        max_len = min(int(max_len_a * src_len + max_len_b), self.max_positions[1] - 1)
+        return self._beam_search(src_tokens, beam, max_len, min_len, lenpen)
+
+    def _beam_search(self, src_tokens: np.ndarray, beam: int, max_len: int, min_len: int,
+                     lenpen: float) -> List[List[Dict]]:
+        dictionary = self.task.source_dictionary
+        bos, pad, eos = dictionary.bos(), dictionary.pad(), dictionary.eos()
+        encoder_out, encoder_padding_mask = self.encoder_session.run(None, {"src_tokens": src_tokens})
+
+        bsz = src_tokens.shape[0]
+        cand_size = 2 * beam
+        tokens = np.full((bsz * beam, max_len + 2), pad, dtype=np.int64)
+        tokens[:, 0] = eos
+        scores = np.zeros((bsz * beam, max_len + 1), dtype=np.float32)
+        finalized = [[] for _ in range(bsz)]
+        # the original index of each sentence still being decoded
+        sent_ids = np.arange(bsz)
+        cands_to_ignore = np.zeros((bsz, beam), dtype=bool)
+
+        for step in range(max_len + 1):
+            # all hypotheses of a sentence share its encoder states
+            state_ids = np.repeat(sent_ids, beam)
+            lprobs = self.decoder_session.run(None, {
+                "prev_output_tokens": tokens[:, :step + 1],
+                "encoder_out": encoder_out[:, state_ids],
+                "encoder_padding_mask": encoder_padding_mask[state_ids]
+            })[0]
+            vocab_size = lprobs.shape[1]
+            lprobs[np.isnan(lprobs)] = -np.inf
+            lprobs[:, pad] = -np.inf
+            if step >= max_len:
+                lprobs[:, :eos] = -np.inf
+                lprobs[:, eos + 1:] = -np.inf
+            if step == 0 and step < max_len:
+                # BART always starts an answer with `<s>`
+                bos_lprobs = lprobs[:, bos].copy()
+                lprobs[:] = -np.inf
+                lprobs[:, bos] = bos_lprobs
+            elif step < min_len:
+                lprobs[:, eos] = -np.inf
+
+            lprobs = lprobs.reshape(bsz, beam, vocab_size)
+            if step == 0:
+                lprobs = lprobs[:, :1, :]
+            else:
+                lprobs = lprobs + scores.reshape(bsz, beam, -1)[:, :, step - 1:step]
+            flat_lprobs = lprobs.reshape(bsz, -1)
+            num_cands = min(cand_size, flat_lprobs.shape[1] - 1)
+            cand_flat_ids = np.argsort(-flat_lprobs, axis=1, kind="stable")[:, :num_cands]
+            cand_scores = np.take_along_axis(flat_lprobs, cand_flat_ids, axis=1)
+            cand_beams = cand_flat_ids // vocab_size
+            cand_indices = cand_flat_ids % vocab_size
+            cand_bbsz_idx = cand_beams + np.arange(bsz)[:, None] * beam
+
+            eos_mask = (cand_indices == eos) & (cand_scores != -np.inf)
+            eos_mask[:, :beam][cands_to_ignore] = False
+            eos_rows, eos_cands = np.nonzero(eos_mask[:, :beam])
+            for row, cand in zip(eos_rows, eos_cands):
+                sent_id = sent_ids[row]
+                if len(finalized[sent_id]) >= beam:
+                    continue
+                hypo_tokens = tokens[cand_bbsz_idx[row, cand], 1:step + 2].copy()
+                hypo_tokens[step] = eos
+                hypo_score = cand_scores[row, cand] / np.float32((step + 1) ** lenpen)
+                finalized[sent_id].append({"tokens": torch.from_numpy(hypo_tokens),
+                                           "score": torch.tensor(hypo_score)})
+            # a sentence is finished once it has `beam` hypotheses
+            finished_sents = [row for row in np.unique(eos_rows)
+                              if len(finalized[sent_ids[row]]) == beam or step == max_len]
+            if len(finished_sents) == bsz or step >= max_len:
+                break
+
+            if len(finished_sents) > 0:
+                batch_ids = np.array([row for row in range(bsz) if row not in finished_sents])
+                eos_mask = eos_mask[batch_ids]
+                cand_beams = cand_beams[batch_ids]
+                cand_scores = cand_scores[batch_ids]
+                cand_indices = cand_indices[batch_ids]
+                cands_to_ignore = cands_to_ignore[batch_ids]
+                sent_ids = sent_ids[batch_ids]
+                tokens = tokens.reshape(bsz, -1)[batch_ids].reshape(len(batch_ids) * beam, -1)
+                scores = scores.reshape(bsz, -1)[batch_ids].reshape(len(batch_ids) * beam, -1)
+                bsz = len(batch_ids)
+                cand_bbsz_idx = cand_beams + np.arange(bsz)[:, None] * beam
+
+            # keep the best `beam` candidates which do not end, finished ones are moved to the end
+            eos_mask[:, :beam] = cands_to_ignore | eos_mask[:, :beam]
+            active_mask = eos_mask.astype(np.int64) * cand_size + np.arange(eos_mask.shape[1])
+            active_hypos = np.argsort(active_mask, axis=1, kind="stable")[:, :beam]
+            cands_to_ignore = np.take_along_axis(active_mask, active_hypos, axis=1) >= cand_size
+            active_bbsz_idx = np.take_along_axis(cand_bbsz_idx, active_hypos, axis=1).reshape(-1)
+            tokens[:, :step + 1] = tokens[active_bbsz_idx, :step + 1]
+            tokens.reshape(bsz, beam, -1)[:, :, step + 1] = np.take_along_axis(cand_indices, active_hypos, axis=1)
+            if step > 0:
+                scores[:, :step] = scores[active_bbsz_idx, :step]
+            scores.reshape(bsz, beam, -1)[:, :, step] = np.take_along_axis(cand_scores, active_hypos, axis=1)
+
+        return [sorted(hypos, key=lambda hypo: -float(hypo["score"])) for hypos in finalized]
@@ -0,0 +1,140 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for memoizing predictions in memory and on disk, so that identical requests are never decoded twice
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from tapex.common.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+def checkpoint_identity(checkpoint_path: str) -> str:
+    """
+    Identify a checkpoint by its path, size and modification time, which changes whenever the checkpoint is
+    replaced but does not require reading a checkpoint of gigabytes.
+    """
+    checkpoint_path = os.path.abspath(checkpoint_path)
+    if not os.path.exists(checkpoint_path):
+        return checkpoint_path
+    stat = os.stat(checkpoint_path)
+    return "{}:{}:{}".format(checkpoint_path, stat.st_size, int(stat.st_mtime))
+
+
+class PredictionCache(object):
+    """
+    A two-tier cache of predicted answers: a thread-safe in-memory LRU tier in front of an optional sqlite file
+    which survives restarts and can be shared by processes on the same machine.
+    An entry is keyed by a stable hash of the question, the linearized table, the checkpoint identity and the
+    decoding parameters, so a prediction is only reused when the model would see exactly the same input.
+    Entries of other checkpoints are never hit, and they can be removed by `invalidate` or `prune`.
+    """
+
+    def __init__(self, db_path: str = None, max_memory_entries: int = 65536):
+        """
+        :param db_path: the path of the sqlite file, the on-disk tier is disabled if not provided
+        :param max_memory_entries: the maximum number of answers kept in memory
+        """
+        self.memory_cache = LRUCache(max_size=max_memory_entries)
+        self.db_path = db_path
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self._db = None
+        self._db_lock = threading.Lock()
+        if db_path is not None:
+            db_dir = os.path.dirname(os.path.abspath(db_path))
+            if not os.path.exists(db_dir):
+                os.makedirs(db_dir)
+            # the connection is shared by threads, and every access is guarded by the lock
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS predictions ("
+                             "key TEXT PRIMARY KEY, model TEXT NOT NULL, answer TEXT NOT NULL, created REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS predictions_model ON predictions (model)")
+            self._db.commit()
+
+    @staticmethod
+    def build_key(question: str, linear_table: str, model_identity: str, **decode_params) -> str:
+        """
+        The question and the table are lower-cased in the same way as the model input.
+        """
+        key_parts = [question.lower(), linear_table.lower(), model_identity, sorted(decode_params.items())]
+        return hashlib.sha256(json.dumps(key_parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        answer = self.memory_cache.get(key)
+        if answer is not None or self._db is None:
+            return answer
+        with self._db_lock:
+            row = self._db.execute("SELECT answer FROM predictions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.disk_misses += 1
+                return None
+            self.disk_hits += 1
+        # promote the answer to the memory tier
+        self.memory_cache.put(key, row[0])
+        return row[0]
+
+    def put(self, key: str, answer: str, model_identity: str = ""):
+        self.memory_cache.put(key, answer)
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO predictions (key, model, answer, created) VALUES (?, ?, ?, ?)",
+                             (key, model_identity, answer, time.time()))
+            self._db.commit()
+
+    def invalidate(self, model_identity: str = None):
+        """
+        Remove the entries of a checkpoint, or all entries if `model_identity` is not provided.
+        """
+        # the memory tier does not know the checkpoint of its entries, and it is cheap to warm up again
+        self.memory_cache.clear()
+        if self._db is None:
+            return
+        with self._db_lock:
+            if model_identity is None:
+                self._db.execute("DELETE FROM predictions")
+            else:
+                self._db.execute("DELETE FROM predictions WHERE model = ?", (model_identity,))
+            self._db.commit()
+
+    def prune(self, model_identity: str):
+        """
+        Remove the entries of all checkpoints except `model_identity`, e.g., after a model is updated.
+        """
+        if self._db is None:
+            return
+        with self._db_lock:
+            deleted = self._db.execute("DELETE FROM predictions WHERE model != ?", (model_identity,)).rowcount
+            self._db.commit()
+        logger.info("Remove {} stale predictions from `{}`".format(deleted, self.db_path))
+
+    def stats(self) -> Dict:
+        cache_stats = {"memory": self.memory_cache.stats()}
+        if self._db is not None:
+            with self._db_lock:
+                entries = self._db.execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
+                total = self.disk_hits + self.disk_misses
+                cache_stats["disk"] = {
+                    "hits": self.disk_hits,
+                    "misses": self.disk_misses,
+                    "hit_rate": self.disk_hits / total if total > 0 else 0.0,
+                    "entries": entries
+                }
+        return cache_stats
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,351 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+"""
+Utils for serving a model interface with a pool of processes, so that a many-core host is not bounded by the GIL
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List
+
+import torch
+
+from tapex.serving.cpu_inference import set_cpu_threads
+from tapex.serving.decoding import DecodingConfig
+
+logger = logging.getLogger(__name__)
+
+# the message which tells the next stage that a process of the previous stage has exited
+_STOP = None
+# the interval (in seconds) of checking whether a worker process has died
+_MONITOR_INTERVAL = 1.0
+
+
+def _pin_to_cores(cores: List[int]):
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    else:
+        logger.warning("Cannot pin processes to cores on this platform")
+
+
+def _preprocess_loop(worker_idx, model_interface, preprocess_queue, encoded_queue, current_requests):
+    while True:
+        message = preprocess_queue.get()
+        if message is _STOP:
+            encoded_queue.put(_STOP)
+            return
+        request_id, question, table_context = message
+        # recorded so that the pool can fail the request if this process dies
+        current_requests[worker_idx] = request_id
+        try:
+            # token ids are sent as plain lists, which are cheaper to pickle than tensors for a short input
+            token_ids = model_interface.encode_examples([question], [table_context])[0].tolist()
+            encoded_queue.put((request_id, token_ids, None))
+        except Exception as e:
+            logger.exception("Failed to preprocess request {}".format(request_id))
+            encoded_queue.put((request_id, None, repr(e)))
+        current_requests[worker_idx] = -1
+
+
+def _model_loop(worker_id, model_interface, model_factory, model_queue, result_queue, num_threads, cores,
+                max_batch_tokens, max_batch_size, decoding):
+    if cores is not None:
+        _pin_to_cores(cores)
+    set_cpu_threads(num_threads=num_threads, num_interop_threads=1)
+    if model_interface is None:
+        model_interface = model_factory()
+    stopped = False
+    while not stopped:
+        messages = [model_queue.get()]
+        # take the requests which are already waiting to share the batch, without waiting for more
+        while messages[-1] is not _STOP and len(messages) < max_batch_size:
+            try:
+                messages.append(model_queue.get_nowait())
+            except queue.Empty:
+                break
+        if messages[-1] is _STOP:
+            stopped = True
+            messages = messages[:-1]
+        if len(messages) == 0:
+            continue
+        request_ids = [request_id for request_id, _ in messages]
+        try:
+            answers = model_interface.generate_batch([torch.LongTensor(token_ids) for _, token_ids in messages],
+                                                     max_tokens=max_batch_tokens, decoding=decoding)
+        except Exception as e:
+            logger.exception("Failed to run a batch of {} requests in worker {}".format(len(messages), worker_id))
+            answers, error = [None] * len(messages), repr(e)
+        else:
+            error = None
+        for request_id, answer in zip(request_ids, answers):
+            result_queue.put((worker_id, request_id, answer, error))
+    result_queue.put((worker_id, _STOP, None, None))
+
+
+class WorkerPool(object):
+    """
+    Serve predictions with several model processes forked from one model interface, which scales to hosts of
+    dozens of cores, where a single process is bounded by the GIL and by the parallelism of small batches.
+    Requests are preprocessed (truncation, linearization and BPE) in separate processes, then routed to the model
+    worker with the fewest requests in flight, which decodes all requests waiting in its queue as one batch.
+    By default the weights are moved to shared memory before forking, so all model workers read a single copy.
+    Forking requires a platform which supports the `fork` start method (e.g., Linux), and the pool is meant for
+    CPU hosts, since CUDA cannot be used in forked processes.
+    If a worker process dies (e.g., killed for running out of memory), the requests it holds fail with a
+    `RuntimeError`, and the remaining model workers serve the new requests.
+    """
+
+    def __init__(self, model_factory: Callable, num_workers: int = None, num_threads_per_worker: int = None,
+                 num_preprocess_workers: int = 2, share_weights: bool = True, pin_cores: bool = False,
+                 max_batch_tokens: int = 4096, max_batch_size: int = 64, decoding: DecodingConfig = None):
+        """
+        :param model_factory: a function without arguments which creates a `TAPEXModelInterface`, it is called
+        once in this process, and once more in each model worker if `share_weights` is false
+        :param num_workers: the number of model processes, one per 4 cores by default
+        :param num_threads_per_worker: the number of intra-op threads of each model process, which defaults to an
+        even split of all cores among model processes
+        :param num_preprocess_workers: the number of preprocessing processes
+        :param share_weights: if true, all model processes share the weights of the model created in this process,
+        otherwise every model process creates its own model by `model_factory` (e.g., for the ONNX backend, whose
+        sessions cannot be used across a fork)
+        :param pin_cores: if true, pin each model process to its own `num_threads_per_worker` cores
+        :param max_batch_tokens: the maximum padded tokens of a batch
+        :param max_batch_size: the maximum number of requests in a batch
+        :param decoding: the decoding settings of all requests, a beam search of size 5 by default
+        """
+        num_cores = os.cpu_count() or 1
+        self.num_workers = num_workers if num_workers is not None else max(1, num_cores // 4)
+        self.num_threads_per_worker = num_threads_per_worker if num_threads_per_worker is not None \
+            else max(1, num_cores // self.num_workers)
+        self.decoding = decoding if decoding is not None else DecodingConfig()
+        self.model_interface = model_factory()
+        shared_model = self.model_interface
+        if share_weights and not isinstance(self.model_interface.model, torch.nn.Module):
+            logger.warning("Cannot share the weights of {}, load a model in each worker instead".format(
+                type(self.model_interface.model).__name__))
+            share_weights = False
+        if share_weights:
+            self.model_interface.model.share_memory()
+        else:
+            shared_model = None
+
+        context = multiprocessing.get_context("fork")
+        self._preprocess_queue = context.Queue()
+        self._encoded_queue = context.Queue()
+        self._result_queue = context.Queue()
+        self._model_queues = [context.Queue() for _ in range(self.num_workers)]
+        # the id of the request each preprocessing process is working on, -1 if idle
+        self._preprocess_requests = context.Array("q", [-1] * num_preprocess_workers, lock=False)
+        # all processes are forked before any thread of this pool is started
+        self._preprocess_workers = [
+            context.Process(target=_preprocess_loop, name="tapex-preprocess-{}".format(idx), daemon=True,
+                            args=(idx, self.model_interface, self._preprocess_queue, self._encoded_queue,
+                                  self._preprocess_requests))
+            for idx in range(num_preprocess_workers)]
+        self._model_workers = []
+        for worker_id in range(self.num_workers):
+            cores = None
+            if pin_cores:
+                first_core = worker_id * self.num_threads_per_worker % num_cores
+                cores = [(first_core + offset) % num_cores for offset in range(self.num_threads_per_worker)]
+            self._model_workers.append(context.Process(
+                target=_model_loop, name="tapex-model-{}".format(worker_id), daemon=True,
+                args=(worker_id, shared_model, model_factory, self._model_queues[worker_id], self._result_queue,
+                      self.num_threads_per_worker, cores, max_batch_tokens, max_batch_size, self.decoding)))
+        for process in self._preprocess_workers + self._model_workers:
+            process.start()
+
+        self._request_ids = itertools.count()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._closed = False
+        self._in_flight = [0] * self.num_workers
+        self._num_served = [0] * self.num_workers
+        # the ids of the requests routed to each model worker and not answered yet
+        self._worker_requests = [set() for _ in range(self.num_workers)]
+        self._worker_alive = [True] * self.num_workers
+        self._dispatcher = threading.Thread(target=self._dispatch, name="tapex-pool-dispatcher", daemon=True)
+        self._collector = threading.Thread(target=self._collect, name="tapex-pool-collector", daemon=True)
+        self._dispatcher.start()
+        self._collector.start()
+        logger.info("Start {} model workers with {} threads each, and {} preprocessing workers".format(
+            self.num_workers, self.num_threads_per_worker, num_preprocess_workers))
+
+    def submit(self, question: str, table_context: Dict) -> Future:
+        """
+        Thread-safe way to enqueue a prediction, the returned future resolves to the answer string.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The pool has been closed and cannot accept new requests.")
+            request_id = next(self._request_ids)
+            self._futures[request_id] = future
+        self._preprocess_queue.put((request_id, question, table_context))
+        return future
+
+    def predict(self, question: str, table_context: Dict, timeout: float = None) -> List[str]:
+        """
+        Blocking prediction, which has the same return value as `TAPEXModelInterface.predict`.
+        """
+        return [self.submit(question, table_context).result(timeout=timeout)]
+
+    def predict_batch(self, questions: List[str], table_contexts: List[Dict], timeout: float = None) -> List[str]:
+        """
+        Blocking prediction of many pairs, which has the same return value as `TAPEXModelInterface.predict_batch`.
+        """
+        futures = [self.submit(question, table_context) for question, table_context in zip(questions, table_contexts)]
+        return [future.result(timeout=timeout) for future in futures]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "num_workers": self.num_workers,
+                "num_threads_per_worker": self.num_threads_per_worker,
+                "num_pending": len(self._futures),
+                "in_flight": list(self._in_flight),
+                "num_served": list(self._num_served),
+                "num_dead_workers": self._worker_alive.count(False)
+            }
+
+    def close(self, wait: bool = True):
+        """
+        Stop accepting new requests. The requests already submitted will still be served before workers exit.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        for _ in self._preprocess_workers:
+            self._preprocess_queue.put(_STOP)
+        if wait:
+            self._dispatcher.join()
+            self._collector.join()
+            for process in self._preprocess_workers + self._model_workers:
+                process.join()
+
+    def _dispatch(self):
+        num_stopped = 0
+        dead_workers = set()
+        next_check_time = time.perf_counter() + _MONITOR_INTERVAL
+        while num_stopped < len(self._preprocess_workers):
+            if time.perf_counter() >= next_check_time:
+                num_stopped += self._check_preprocess_workers(dead_workers)
+                next_check_time = time.perf_counter() + _MONITOR_INTERVAL
+            try:
+                message = self._encoded_queue.get(timeout=_MONITOR_INTERVAL)
+            except queue.Empty:
+                continue
+            if message is _STOP:
+                num_stopped += 1
+                continue
+            request_id, token_ids, error = message
+            if error is not None:
+                self._resolve(request_id, None, error)
+                continue
+            with self._lock:
+                live_workers = [idx for idx in range(self.num_workers) if self._worker_alive[idx]]
+                if len(live_workers) > 0:
+                    worker_id = min(live_workers, key=lambda idx: self._in_flight[idx])
+                    self._in_flight[worker_id] += 1
+                    self._worker_requests[worker_id].add(request_id)
+            if len(live_workers) == 0:
+                self._resolve(request_id, None, "all model workers have exited")
+                continue
+            self._model_queues[worker_id].put((request_id, token_ids))
+        # only requests lost with the dead preprocessing processes are left unrouted, and no more can be served
+        with self._lock:
+            self._closed = True
+            routed_requests = set().union(*self._worker_requests)
+            lost_requests = [request_id for request_id in self._futures if request_id not in routed_requests]
+        for request_id in lost_requests:
+            self._resolve(request_id, None, "all preprocessing workers have exited")
+        # every request has been routed, so model workers can exit once their queues are drained
+        for model_queue in self._model_queues:
+            model_queue.put(_STOP)
+
+    def _check_preprocess_workers(self, dead_workers: set) -> int:
+        """
+        Fail the request held by each preprocessing process which has died since the last check.
+        :return: the number of newly found dead processes, which will never send `_STOP`
+        """
+        num_dead = 0
+        for idx, process in enumerate(self._preprocess_workers):
+            # a process exiting normally has sent `_STOP` before
+            if idx in dead_workers or process.exitcode is None or process.exitcode == 0:
+                continue
+            dead_workers.add(idx)
+            num_dead += 1
+            logger.error("Preprocessing worker {} exited with code {}".format(idx, process.exitcode))
+            request_id = self._preprocess_requests[idx]
+            if request_id >= 0:
+                self._resolve(request_id, None, "preprocessing worker {} exited with code {}".format(
+                    idx, process.exitcode))
+        return num_dead
+
+    def _collect(self):
+        stopped_workers = set()
+        next_check_time = time.perf_counter() + _MONITOR_INTERVAL
+        while len(stopped_workers) < self.num_workers:
+            if time.perf_counter() >= next_check_time:
+                self._check_model_workers(stopped_workers)
+                next_check_time = time.perf_counter() + _MONITOR_INTERVAL
+            try:
+                message = self._result_queue.get(timeout=_MONITOR_INTERVAL)
+            except queue.Empty:
+                continue
+            self._handle_result(message, stopped_workers)
+
+    def _handle_result(self, message, stopped_workers: set):
+        worker_id, request_id, answer, error = message
+        if request_id is _STOP:
+            stopped_workers.add(worker_id)
+            return
+        with self._lock:
+            self._in_flight[worker_id] -= 1
+            self._num_served[worker_id] += 1
+            self._worker_requests[worker_id].discard(request_id)
+        self._resolve(request_id, answer, error)
+
+    def _check_model_workers(self, stopped_workers: set):
+        """
+        Fail the requests routed to each model process which has died since the last check, and stop routing
+        requests to it.
+        """
+        for worker_id, process in enumerate(self._model_workers):
+            # a process exiting normally has sent `_STOP` before
+            if worker_id in stopped_workers or process.exitcode is None or process.exitcode == 0:
+                continue
+            # the answers sent by the process before it died may still be in the queue
+            while True:
+                try:
+                    self._handle_result(self._result_queue.get_nowait(), stopped_workers)
+                except queue.Empty:
+                    break
+            logger.error("Model worker {} exited with code {}".format(worker_id, process.exitcode))
+            with self._lock:
+                self._worker_alive[worker_id] = False
+                pending_requests = self._worker_requests[worker_id]
+                self._worker_requests[worker_id] = set()
+                self._in_flight[worker_id] = 0
+            stopped_workers.add(worker_id)
+            for request_id in pending_requests:
+                self._resolve(request_id, None, "model worker {} exited with code {}".format(
+                    worker_id, process.exitcode))
+
+    def _resolve(self, request_id: int, answer: str, error: str):
+        with self._lock:
+            # the request may have been failed already, e.g., when its worker died after sending the answer
+            future = self._futures.pop(request_id, None)
+        if future is None:
+            return
+        if error is not None:
+            future.set_exception(RuntimeError("Failed to predict request {}: {}".format(request_id, error)))
+        else:
+            future.set_result(answer)
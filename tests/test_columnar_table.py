@@ -0,0 +1,59 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import copy
+import unittest
+
+from tapex.data_utils.table_store import TableStore
+from tapex.processor import ColumnarTable, ColumnPruneTruncate, IndexedRowTableLinearize
+
+from test_table_truncate import WhitespaceTokenizer
+
+SHORT_ROW_TABLE = {"header": ["a", "b", "c"], "rows": [["1", "2"], ["3", "4", "5"]]}
+LONG_ROW_TABLE = {"header": ["a", "b", "c"], "rows": [["1", "2", "3", "4"], ["5", "6", "7"]]}
+
+
+class ColumnarTableTest(unittest.TestCase):
+
+    def assert_same_as_dict(self, table_content):
+        linearizer = IndexedRowTableLinearize()
+        table = ColumnarTable.from_dict(table_content)
+        self.assertEqual(table.to_dict(), table_content)
+        self.assertEqual([len(row) for row in table["rows"]], [len(row) for row in table_content["rows"]])
+        self.assertEqual(linearizer.process_table(table), linearizer.process_table(table_content))
+        view = TableStore(lambda table_name: table_content).get("table")
+        self.assertEqual(linearizer.process_table(view), linearizer.process_table(table_content))
+
+    def test_short_row(self):
+        self.assert_same_as_dict(SHORT_ROW_TABLE)
+        row = ColumnarTable.from_dict(SHORT_ROW_TABLE)["rows"][0]
+        self.assertEqual(row[-1], "2")
+        with self.assertRaises(IndexError):
+            row[2]
+
+    def test_long_row(self):
+        self.assert_same_as_dict(LONG_ROW_TABLE)
+        self.assertEqual(ColumnarTable.from_dict(LONG_ROW_TABLE)["rows"][0][3], "4")
+
+    def test_delete_columns_of_ragged_rows(self):
+        header = ["column {}".format(col_idx) for col_idx in range(40)]
+        rows = [["cell {} {}".format(row_idx, col_idx) for col_idx in range(40 - row_idx % 3 * 10)]
+                for row_idx in range(10)]
+        rows[0].extend(["extra", "cells"])
+        rows[5][0] = "target"
+        table_content = {"header": header, "rows": rows}
+        linearizer = IndexedRowTableLinearize()
+        truncator = ColumnPruneTruncate(table_linearize=linearizer, tokenizer=WhitespaceTokenizer(),
+                                        max_input_length=200)
+        question = "what is the column 3 of target?"
+        dict_table = copy.deepcopy(table_content)
+        truncator.truncate_table(dict_table, question, [])
+        self.assertLess(len(dict_table["header"]), 40)
+        for table in [ColumnarTable.from_dict(table_content),
+                      TableStore(lambda table_name: table_content).get("table")]:
+            truncator.truncate_table(table, question, [])
+            self.assertEqual(linearizer.process_table(table), linearizer.process_table(dict_table))
+
+
+if __name__ == "__main__":
+    unittest.main()
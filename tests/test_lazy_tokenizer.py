@@ -0,0 +1,45 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from transformers import AutoTokenizer, BartTokenizerFast
+from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+
+from tapex.processor import get_default_processor
+
+
+def write_bpe_files(resource_dir):
+    """
+    Write a byte-level BPE without merges, whose tokens are the single bytes.
+    """
+    tokens = ["<s>", "<pad>", "</s>", "<unk>"] + list(bytes_to_unicode().values()) + ["<mask>"]
+    with open(os.path.join(resource_dir, "encoder.json"), "w", encoding="utf8") as encoder_f:
+        json.dump({token: idx for idx, token in enumerate(tokens)}, encoder_f)
+    with open(os.path.join(resource_dir, "vocab.bpe"), "w", encoding="utf8") as vocab_f:
+        vocab_f.write("#version: 0.2\n")
+
+
+class LazyTokenizerTest(unittest.TestCase):
+
+    def test_processor_loads_tokenizer_from_resource_dir(self):
+        table_content = {"header": ["name", "year"], "rows": [["alice", 1990], ["bob", 1991]]}
+        with tempfile.TemporaryDirectory() as resource_dir:
+            write_bpe_files(resource_dir)
+            with mock.patch.object(AutoTokenizer, "from_pretrained",
+                                   side_effect=AssertionError("the hub should not be used")) as from_pretrained:
+                processor = get_default_processor(max_cell_length=15, max_input_length=1024,
+                                                  resource_dir=resource_dir)
+                joint_input = processor.process_input(table_content, "who was born in 1990?", [])
+                tokenizer = processor.table_truncate_funcs[0].tokenizer.tokenizer
+            from_pretrained.assert_not_called()
+        self.assertIsInstance(tokenizer, BartTokenizerFast)
+        self.assertEqual(joint_input, "who was born in 1990? col : name | year row 1 : alice | 1990 row 2 : bob | 1991")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import unittest
+
+from tapex.processor import ColumnPruneTruncate, IndexedRowTableLinearize, TableView
+
+
+class WhitespaceTokenizer(object):
+    """
+    A stand-in for the BPE tokenizer, which counts every whitespace-separated word as one token.
+    """
+
+    def tokenize(self, text, add_special_tokens=False):
+        tokens = text.split()
+        return ["<s>"] + tokens + ["</s>"] if add_special_tokens else tokens
+
+    def __call__(self, texts, add_special_tokens=False):
+        return {"input_ids": [self.tokenize(text, add_special_tokens) for text in texts]}
+
+
+def build_prune_truncate(max_input_length, **kwargs):
+    return ColumnPruneTruncate(table_linearize=IndexedRowTableLinearize(), tokenizer=WhitespaceTokenizer(),
+                               max_input_length=max_input_length, **kwargs)
+
+
+class ColumnPruneTruncateTest(unittest.TestCase):
+
+    def test_wide_table_keeps_question_column(self):
+        header = ["city"] + ["metric {}".format(col_idx) for col_idx in range(39)]
+        rows = [["city{}".format(row_idx)] + ["value {} {}".format(row_idx, col_idx) for col_idx in range(39)]
+                for row_idx in range(10)]
+        table_content = {"header": header, "rows": rows}
+        build_prune_truncate(max_input_length=300).truncate_table(table_content,
+                                                                  "is the rain in city2 or city5 higher?", [])
+        self.assertLess(len(table_content["header"]), 40)
+        self.assertGreaterEqual(len(table_content["header"]), 8)
+        self.assertIn("city", table_content["header"])
+        self.assertTrue(all(len(row) == len(table_content["header"]) for row in table_content["rows"]))
+
+    def test_tall_narrow_table_is_not_pruned(self):
+        header = ["city", "country", "population"]
+        rows = [["city{}".format(row_idx), "country{}".format(row_idx), str(row_idx * 1000)]
+                for row_idx in range(400)]
+        table_content = {"header": header, "rows": rows}
+        build_prune_truncate(max_input_length=100).truncate_table(table_content,
+                                                                  "what is the population of city7?", [])
+        self.assertEqual(table_content["header"], header)
+        self.assertTrue(all(len(row) == 3 for row in table_content["rows"]))
+
+    def test_tall_table_fitting_after_row_deletion_is_not_pruned(self):
+        # only a few rows are related to the question, which fit in memory after `RowDeleteTruncate`
+        header = ["column {}".format(col_idx) for col_idx in range(30)]
+        rows = [["cell{}x{}".format(row_idx, col_idx) for col_idx in range(30)] for row_idx in range(200)]
+        table_content = {"header": header, "rows": rows}
+        build_prune_truncate(max_input_length=512).truncate_table(table_content, "what is in cell7x3?", [])
+        self.assertEqual(len(table_content["header"]), 30)
+
+    def test_answer_column_is_kept(self):
+        header = ["column {}".format(col_idx) for col_idx in range(40)]
+        rows = [["cell {} {}".format(row_idx, col_idx) for col_idx in range(40)] for row_idx in range(10)]
+        rows[4][25] = "gold"
+        table_content = {"header": header, "rows": rows}
+        build_prune_truncate(max_input_length=200, min_keep_columns=1).truncate_table(
+            table_content, "which one is the answer?", ["gold"])
+        self.assertIn("column 25", table_content["header"])
+        self.assertLess(len(table_content["header"]), 40)
+        self.assertEqual(table_content["rows"][4][table_content["header"].index("column 25")], "gold")
+
+    def test_ragged_rows(self):
+        header = ["column {}".format(col_idx) for col_idx in range(40)]
+        rows = [["cell {} {}".format(row_idx, col_idx) for col_idx in range(40 - row_idx % 3 * 10)]
+                for row_idx in range(10)]
+        rows[0].append("extra cell")
+        rows[5][0] = "target"
+        for table_content in [{"header": header, "rows": [list(row) for row in rows]},
+                              TableView({"header": header, "rows": rows})]:
+            build_prune_truncate(max_input_length=200).truncate_table(table_content,
+                                                                      "what is the column 3 of target?", [])
+            self.assertIn("column 3", table_content["header"])
+            self.assertLess(len(table_content["header"]), 40)
+            linear_table = IndexedRowTableLinearize().process_table(table_content)
+            self.assertIn("row 6 : target", linear_table)
+
+
+if __name__ == "__main__":
+    unittest.main()